@@ -0,0 +1,527 @@
+from __future__ import unicode_literals
+
+# Analyzing evaluator, a la SICP 4.1.7. Each form is turned into a tree of
+# Python closures once; running the program just calls the closures, so the
+# special-form dispatch in Environment.eval isn't repeated on every node.
+#
+# Local variables are resolved at analysis time to a (depth, slot) lexical
+# address (SICP 5.5.6), and live in list-backed Frames rather than
+# Environment dicts. Only globals are looked up by name.
+
+from environments import (
+    Environment, Symbol, QUOTE, GETHASH, LAMBDA, DEFINE, SET, IF, COND, AND,
+    OR, PROGN, LET, MAP, SEQ, MEMOIZE, DEFINE_MEMOIZED, PMAP, PROFILE,
+    DEFMACRO, QUASIQUOTE,
+)
+from lazy import map_values
+import limits
+import macros
+from macros import define_macro_form, expansion, find_macro, macro_expander
+from memo import define_memoized_form, memoize, memoize_args
+from optimize import optimize_lambda, rebound, watch
+from parallel import pmap, pmap_args
+import profiler
+from pylisp import Procedure, TailCall, name_procedure
+
+
+class Unbound(object):
+    def __repr__(self):
+        return '<unbound>'
+
+UNBOUND = Unbound()
+
+
+class Frame(list):
+    # No __init__, so creating one stays in C: callers set .parent directly.
+    __slots__ = ('parent',)
+
+
+class Scope(object):
+    # Analysis-time mirror of a Frame: the names of its slots.
+
+    def __init__(self, names, parent, is_procedure):
+        self.names = names
+        self.parent = parent
+        self.is_procedure = is_procedure
+
+    def resolve(self, name):
+        scope, depth = self, 0
+        while scope is not None:
+            if name in scope.names:
+                return depth, scope.names.index(name)
+            scope, depth = scope.parent, depth + 1
+        return None
+
+    def procedure_scope(self):
+        scope, depth = self, 0
+        while scope is not None and not scope.is_procedure:
+            scope, depth = scope.parent, depth + 1
+        return scope, depth
+
+
+class TestedTailCall(TailCall):
+    # A tail call as the last of an and, whose value is tested too
+    __slots__ = ()
+
+
+class AnalyzedProcedure(Procedure):
+
+    def __init__(self, arglist, body, parent_env, code, nslots, genv):
+        super(AnalyzedProcedure, self).__init__(arglist, body, parent_env)
+        self.code = code
+        self.nslots = nslots
+        self.genv = genv
+
+    def home(self):
+        return self.genv if self.source is not None else None
+
+    def rebind(self, genv):
+        return analyze_lambda(self.source, None, genv)(None)
+
+    def bind(self, args):
+        values = list(args)
+        if len(values) != self.nslots:
+            values = (values + [UNBOUND] * self.nslots)[:self.nslots]
+        frame = Frame(values)
+        frame.parent = self.parent_env
+        return frame
+
+    def __call__(self, *args):
+        limits.local.fuel -= 1
+        if not limits.local.fuel:
+            limits.refuel()
+        if profiler.active:
+            return profiler.call(self, run_traced, self, args)
+        # Procedure calls in tail position come back as TailCalls
+        ret = self.code(self.bind(args))
+        while type(ret) is TailCall:
+            limits.local.fuel -= 1
+            if not limits.local.fuel:
+                limits.refuel()
+            ret = ret.proc.code(ret.proc.bind(ret.args))
+        if type(ret) is TestedTailCall:
+            return run_tested(ret)
+        return ret
+
+
+def run_tested(ret):
+    # Finish a chain of tail calls that an and tests the value of
+    while isinstance(ret, TailCall):
+        limits.spend()
+        ret = ret.proc.code(ret.proc.bind(ret.args))
+    return None if ret in [None, False] else ret
+
+
+def run_traced(proc, args):
+    # AnalyzedProcedure.__call__ while profiling
+    ret = proc.code(proc.bind(args))
+    tested = False
+    while isinstance(ret, TailCall):
+        limits.spend()
+        tested = tested or type(ret) is TestedTailCall
+        proc = ret.proc
+        profiler.tail(profiler.proc_name(proc))
+        ret = proc.code(proc.bind(ret.args))
+    if tested and ret in [None, False]:
+        ret = None
+    return ret
+
+
+limits.nesting_codes.update([AnalyzedProcedure.__call__.__func__.__code__,
+                             run_traced.__code__])
+
+
+class AnalyzedEnvironment(Environment):
+
+    def eval(self, expr):
+        return analyze(expr, None, self)(None)
+
+
+def form_head(expr):
+    head = expr[0] if expr else None
+    return head if isinstance(head, Symbol) else None
+
+
+def frame_at(frame, depth):
+    for _ in xrange(depth):
+        frame = frame.parent
+    return frame
+
+
+def internal_defines(expr, expand=None):
+    # Names `define`d in a procedure body, not counting nested lambdas. These
+    # get slots in the procedure's own frame. expand(form) gives the
+    # expansion of a macro call, or None for anything else.
+    if not isinstance(expr, list) or not expr:
+        return []
+    expanded = expand(expr) if expand is not None else None
+    if expanded is not None:
+        return internal_defines(expanded, expand)
+    head = form_head(expr)
+    if head is QUOTE or head is LAMBDA or head is QUASIQUOTE:
+        return []
+    names = []
+    if (head in (DEFINE, DEFINE_MEMOIZED, DEFMACRO) and
+            isinstance(expr[1], Symbol)):
+        names.append(expr[1].value)
+    for sub in expr[1:]:
+        for n in internal_defines(sub, expand):
+            if n not in names:
+                names.append(n)
+    return names
+
+
+def analyze_self(expr, scope, genv, tail=False):
+    return lambda frame: expr
+
+
+def unbound_error(name):
+    return ValueError('Symbol "{}" not found'.format(name))
+
+
+def analyze_local(name, depth, slot):
+    def check(val):
+        if val is UNBOUND:
+            raise unbound_error(name)
+        return val
+
+    if depth == 0:
+        return lambda frame: check(frame[slot])
+    elif depth == 1:
+        return lambda frame: check(frame.parent[slot])
+    return lambda frame: check(frame_at(frame, depth)[slot])
+
+
+def analyze_global(name, genv):
+    # Names missing from genv itself fall back to its parents (a fork's
+    # base) through Environment.__missing__
+    return lambda frame: genv[name]
+
+
+def analyze_symbol(expr, scope, genv, tail=False):
+    name = expr.value
+    address = scope.resolve(name) if scope else None
+    if address is not None:
+        return analyze_local(name, *address)
+    return analyze_global(name, genv)
+
+
+def analyze_quote(expr, scope, genv, tail=False):
+    return analyze_self(expr[1], scope, genv)
+
+
+def analyze_gethash(expr, scope, genv, tail=False):
+    key, table = analyze(expr[1], scope, genv), analyze(expr[2], scope, genv)
+    return lambda frame: table(frame).get(key(frame))
+
+
+def analyze_lambda(expr, scope, genv, tail=False):
+    arglist = expr[1]
+    body = expr[2]
+    names = [arg.value for arg in arglist]
+    expand = macro_expander(Scope(list(names), scope, True), genv)
+    names += [n for n in internal_defines(body, expand) if n not in names]
+    nslots = len(names)
+
+    def build():
+        # [generation, body, code, names what's folded relies on]
+        assumed = set()
+        body = optimize_lambda(
+            expr, lambda name: scope is not None and
+            scope.resolve(name) is not None, genv, assumed)
+        code = analyze(body, Scope(list(names), scope, True), genv, True)
+        return [genv.generation, body, code, frozenset(assumed)]
+    built = build()
+
+    def current():
+        # Built again once a name it relied on may have been set
+        if built[3] and built[0] != genv.generation:
+            built[:] = build()
+        return built
+
+    def refresh(proc):
+        _, proc.body, proc.code, assumed = current()
+        return assumed
+
+    def make(frame):
+        _, body, code, assumed = current()
+        proc = AnalyzedProcedure(arglist, body, frame, code, nslots, genv)
+        watch(proc, assumed, refresh)
+        return proc
+
+    def make_toplevel(frame):
+        proc = make(frame)
+        proc.source = expr
+        return proc
+    return make if scope is not None else make_toplevel
+
+
+def analyze_define(expr, scope, genv, tail=False):
+    sym = expr[1]
+    name = sym.value
+    value = analyze(expr[2], scope, genv)
+    target, depth = scope.procedure_scope() if scope else (None, None)
+
+    if target is None:
+        def run(frame):
+            if genv.defines(name):
+                raise ValueError(
+                    '{} already defined in environment'.format(sym))
+            val = genv[name] = value(frame)
+            name_procedure(val, name)
+            return val
+        return run
+
+    slot = target.names.index(name)
+
+    def run(frame):
+        target_frame = frame_at(frame, depth)
+        if target_frame[slot] is not UNBOUND:
+            raise ValueError('{} already defined in environment'.format(sym))
+        val = target_frame[slot] = value(frame)
+        name_procedure(val, name)
+        return val
+    return run
+
+
+def analyze_set(expr, scope, genv, tail=False):
+    place = expr[1]
+    value = analyze(expr[2], scope, genv)
+    if isinstance(place, list) and form_head(place) is GETHASH:
+        key = analyze(place[1], scope, genv)
+        table = analyze(place[2], scope, genv)
+
+        def run(frame):
+            val = value(frame)
+            table(frame)[key(frame)] = val
+            return val
+        return run
+
+    if (isinstance(place, list) and form_head(place) is QUOTE and
+            isinstance(place[1], Symbol) and scope and
+            scope.resolve(place[1].value) is not None):
+        # (set 'x ...) on a local: write straight to its slot
+        sym = place[1]
+        depth, slot = scope.resolve(sym.value)
+
+        def run(frame):
+            val = value(frame)
+            target_frame = frame_at(frame, depth)
+            if target_frame[slot] is UNBOUND:
+                raise ValueError('{} not found in environment'.format(sym))
+            target_frame[slot] = val
+            return val
+        return run
+
+    # Otherwise the place must evaluate to the Symbol of a global
+    sym_code = analyze(place, scope, genv)
+
+    def run(frame):
+        val = value(frame)
+        sym = sym_code(frame)
+        if not isinstance(sym, Symbol):
+            raise TypeError('{} is not a Symbol'.format(sym))
+        if not genv.defines(sym.value):
+            raise ValueError('{} not found in environment'.format(sym))
+        genv[sym.value] = val
+        rebound(genv, sym.value)
+        return val
+    return run
+
+
+def analyze_if(expr, scope, genv, tail=False):
+    cond = analyze(expr[1], scope, genv)
+    true_code = analyze(expr[2], scope, genv, tail)
+    false_code = analyze(expr[3] if len(expr) > 3 else None, scope, genv, tail)
+    return lambda frame: true_code(frame) if cond(frame) else false_code(frame)
+
+
+def analyze_cond(expr, scope, genv, tail=False):
+    clauses = [(analyze(cond, scope, genv), analyze(result, scope, genv, tail))
+               for cond, result in expr[1:]]
+
+    def run(frame):
+        for cond, result in clauses:
+            if cond(frame):
+                return result(frame)
+        # No conditions matched
+        return None
+    return run
+
+
+def analyze_forms(exprs, scope, genv, tail):
+    # Only the last of a run of forms is in tail position
+    return ([analyze(exp, scope, genv) for exp in exprs[:-1]] +
+            [analyze(exp, scope, genv, tail) for exp in exprs[-1:]])
+
+
+def analyze_and(expr, scope, genv, tail=False):
+    forms = analyze_forms(expr[1:], scope, genv, tail)
+
+    def run(frame):
+        result = True
+        for form in forms:
+            result = form(frame)
+            if result in [None, False]:
+                return None
+        if type(result) is TailCall:
+            # The last value is tested too, once the call has made it
+            return TestedTailCall(result.proc, result.args)
+        return result
+    return run
+
+
+def analyze_or(expr, scope, genv, tail=False):
+    forms = analyze_forms(expr[1:], scope, genv, tail)
+
+    def run(frame):
+        result = None
+        for form in forms:
+            result = form(frame)
+            if result not in [None, False]:
+                return result
+        return result
+    return run
+
+
+def analyze_sequence(exprs, scope, genv, tail=False):
+    forms = analyze_forms(exprs, scope, genv, tail)
+    if len(forms) == 1:
+        return forms[0]
+
+    def run(frame):
+        ret = None
+        for form in forms:
+            ret = form(frame)
+        return ret
+    return run
+
+
+def analyze_progn(expr, scope, genv, tail=False):
+    return analyze_sequence(expr[1:], scope, genv, tail)
+
+
+def analyze_let(expr, scope, genv, tail=False):
+    names = [form[0].value for form in expr[1]]
+    values = [analyze(form[1], scope, genv) for form in expr[1]]
+    body = analyze_sequence(expr[2:], Scope(names, scope, False), genv, tail)
+
+    def run(frame):
+        new_frame = Frame([value(frame) for value in values])
+        new_frame.parent = frame
+        if profiler.active:
+            profiler.frame()
+        return body(new_frame)
+    return run
+
+
+def analyze_map(expr, scope, genv, tail=False):
+    proc_code = analyze(expr[1], scope, genv)
+    arg_codes = [analyze(arg, scope, genv) for arg in expr[2:]]
+
+    def run(frame):
+        proc = proc_code(frame)
+        args_list = [arg(frame) for arg in arg_codes]
+        return map_values(proc, args_list)
+    return run
+
+
+def analyze_seq(expr, scope, genv, tail=False):
+    arg_codes = [analyze(arg, scope, genv) for arg in expr[1:]]
+    return lambda frame: range(*[arg(frame) for arg in arg_codes])
+
+
+def analyze_memoize(expr, scope, genv, tail=False):
+    arg_codes = [analyze(arg, scope, genv) for arg in memoize_args(expr)]
+    return lambda frame: memoize(*[arg(frame) for arg in arg_codes])
+
+
+def analyze_define_memoized(expr, scope, genv, tail=False):
+    return analyze_define(define_memoized_form(expr), scope, genv, tail)
+
+
+def analyze_pmap(expr, scope, genv, tail=False):
+    arg_codes = [analyze(arg, scope, genv) for arg in pmap_args(expr)]
+    return lambda frame: pmap(*[arg(frame) for arg in arg_codes])
+
+
+def analyze_profile(expr, scope, genv, tail=False):
+    code = analyze(expr[1], scope, genv)
+    path = analyze(expr[2] if len(expr) > 2 else None, scope, genv)
+    return lambda frame: profiler.profile_form(lambda: code(frame),
+                                               path(frame))
+
+
+def analyze_defmacro(expr, scope, genv, tail=False):
+    return analyze_define(define_macro_form(expr), scope, genv, tail)
+
+
+def analyze_quasiquote(expr, scope, genv, tail=False):
+    return analyze(expansion(macros.quasiquote, expr), scope, genv, tail)
+
+
+def analyze_proc(expr, scope, genv, tail=False):
+    proc_code = analyze(expr[0], scope, genv)
+    arg_codes = [analyze(arg, scope, genv) for arg in expr[1:]]
+
+    if tail:
+        def run_tail(frame):
+            proc = proc_code(frame)
+            args = [arg(frame) for arg in arg_codes]
+            if isinstance(proc, AnalyzedProcedure):
+                # Let the caller's trampoline make the call
+                return TailCall(proc, args)
+            ret = (profiler.apply(proc, args) if profiler.active
+                   else proc(*args))
+            if ret is False:
+                # Lisp!
+                ret = None
+            return ret
+        return run_tail
+
+    def run(frame):
+        proc = proc_code(frame)
+        args = [arg(frame) for arg in arg_codes]
+        ret = profiler.apply(proc, args) if profiler.active else proc(*args)
+        if ret is False:
+            # Lisp!
+            ret = None
+        return ret
+    return run
+
+
+special_forms = {
+    QUOTE: analyze_quote,
+    GETHASH: analyze_gethash,
+    LAMBDA: analyze_lambda,
+    DEFINE: analyze_define,
+    SET: analyze_set,
+    IF: analyze_if,
+    COND: analyze_cond,
+    AND: analyze_and,
+    OR: analyze_or,
+    PROGN: analyze_progn,
+    LET: analyze_let,
+    MAP: analyze_map,
+    SEQ: analyze_seq,
+    MEMOIZE: analyze_memoize,
+    DEFINE_MEMOIZED: analyze_define_memoized,
+    PMAP: analyze_pmap,
+    PROFILE: analyze_profile,
+    DEFMACRO: analyze_defmacro,
+    QUASIQUOTE: analyze_quasiquote,
+}
+
+
+def analyze(expr, scope, genv, tail=False):
+    if isinstance(expr, Symbol):
+        return analyze_symbol(expr, scope, genv, tail)
+    elif not isinstance(expr, list):
+        return analyze_self(expr, scope, genv)
+    head = form_head(expr)
+    if head in special_forms:
+        return special_forms[head](expr, scope, genv, tail)
+    macro = find_macro(head, scope, genv)
+    if macro is not None:
+        return analyze(expansion(macro, expr), scope, genv, tail)
+    return analyze_proc(expr, scope, genv, tail)
@@ -0,0 +1,368 @@
+from __future__ import unicode_literals
+
+# Benchmarks for the reader, the engines and the standard procedures.
+#
+#   python -m pylisp.benchmark                      run them all
+#   python -m pylisp.benchmark -e vm -k fib         just some of them
+#   python -m pylisp.benchmark -o baseline.json     save the results
+#   python -m pylisp.benchmark -c baseline.json     flag regressions against
+#                                                   saved results
+#
+# Speed is in ops per second, for the best of several timings; what an op is
+# depends on the benchmark (a token, a form, a procedure call...). Each
+# benchmark runs in a forked child, so its memory peak -- how far the child's
+# maximum resident set size grew, in KB -- is its own.
+
+from collections import OrderedDict, namedtuple
+import argparse
+import cPickle
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import traceback
+
+from read import read_forms, tokenize
+
+FORMAT_VERSION = 1
+
+# setup(engine) does any preparation and returns a function doing one run,
+# which is `ops` ops. per_engine benchmarks run once for each engine.
+Benchmark = namedtuple('Benchmark', 'name ops setup per_engine')
+
+benchmarks = OrderedDict()
+
+ENGINES = ['interp', 'analyze', 'vm']
+
+# Memory growth smaller than this is noise, whatever the threshold
+MEMORY_SLACK_KB = 512
+
+
+def benchmark(name, ops, per_engine=True):
+    def register(setup):
+        benchmarks[name] = Benchmark(name, ops, setup, per_engine)
+        return setup
+    return register
+
+
+def generated_source(num_forms):
+    # Top-level forms with the usual mix of things programs are made of
+    return '\n'.join(
+        '(define f{0} (lambda (x y) (let ((z (* x {0})))\n'
+        '  (if (< z y) "small {0}" (+ z y 1.5 (quote (a b {0})))))))'.format(i)
+        for i in xrange(num_forms))
+
+
+SOURCE_FORMS = 1000
+SOURCE = generated_source(SOURCE_FORMS)
+
+
+def eval_setup(engine, setup_source, expr):
+    from environments import reset_global_env
+    from read import parse
+    import environments
+
+    reset_global_env(engine)
+    env = environments.global_env
+    for form in read_forms(setup_source):
+        env.eval(form)
+    expr = parse(expr)
+    return lambda: env.eval(expr)
+
+
+@benchmark('tokenize', len(tokenize(SOURCE)), per_engine=False)
+def tokenize_setup(_engine):
+    return lambda: tokenize(SOURCE)
+
+
+@benchmark('read', SOURCE_FORMS, per_engine=False)
+def read_setup(_engine):
+    return lambda: list(read_forms(SOURCE))
+
+
+# Calls of fib
+@benchmark('fib', 1973)
+def fib_setup(engine):
+    return eval_setup(engine, '', '(fib 15)')
+
+
+# The same, within a budget it won't use up, for what checking it costs
+@benchmark('fib-budget', 1973)
+def fib_budget_setup(engine):
+    from limits import Budget
+
+    run = eval_setup(engine, '', '(fib 15)')
+
+    def run_budgeted():
+        with Budget(steps=10 ** 9, seconds=3600, depth=1000):
+            return run()
+    return run_budgeted
+
+
+# Calls of fact
+@benchmark('fact', 100)
+def fact_setup(engine):
+    return eval_setup(engine, '', '(fact 100)')
+
+
+# Closures made and called
+@benchmark('closures', 1000)
+def closures_setup(engine):
+    return eval_setup(
+        engine,
+        '(define make-adder (lambda (n) (let ((k (* n 2))) '
+        '(lambda (x) (let ((y (+ x k))) y)))))',
+        '(reduce + (map (lambda (i) ((make-adder i) i)) (seq 1000)))')
+
+
+# Stores and lookups
+@benchmark('hash-tables', 2000)
+def hash_tables_setup(engine):
+    return eval_setup(
+        engine, '(define table (make-hash-table))',
+        '(progn (map (lambda (i) (set (gethash i table) (* i i))) (seq 1000)) '
+        '(reduce + (map (lambda (i) (gethash i table)) (seq 1000))))')
+
+
+# Elements mapped
+@benchmark('map', 10000)
+def map_setup(engine):
+    return eval_setup(engine, '', '(map (lambda (x) (* x x)) (seq 10000))')
+
+
+CONCURRENT = 1000
+# Each evaluation waits this long for a lookup, and computes a bit
+LOOKUP_TIME = 0.005
+CONCURRENT_SOURCE = '(+ (lookup 1) (fib 8))'
+
+
+# Evaluations, all at once, as tasks on one loop
+@benchmark('concurrent-tasks', CONCURRENT, per_engine=False)
+def concurrent_tasks_setup(_engine):
+    from read import parse
+    from tasks import AsyncPrimitive, Future, Loop, evaluate, gather, session
+
+    forms = [parse(CONCURRENT_SOURCE)]
+
+    def run():
+        loop = Loop()
+
+        def lookup(x):
+            future = Future()
+            loop.call_later(LOOKUP_TIME, future.set_result, x)
+            return future
+
+        tasks = []
+        for _ in xrange(CONCURRENT):
+            env = session()
+            env['lookup'] = AsyncPrimitive(lookup)
+            tasks.append(evaluate(forms, env, loop))
+        loop.run_until_complete(gather(tasks))
+    return run
+
+
+# The same, with a thread for each evaluation
+@benchmark('concurrent-threads', CONCURRENT, per_engine=False)
+def concurrent_threads_setup(_engine):
+    import threading
+    from read import parse
+    from tasks import session
+
+    form = parse(CONCURRENT_SOURCE)
+
+    def lookup(x):
+        time.sleep(LOOKUP_TIME)
+        return x
+
+    def run():
+        threads = []
+        for _ in xrange(CONCURRENT):
+            env = session()
+            env['lookup'] = lookup
+            threads.append(threading.Thread(target=env.eval, args=(form,)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return run
+
+
+@benchmark('startup', 1)
+def startup_setup(engine):
+    from environments import reset_global_env
+
+    return lambda: reset_global_env(engine)
+
+
+def max_rss_kb():
+    # ru_maxrss is in KB on Linux, bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def measure(bench, engine=None, repeat=5, min_time=0.1):
+    rss = max_rss_kb()
+    run = bench.setup(engine)
+    # Warm up, then find how many runs make a timing long enough to trust
+    run()
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            run()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed < min_time / 10 else 1 + int(
+            min_time / max(elapsed, 1e-9))
+    timings = [elapsed]
+    for _ in xrange(repeat - 1):
+        start = time.time()
+        for _ in xrange(number):
+            run()
+        timings.append(time.time() - start)
+    return {
+        'ops': bench.ops,
+        'runs': number,
+        'ops_per_sec': bench.ops * number / min(timings),
+        'peak_kb': max_rss_kb() - rss,
+    }
+
+
+def isolated(function, *args):
+    # function(*args), in a forked child when possible, so memory use doesn't
+    # carry over from one benchmark to the next
+    if not hasattr(os, 'fork'):
+        return function(*args)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        try:
+            os.close(read_fd)
+            try:
+                result = 'ok', function(*args)
+            except Exception:                       # pylint: disable=W0703
+                result = 'error', traceback.format_exc()
+            with os.fdopen(write_fd, 'wb') as f:
+                cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            os._exit(0)                             # pylint: disable=W0212
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError('Benchmark process died')
+    status, result = cPickle.loads(data)
+    if status == 'error':
+        raise RuntimeError('Benchmark failed:\n' + result)
+    return result
+
+
+def run_benchmarks(engines=None, pattern=None, repeat=5, min_time=0.1,
+                   report=None):
+    # name (or name/engine) -> results
+    results = OrderedDict()
+    for bench in benchmarks.itervalues():
+        if pattern and pattern not in bench.name:
+            continue
+        for engine in (engines or ENGINES) if bench.per_engine else [None]:
+            key = '{}/{}'.format(bench.name, engine) if engine else bench.name
+            results[key] = isolated(measure, bench, engine, repeat, min_time)
+            if report:
+                report(key, results[key])
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    # Descriptions of what got slower, or bigger, than in baseline
+    regressions = []
+    for key, result in results.iteritems():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold):
+            regressions.append('{}: {:.0f} ops/sec, {:.0%} slower than {:.0f}'
+                               .format(key, result['ops_per_sec'],
+                                       1 - result['ops_per_sec'] /
+                                       base['ops_per_sec'],
+                                       base['ops_per_sec']))
+        growth = result['peak_kb'] - base['peak_kb']
+        if (growth > MEMORY_SLACK_KB and
+                result['peak_kb'] > base['peak_kb'] * (1 + threshold)):
+            regressions.append('{}: peak of {} KB, up from {} KB'.format(
+                key, result['peak_kb'], base['peak_kb']))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version') != FORMAT_VERSION:
+        raise ValueError('{} is not a benchmark results file'.format(path))
+    return data['results']
+
+
+def save(path, results):
+    data = {
+        'version': FORMAT_VERSION,
+        'python': platform.python_version(),
+        'time': time.time(),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pylisp.benchmark',
+        description='Benchmark the reader, engines and standard procedures.')
+    parser.add_argument('-e', '--engine', action='append', choices=ENGINES,
+                        help='engine to run (repeatable; default all)')
+    parser.add_argument('-k', dest='pattern',
+                        help='only benchmarks with this in their names')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='timings per benchmark, of which the best counts')
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='seconds each timing should take, at least')
+    parser.add_argument('-o', '--output', help='save results as JSON here')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+                        help='flag regressions against results saved by -o')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='fraction slower or bigger that counts as a '
+                        'regression (default 0.1)')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON instead of a table')
+    args = parser.parse_args(argv)
+
+    baseline = load(args.compare) if args.compare else {}
+
+    def report(key, result):
+        if args.json:
+            return
+        line = '{:<22} {:>14,.0f} ops/sec {:>8} KB'.format(
+            key, result['ops_per_sec'], result['peak_kb'])
+        if key in baseline:
+            line += ' {:>+8.1%}'.format(
+                result['ops_per_sec'] / baseline[key]['ops_per_sec'] - 1)
+        print line
+        sys.stdout.flush()
+
+    results = run_benchmarks(args.engine, args.pattern, args.repeat,
+                             args.min_time, report)
+    if args.json:
+        print json.dumps(results, indent=2)
+    if args.output:
+        save(args.output, results)
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print >> sys.stderr, 'Regression: ' + regression
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
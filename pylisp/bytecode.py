@@ -0,0 +1,448 @@
+from __future__ import unicode_literals
+
+# Compiles parsed forms to a linear bytecode for the stack machine in vm.py.
+# Locals are resolved to lexical addresses exactly as in analyze.py; a Code
+# object holds only plain data (ints, constants, names and nested Code
+# objects), so it can be pickled and cached.
+
+import threading
+
+from analyze import Scope, form_head, internal_defines
+from environments import (
+    Symbol, QUOTE, GETHASH, LAMBDA, DEFINE, SET, IF, COND, AND, OR, PROGN,
+    LET, MAP, SEQ, MEMOIZE, DEFINE_MEMOIZED, PMAP, PROFILE, DEFMACRO,
+    QUASIQUOTE,
+)
+import macros
+from macros import define_macro_form, expansion, find_macro, macro_expander
+from memo import define_memoized_form, memoize, memoize_args
+from optimize import optimize_lambda
+from parallel import pmap, pmap_args
+
+opnames = [
+    'CONST',            # push consts[arg]
+    'LOAD_LOCAL',       # push the local at lexical address arg
+    'LOAD_GLOBAL',      # push the global names[arg]
+    'DEFINE_LOCAL',     # bind the unbound local at arg to TOS
+    'DEFINE_GLOBAL',    # bind the undefined global names[arg] to TOS
+    'SET_LOCAL',        # assign TOS to the bound local at arg
+    'SET_GLOBAL',       # pop a Symbol and assign TOS to that global
+    'LOAD_HASH',        # pop key and table, push table.get(key)
+    'STORE_HASH',       # pop key and table, table[key] = TOS
+    'POP',              # discard TOS
+    'JUMP',             # continue at arg
+    'JUMP_IF_FALSE',    # pop TOS, continue at arg if it's false
+    'AND_TEST',         # if TOS is None/False, make it None and jump to arg,
+                        # otherwise pop it
+    'OR_TEST',          # if TOS isn't None/False jump to arg, else pop it
+    'MAKE_CLOSURE',     # push a procedure for the Code in consts[arg]
+    'ENTER_LET',        # pop arg values into a new frame
+    'LEAVE_LET',        # return to the let frame's parent
+    'CALL',             # call the procedure under arg arguments
+    'TAIL_CALL',        # same, replacing the current call
+    'RETURN',           # return TOS to the caller
+    'MAP_CALL',         # map the procedure under arg lists over them
+    'BUILD_SEQ',        # pop arg arguments, push range(*args)
+]
+(CONST, LOAD_LOCAL, LOAD_GLOBAL, DEFINE_LOCAL, DEFINE_GLOBAL, SET_LOCAL,
+ SET_GLOBAL, LOAD_HASH, STORE_HASH, POP, JUMP, JUMP_IF_FALSE, AND_TEST,
+ OR_TEST, MAKE_CLOSURE, ENTER_LET, LEAVE_LET, CALL, TAIL_CALL, RETURN,
+ MAP_CALL, BUILD_SEQ) = range(len(opnames))
+
+# Lexical addresses are packed into a single int argument
+SLOT_BITS = 16
+SLOT_MASK = (1 << SLOT_BITS) - 1
+
+
+def pack_address(depth, slot):
+    return (depth << SLOT_BITS) | slot
+
+
+def unpack_address(addr):
+    return addr >> SLOT_BITS, addr & SLOT_MASK
+
+
+class Code(object):
+
+    # For a procedure with something folded into it: the names that relies on
+    # (see optimize.watch), and the lambda and scope to compile it again from
+    assumed = frozenset()
+    source = scope = None
+
+    def __init__(self, name, argnames=(), nslots=0, body=None):
+        self.name = name
+        self.argnames = list(argnames)
+        self.nslots = nslots
+        self.body = body    # source form, for procedures
+        self.code = []      # [op, arg, op, arg, ...]
+        self.consts = []
+        self.names = []
+        self.varnames = {}  # lexical address -> name, for error messages
+
+    def __repr__(self):
+        return '<Code {} at {:#x}>'.format(self.name, id(self))
+
+    def emit(self, op, arg=0):
+        self.code.extend((op, arg))
+        return len(self.code) - 1
+
+    def here(self):
+        return len(self.code)
+
+    def patch(self, arg_index, target):
+        self.code[arg_index] = target
+
+    def const(self, value):
+        for i, c in enumerate(self.consts):
+            if c is value:
+                return i
+        self.consts.append(value)
+        return len(self.consts) - 1
+
+    def local(self, name, depth, slot):
+        addr = pack_address(depth, slot)
+        self.varnames[addr] = name
+        return addr
+
+    def add_name(self, name):
+        if name not in self.names:
+            self.names.append(name)
+        return self.names.index(name)
+
+
+def disassemble(code, indent=''):
+    from pylisp import Procedure
+
+    if isinstance(code, Procedure):
+        code = code.code
+    lines = ['{}{} ({})'.format(indent, code.name, ' '.join(code.argnames))]
+    nested = []
+    for pc in xrange(0, len(code.code), 2):
+        op, arg = code.code[pc], code.code[pc + 1]
+        opname = opnames[op]
+        if op in (CONST, MAKE_CLOSURE):
+            detail = repr(code.consts[arg])
+            if op == MAKE_CLOSURE:
+                nested.append(code.consts[arg])
+        elif op in (LOAD_GLOBAL, DEFINE_GLOBAL):
+            detail = code.names[arg]
+        elif op in (LOAD_LOCAL, DEFINE_LOCAL, SET_LOCAL):
+            detail = 'depth {}, slot {}'.format(*unpack_address(arg))
+        elif op in (JUMP, JUMP_IF_FALSE, AND_TEST, OR_TEST):
+            detail = '-> {}'.format(arg)
+        else:
+            detail = ''
+        lines.append('{}{:>5} {:<14}{:>6}  {}'.format(
+            indent, pc, opname, arg, detail).rstrip())
+    for sub in nested:
+        lines.append('')
+        lines.append(disassemble(sub, indent + '    '))
+    return '\n'.join(lines)
+
+
+def compile_return(code, tail):
+    if tail:
+        code.emit(RETURN)
+
+
+def compile_const(value, scope, code, tail=False):
+    code.emit(CONST, code.const(value))
+    compile_return(code, tail)
+
+
+def compile_symbol(expr, scope, code, tail=False):
+    address = scope.resolve(expr.value) if scope else None
+    if address is not None:
+        code.emit(LOAD_LOCAL, code.local(expr.value, *address))
+    else:
+        code.emit(LOAD_GLOBAL, code.add_name(expr.value))
+    compile_return(code, tail)
+
+
+def compile_quote(expr, scope, code, tail=False):
+    compile_const(expr[1], scope, code, tail)
+
+
+def compile_gethash(expr, scope, code, tail=False):
+    compile_expr(expr[2], scope, code)
+    compile_expr(expr[1], scope, code)
+    code.emit(LOAD_HASH)
+    compile_return(code, tail)
+
+
+def compile_lambda(expr, scope, code, tail=False, name='lambda'):
+    code.emit(MAKE_CLOSURE, code.const(lambda_code(expr, scope, name)))
+    compile_return(code, tail)
+
+
+def lambda_code(expr, scope, name):
+    arglist, body = expr[1], expr[2]
+    argnames = [arg.value for arg in arglist]
+    genv = local.macro_env
+    expand = (macro_expander(Scope(argnames, scope, True), genv)
+              if genv is not None else None)
+    names = argnames + [n for n in internal_defines(body, expand)
+                        if n not in argnames]
+    assumed = set()
+    body = optimize_lambda(
+        expr, lambda name: scope is not None and
+        scope.resolve(name) is not None, genv, assumed)
+    sub = Code(name, argnames, len(names), body)
+    if assumed:
+        sub.assumed = frozenset(assumed)
+        sub.source, sub.scope = expr, scope
+    compile_expr(body, Scope(names, scope, True), sub, True)
+    return sub
+
+
+def recompile_lambda(sub, genv):
+    # sub compiled again from its lambda, for after a name it relied on has
+    # been set
+    saved, local.macro_env = local.macro_env, genv
+    try:
+        return lambda_code(sub.source, sub.scope, sub.name)
+    finally:
+        local.macro_env = saved
+
+
+def compile_define(expr, scope, code, tail=False):
+    sym, value = expr[1], expr[2]
+    if isinstance(value, list) and form_head(value) is LAMBDA:
+        compile_lambda(value, scope, code, name=sym.value)
+    else:
+        compile_expr(value, scope, code)
+    target, depth = scope.procedure_scope() if scope else (None, None)
+    if target is None:
+        code.emit(DEFINE_GLOBAL, code.add_name(sym.value))
+    else:
+        code.emit(DEFINE_LOCAL, code.local(
+            sym.value, depth, target.names.index(sym.value)))
+    compile_return(code, tail)
+
+
+def compile_set(expr, scope, code, tail=False):
+    place = expr[1]
+    compile_expr(expr[2], scope, code)
+    if isinstance(place, list) and form_head(place) is GETHASH:
+        compile_expr(place[2], scope, code)
+        compile_expr(place[1], scope, code)
+        code.emit(STORE_HASH)
+    elif (isinstance(place, list) and form_head(place) is QUOTE and
+          isinstance(place[1], Symbol) and scope and
+          scope.resolve(place[1].value) is not None):
+        code.emit(SET_LOCAL, code.local(
+            place[1].value, *scope.resolve(place[1].value)))
+    else:
+        compile_expr(place, scope, code)
+        code.emit(SET_GLOBAL)
+    compile_return(code, tail)
+
+
+def compile_if(expr, scope, code, tail=False):
+    compile_expr(expr[1], scope, code)
+    to_false = code.emit(JUMP_IF_FALSE)
+    compile_expr(expr[2], scope, code, tail)
+    if not tail:
+        to_end = code.emit(JUMP)
+    code.patch(to_false, code.here())
+    compile_expr(expr[3] if len(expr) > 3 else None, scope, code, tail)
+    if not tail:
+        code.patch(to_end, code.here())
+
+
+def compile_cond(expr, scope, code, tail=False):
+    to_end = []
+    for cond, result in expr[1:]:
+        compile_expr(cond, scope, code)
+        to_next = code.emit(JUMP_IF_FALSE)
+        compile_expr(result, scope, code, tail)
+        if not tail:
+            to_end.append(code.emit(JUMP))
+        code.patch(to_next, code.here())
+    # No conditions matched
+    compile_const(None, scope, code, tail)
+    for arg_index in to_end:
+        code.patch(arg_index, code.here())
+
+
+def compile_short_circuit(expr, scope, code, tail, test, empty):
+    if len(expr) == 1:
+        compile_const(empty, scope, code, tail)
+        return
+    to_end = []
+    for exp in expr[1:-1]:
+        compile_expr(exp, scope, code)
+        to_end.append(code.emit(test))
+    compile_expr(expr[-1], scope, code, tail)
+    for arg_index in to_end:
+        code.patch(arg_index, code.here())
+    if to_end:
+        compile_return(code, tail)
+
+
+def compile_and(expr, scope, code, tail=False):
+    # The last value is tested too, so it isn't in tail position: OR_TEST
+    # keeps it if it's true, and otherwise it's replaced by None
+    if len(expr) == 1:
+        compile_const(True, scope, code, tail)
+        return
+    to_end = []
+    for exp in expr[1:-1]:
+        compile_expr(exp, scope, code)
+        to_end.append(code.emit(AND_TEST))
+    compile_expr(expr[-1], scope, code)
+    to_end.append(code.emit(OR_TEST))
+    compile_const(None, scope, code)
+    for arg_index in to_end:
+        code.patch(arg_index, code.here())
+    compile_return(code, tail)
+
+
+def compile_or(expr, scope, code, tail=False):
+    compile_short_circuit(expr, scope, code, tail, OR_TEST, None)
+
+
+def compile_sequence(exprs, scope, code, tail=False):
+    if not exprs:
+        compile_const(None, scope, code, tail)
+        return
+    for exp in exprs[:-1]:
+        compile_expr(exp, scope, code)
+        code.emit(POP)
+    compile_expr(exprs[-1], scope, code, tail)
+
+
+def compile_progn(expr, scope, code, tail=False):
+    compile_sequence(expr[1:], scope, code, tail)
+
+
+def compile_let(expr, scope, code, tail=False):
+    names = [form[0].value for form in expr[1]]
+    for form in expr[1]:
+        compile_expr(form[1], scope, code)
+    code.emit(ENTER_LET, len(names))
+    compile_sequence(expr[2:], Scope(names, scope, False), code, tail)
+    if not tail:
+        code.emit(LEAVE_LET)
+
+
+def compile_map(expr, scope, code, tail=False):
+    for arg in expr[1:]:
+        compile_expr(arg, scope, code)
+    code.emit(MAP_CALL, len(expr) - 2)
+    compile_return(code, tail)
+
+
+def compile_seq(expr, scope, code, tail=False):
+    for arg in expr[1:]:
+        compile_expr(arg, scope, code)
+    code.emit(BUILD_SEQ, len(expr) - 1)
+    compile_return(code, tail)
+
+
+def compile_builtin_call(function, args, scope, code, tail):
+    # Call a Python function with the values of args
+    code.emit(CONST, code.const(function))
+    for arg in args:
+        compile_expr(arg, scope, code)
+    code.emit(CALL, len(args))
+    compile_return(code, tail)
+
+
+def compile_memoize(expr, scope, code, tail=False):
+    compile_builtin_call(memoize, memoize_args(expr), scope, code, tail)
+
+
+def compile_define_memoized(expr, scope, code, tail=False):
+    compile_define(define_memoized_form(expr), scope, code, tail)
+
+
+def compile_pmap(expr, scope, code, tail=False):
+    compile_builtin_call(pmap, pmap_args(expr), scope, code, tail)
+
+
+def compile_profile(expr, scope, code, tail=False):
+    # expr becomes the body of a procedure with no arguments, and a scope
+    # that isn't a procedure's, so defines in it still land outside it
+    from vm import profile_thunk
+
+    sub = Code('<profile>', body=expr[1])
+    compile_expr(expr[1], Scope([], scope, False), sub, True)
+    code.emit(CONST, code.const(profile_thunk))
+    code.emit(MAKE_CLOSURE, code.const(sub))
+    compile_expr(expr[2] if len(expr) > 2 else None, scope, code)
+    code.emit(CALL, 2)
+    compile_return(code, tail)
+
+
+def compile_defmacro(expr, scope, code, tail=False):
+    compile_define(define_macro_form(expr), scope, code, tail)
+
+
+def compile_quasiquote(expr, scope, code, tail=False):
+    compile_expr(expansion(macros.quasiquote, expr), scope, code, tail)
+
+
+def compile_call(expr, scope, code, tail=False):
+    for exp in expr:
+        compile_expr(exp, scope, code)
+    code.emit(TAIL_CALL if tail else CALL, len(expr) - 1)
+
+
+special_forms = {
+    QUOTE: compile_quote,
+    GETHASH: compile_gethash,
+    LAMBDA: compile_lambda,
+    DEFINE: compile_define,
+    SET: compile_set,
+    IF: compile_if,
+    COND: compile_cond,
+    AND: compile_and,
+    OR: compile_or,
+    PROGN: compile_progn,
+    LET: compile_let,
+    MAP: compile_map,
+    SEQ: compile_seq,
+    MEMOIZE: compile_memoize,
+    DEFINE_MEMOIZED: compile_define_memoized,
+    PMAP: compile_pmap,
+    PROFILE: compile_profile,
+    DEFMACRO: compile_defmacro,
+    QUASIQUOTE: compile_quasiquote,
+}
+
+
+def compile_expr(expr, scope, code, tail=False):
+    if isinstance(expr, Symbol):
+        compile_symbol(expr, scope, code, tail)
+    elif not isinstance(expr, list):
+        compile_const(expr, scope, code, tail)
+    elif form_head(expr) in special_forms:
+        special_forms[form_head(expr)](expr, scope, code, tail)
+    else:
+        genv = local.macro_env
+        macro = (find_macro(expr[0] if expr else None, scope, genv)
+                 if genv is not None else None)
+        if macro is not None:
+            compile_expr(expansion(macro, expr), scope, code, tail)
+        else:
+            compile_call(expr, scope, code, tail)
+
+
+class State(threading.local):
+    # Per thread: the global environment macros are looked up in, while
+    # compile_toplevel is compiling for one
+    macro_env = None
+
+
+local = State()
+
+
+def compile_toplevel(expr, genv=None):
+    saved, local.macro_env = local.macro_env, genv
+    try:
+        code = Code('<toplevel>')
+        compile_expr(expr, None, code, True)
+        return code
+    finally:
+        local.macro_env = saved
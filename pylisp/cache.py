@@ -0,0 +1,159 @@
+from __future__ import unicode_literals
+
+# On-disk cache of compiled source. A source text is parsed, and compiled as
+# far as its engine allows (bytecode for the vm, parsed forms for the others),
+# once; the result is pickled to a file named for a hash of the text, the
+# engine and the cache format, and later runs load that file instead. Loaded
+# results are also kept in memory, so resetting the global environment doesn't
+# touch the disk at all after the first time.
+#
+# The disk cache is off unless PYLISP_CACHE_DIR (or cache.cache_dir) says
+# where the files go. Loading a file unpickles it, which can run any code, so
+# only files in a directory belonging to this user, that no one else can
+# write to, are ever loaded.
+
+import cPickle as pickle
+import hashlib
+import io
+import mmap
+import os
+import stat
+import tempfile
+
+CACHE_VERSION = 3
+MAGIC = b'PYLISPC'
+
+cache_dir = os.environ.get('PYLISP_CACHE_DIR') or None
+
+# key -> list of compiled forms
+loaded = {}
+
+
+def cache_key(source, env_class):
+    # Symbols and Code objects pickle by module path, which differs depending
+    # on how the package was imported, so that goes into the key too, and so
+    # does the engine.
+    digest = hashlib.sha1()
+    for part in (MAGIC, str(CACHE_VERSION), __name__, env_class.__name__,
+                 env_class.cache_tag):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(source.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(cache_dir, key + '.plc')
+
+
+def header(key):
+    return MAGIC + str(CACHE_VERSION).encode('ascii') + b' ' + \
+        key.encode('ascii') + b'\n'
+
+
+def trusted(path):
+    # Whether path belongs to this user, and no one else can write to it
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def read_cache(key):
+    path = cache_path(key)
+    if not trusted(cache_dir) or not trusted(path):
+        return None
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    with f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            # Empty file, or nothing to map it from
+            data = io.BytesIO(f.read())
+        try:
+            if data.readline() != header(key):
+                return None
+            return pickle.load(data)
+        except Exception:                           # pylint: disable=W0703
+            # Truncated or otherwise unreadable: compile it again
+            return None
+        finally:
+            data.close()
+
+
+def write_cache(key, compiled):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        # Write to a temporary file and rename it into place, so a reader
+        # never sees half a file.
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header(key))
+            pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path(key))
+    except (IOError, OSError):
+        # The cache is only an optimization
+        pass
+
+
+def compile_source(source, env_class, env=None):
+    # The compiled forms of every top-level form in source, for env_class,
+    # to run in env if it's given
+    from environments import DEFMACRO
+    from macros import has_macros, mentions
+    from read import read_forms
+
+    expands = env_class.compile_expands_macros
+    if expands and env is not None and has_macros(env):
+        # The compiled code would depend on env's macros, which aren't known
+        # until the forms before it have run: compile each form just before
+        # it's run, and don't cache any of it (or use what's cached)
+        return (env_class.compile(form, env) for form in read_forms(source))
+    key = cache_key(source, env_class)
+    compiled = loaded.get(key)
+    if compiled is None and cache_dir:
+        compiled = read_cache(key)
+    if compiled is None:
+        forms = list(read_forms(source))
+        if expands and mentions(forms, DEFMACRO):
+            # Likewise for macros it defines itself
+            return (env_class.compile(form, env) for form in forms)
+        compiled = [env_class.compile(form) for form in forms]
+        if cache_dir:
+            write_cache(key, compiled)
+    loaded[key] = compiled
+    return compiled
+
+
+def eval_source(source, env):
+    ret = None
+    for compiled in compile_source(source, type(env), env):
+        ret = env.execute(compiled)
+    return ret
+
+
+def load_file(path, env):
+    with io.open(path, encoding='utf-8') as f:
+        return eval_source(f.read(), env)
+
+
+def precompile(paths, engines=('interp', 'analyze', 'vm')):
+    # Fill the disk cache for library files ahead of time
+    from environments import environment_class
+
+    for path in paths:
+        with io.open(path, encoding='utf-8') as f:
+            source = f.read()
+        for engine in engines:
+            compile_source(source, environment_class(engine))
+
+
+def clear():
+    loaded.clear()
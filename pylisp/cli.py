@@ -0,0 +1,166 @@
+from __future__ import unicode_literals
+
+# Command line entry point.
+#
+#   pylisp                          the REPL, if stdin is a terminal
+#   pylisp script.lisp ...          run files, in order, in one environment
+#   pylisp -e '(fib 20)'            evaluate expressions
+#   pylisp a.lisp -e '(f)' b.lisp   both, in the order given
+#   pylisp < script.lisp            run standard input (or name it as -)
+#
+# Outside the REPL nothing is interactive: forms are read and evaluated one
+# at a time as they stream in, readline and the history file are never
+# touched, and the value of each top-level form other than a define is
+# printed without colors, unless it's None or -q is given. The first error
+# stops the run with exit status 1.
+
+import argparse
+import codecs
+import io
+import sys
+import time
+
+from pylisp import Procedure
+
+DEFINES = ('define', 'define-memoized', 'defmacro')
+
+
+def to_string(value, top=True):
+    # Plain-text representation, the way it would be read back in
+    from environments import Symbol
+
+    if isinstance(value, Symbol):
+        return value.value
+    if isinstance(value, basestring):
+        if top:
+            return value
+        return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+    if isinstance(value, (list, tuple)):
+        return '({})'.format(' '.join(to_string(x, False) for x in value))
+    if isinstance(value, Procedure):
+        return '<procedure {}>'.format(value.name or 'lambda')
+    if value is True:
+        return 'True'
+    return '{}'.format(value)
+
+
+def run_forms(forms, env, out, quiet=False):
+    from environments import Symbol
+
+    for form in forms:
+        ret = env.eval(form)
+        if quiet or ret is None or ret is False:
+            continue
+        if (isinstance(form, list) and form and
+                isinstance(form[0], Symbol) and form[0].value in DEFINES):
+            continue
+        out.write(to_string(ret) + '\n')
+
+
+def sources(args):
+    # (name, forms) for each file and expression, in the order given
+    from read import read_forms
+
+    for kind, value in args.sources:
+        if kind == 'expr':
+            yield '-e', read_forms(value)
+        elif value == '-':
+            # Line by line, so forms run as soon as they arrive
+            stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+            yield '<stdin>', read_forms(iter(stdin.readline, b''))
+        else:
+            yield value, read_file(value)
+
+
+def read_file(path):
+    from read import read_forms
+
+    with io.open(path, 'rb') as f:
+        for form in read_forms(f):
+            yield form
+
+
+class AddSource(argparse.Action):
+    # Files and -e expressions go in one list, to keep their order
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        values = values if isinstance(values, list) else [values]
+        namespace.sources.extend(
+            ('expr' if option_string else 'file', value) for value in values)
+
+
+def pieces(argv):
+    # argv split before each option that follows a file (or an option's
+    # value; they look the same, and an extra split does no harm). argparse
+    # only takes the first run of files in what it's given, and handles all
+    # the options in it before any files left over, so the pieces are parsed
+    # one after another to keep files and expressions in order.
+    ret = [[]]
+    after_file = False
+    for i, arg in enumerate(argv):
+        if arg == '--':
+            ret[-1].extend(argv[i:])
+            break
+        is_option = arg.startswith('-') and arg != '-'
+        if is_option and after_file:
+            ret.append([])
+        ret[-1].append(arg)
+        after_file = not is_option
+    return ret
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pylisp', description='Run Lisp files and expressions.')
+    parser.add_argument('files', nargs='*', action=AddSource,
+                        metavar='FILE', help='source file, or - for stdin')
+    parser.add_argument('-e', '--eval', action=AddSource, metavar='EXPR',
+                        help='evaluate EXPR (repeatable)')
+    parser.add_argument('--engine', choices=['interp', 'analyze', 'vm'],
+                        help='evaluation engine')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="don't print results")
+    parser.add_argument('-t', '--time', action='store_true',
+                        help='print the total run time to stderr')
+    parser.set_defaults(sources=[])
+    args = None
+    for piece in pieces(sys.argv[1:] if argv is None else argv):
+        args = parser.parse_args(piece, args)
+
+    import environments
+
+    if args.engine:
+        environments.default_engine = args.engine
+        environments.reset_global_env()
+    if not args.sources:
+        if sys.stdin.isatty():
+            from repl import read_loop
+            read_loop()
+            return 0
+        args.sources.append(('file', '-'))
+
+    start = time.time()
+    status = 0
+    out = sys.stdout
+    if not getattr(out, 'encoding', None):
+        # A pipe or file
+        out = codecs.getwriter('utf-8')(out)
+    name = None
+    try:
+        for name, forms in sources(args):
+            run_forms(forms, environments.global_env, out, args.quiet)
+    except KeyboardInterrupt:
+        status = 130
+    except Exception as e:                          # pylint: disable=W0703
+        out.flush()
+        print >> sys.stderr, 'pylisp: {}: {}: {}'.format(
+            name, type(e).__name__, e)
+        status = 1
+    out.flush()
+    if args.time:
+        print >> sys.stderr, 'pylisp: {:.3f}s'.format(time.time() - start)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,18 @@
 from __future__ import unicode_literals
 
 import operator as op
-from pylisp import Procedure
-from read import parse
+import weakref
+import lazy
+import limits
+import macros
+from macros import Macro, define_macro_form, expansion
+import profiler
+import vectors
+from pylisp import Procedure, TailCall, name_procedure
 from utils import Colors
 
 global_env = None
+default_engine = 'interp'
 
 std_procedures = {
     'fact': '''(lambda (x)
@@ -19,24 +26,126 @@ std_procedures = {
 }
 
 
+# Only while something refers to them, so reading arbitrary input can't grow
+# it without bound
+symbol_table = weakref.WeakValueDictionary()
+
+
 class Symbol(object):
-    def __init__(self, v):
-        self.value = v
+    # Symbols are interned: there is only ever one Symbol per name, so they
+    # compare and hash by identity.
+    #
+    # `local` is set when anything other than a global environment is about
+    # to bind the name: a procedure taking it as a parameter, a let, or a
+    # define inside a procedure. The interpreter looks up symbols without it
+    # in the global environment directly, instead of climbing the enclosing
+    # ones. Whatever binds the name holds on to its Symbol, as does any code
+    # that refers to it, so the flag lasts as long as it matters, and goes
+    # with the Symbol.
+    __slots__ = ('value', 'local', '__weakref__')
+
+    def __new__(cls, v):
+        try:
+            return symbol_table[v]
+        except KeyError:
+            sym = symbol_table[v] = super(Symbol, cls).__new__(cls)
+            sym.value = v
+            sym.local = False
+            return sym
+
+    def __reduce__(self):
+        # Unpickling goes back through the symbol table
+        return Symbol, (self.value,)
 
     def __repr__(self):
         return Colors.blue(self.value)
 
-    def __eq__(self, v):
-        return self.value == v
+
+def bound_locally(name):
+    # Whether anything other than a global environment binds name
+    sym = symbol_table.get(name)
+    return sym is not None and sym.local
+
+
+QUOTE = Symbol('quote')
+GETHASH = Symbol('gethash')
+LAMBDA = Symbol('lambda')
+DEFINE = Symbol('define')
+SET = Symbol('set')
+IF = Symbol('if')
+COND = Symbol('cond')
+AND = Symbol('and')
+OR = Symbol('or')
+PROGN = Symbol('progn')
+LET = Symbol('let')
+MAP = Symbol('map')
+SEQ = Symbol('seq')
+MEMOIZE = Symbol('memoize')
+DEFINE_MEMOIZED = Symbol('define-memoized')
+PMAP = Symbol('pmap')
+PROFILE = Symbol('profile')
+DEFMACRO = Symbol('defmacro')
+QUASIQUOTE = Symbol('quasiquote')
+UNQUOTE = Symbol('unquote')
+UNQUOTE_SPLICING = Symbol('unquote-splicing')
 
 
 class Environment(dict):
+    # A fork's read-only Snapshot, which is also its parent. Names bound in
+    # the base count as bound here, but writes land in the fork.
+    base = None
+    # Whether this is the frame of a let, which defines in its body skip
+    # (they go in the procedure's environment, or the global one)
+    let_frame = False
+    # In a fork: name -> the value copied up from the base for it
+    copied = None
+    # In a global environment: bumped by every set of a name the optimizer
+    # folds (see optimize.rebound)
+    generation = 0
+
     def __init__(self, dikt=None, parent=None):
         super(Environment, self).__init__(dikt=None)
         dikt = dikt or {}
         self.parent = parent
+        # The global environment at the end of the parent chain
+        self.genv = self if parent is None else parent.genv
+        if parent is not None and dikt:
+            # Keep the names' Symbols, and so their flags, for as long as
+            # the bindings
+            self.symbols = [Symbol(name) for name in dikt]
+            for sym in self.symbols:
+                sym.local = True
         self.update(dikt)
 
+    def __missing__(self, s):
+        # env[s] falls back to the enclosing environments
+        if self.parent is None:
+            raise ValueError('Symbol "{}" not found'.format(s))
+        val = self.parent[s]
+        if self.parent is self.base:
+            # The base of a fork never changes, so copy its bindings up on
+            # first use and later reads are a plain dict lookup. (Snapshots
+            # layered on snapshots do this too, hence dict.__setitem__.)
+            # Remaking a procedure can read it, so it's there meanwhile.
+            dict.__setitem__(self, s, val)
+            val = self.copied[s] = self.adopt(val)
+            dict.__setitem__(self, s, val)
+        return val
+
+    def adopt(self, val):
+        # A binding read up from the base of a fork. A procedure made at the
+        # top level of an environment the base was taken from is made again
+        # at the top level of this one, so it sees this one's globals, as it
+        # would have if it had been defined here.
+        if isinstance(val, Procedure):
+            home = val.home()
+            if home is not None and any(home is env
+                                        for env in self.base.origins):
+                new = val.rebind(self)
+                new.name = val.name
+                return new
+        return val
+
     def lookup(self, s):
         if s in self:
             return self, self[s]
@@ -44,14 +153,37 @@ class Environment(dict):
             return self.parent.lookup(s)
         raise ValueError('Symbol "{}" not found'.format(s))
 
+    def defines(self, name):
+        env = self
+        while env is not None:
+            if name in env:
+                return True
+            env = env.base
+        return False
+
+    def snapshot(self):
+        return Snapshot(self, type(self))
+
+    def fork(self):
+        # Taking the snapshot copies this environment; fork the snapshot
+        # itself to share it between many forks.
+        return self.snapshot().fork()
+
     def eval_self(self, expr):
         if isinstance(expr, Symbol):
             return self.eval_symbol(expr)
         return expr
 
     def eval_symbol(self, expr):
-        _, val = self.lookup(expr.value)
-        return val
+        if expr.local:
+            return self[expr.value]
+        # Only bound globally, unless something bound it here by hand
+        try:
+            return self.genv[expr.value]
+        except ValueError:
+            if self.genv is self:
+                raise
+        return self[expr.value]
 
     def eval_quote(self, expr):
         return expr[1]
@@ -65,194 +197,357 @@ class Environment(dict):
         return table.get(key)
 
     def eval_lambda(self, expr):
-        arglist = expr[1]
-        body = expr[2]
-        return Procedure(arglist, body, self)
+        from optimize import interpreted_procedure
+        return interpreted_procedure(expr, self)
 
     def eval_define(self, expr):
         sym = expr[1]
-        if sym.value in self:
+        target = self
+        while target.let_frame:
+            target = target.parent
+        if target.defines(sym.value):
             raise ValueError('{} already defined in environment'.format(sym))
+        if target.genv is not target:
+            sym.local = True
         val = self.eval(expr[2])
-        self[sym.value] = val
+        target[sym.value] = val
+        name_procedure(val, sym.value)
         return val
 
     def eval_set(self, expr):
         # Apparently the Lisp way is to hack a bunch of special cases in here
         place = expr[1]
         val = self.eval(expr[2])
-        if isinstance(place, list) and place[0] in ['gethash']:
-            if place[0] == 'gethash':
-                key, table = place[1], self.eval(place[2])
-                if isinstance(key, Symbol):
-                    key = self.eval(key)
-                else:
-                    key = self.eval(key)
-                table[key] = val
+        if isinstance(place, list) and place[0] is GETHASH:
+            key, table = place[1], self.eval(place[2])
+            if isinstance(key, Symbol):
+                key = self.eval(key)
+            else:
+                key = self.eval(key)
+            table[key] = val
         else:
             # Must be a Symbol
             sym = self.eval(expr[1])
             if not isinstance(sym, Symbol):
                 raise TypeError('{} is not a Symbol'.format(sym))
-            if sym.value not in self:
-                raise ValueError('{} not found in environment'.format(sym))
-            self[sym.value] = val
+            # Rebind it where it's bound, which can be a frame a closure
+            # captured
+            target = self
+            while not target.defines(sym.value):
+                target = target.parent
+                if target is None:
+                    raise ValueError('{} not found in environment'.format(sym))
+            target[sym.value] = val
+            if target is self.genv:
+                from optimize import rebound
+                rebound(target, sym.value)
         return val
 
-    def eval_if(self, expr):
+    # The forms below have a tail position. Rather than evaluating it
+    # themselves, they return the (environment, expression) pair for eval to
+    # continue with, so tail calls run in constant Python stack space. An
+    # environment of None means the expression is already the final value.
+
+    def tail_if(self, expr):
         try:
             _, cond, true_expr, false_expr = expr
         except ValueError:
             _, cond, true_expr = expr
-            false_expr = 'None'
-        return (self.eval(true_expr) if self.eval(cond)
-                else self.eval(false_expr))
+            false_expr = None
+        return self, (true_expr if self.eval(cond) else false_expr)
 
-    def eval_cond(self, expr):
+    def tail_cond(self, expr):
         # TOOD: probably not compliant
         i = 1
         while i < len(expr):
             cond, result = expr[i]
             if self.eval(cond):
-                return self.eval(result)
+                return self, result
             i += 1
         # No conditions matched
-        return None
-
-    def eval_and(self, expr):
-        result = True
-        for exp in expr[1:]:
-            result = self.eval(exp)
-            if result in [None, False]:
-                return None
-        return result
-
-    def eval_or(self, expr):
-        result = None
-        for exp in expr[1:]:
+        return None, None
+
+    def tail_and(self, expr):
+        # eval tests the last value once it has it
+        if len(expr) == 1:
+            return None, True
+        for exp in expr[1:-1]:
+            if self.eval(exp) in [None, False]:
+                return None, None
+        return self, expr[-1]
+
+    def tail_or(self, expr):
+        if len(expr) == 1:
+            return None, None
+        for exp in expr[1:-1]:
             result = self.eval(exp)
             if result not in [None, False]:
-                return result
-        return result
-
-    def eval_progn(self, expr):
-        body_forms = expr[1:] if len(expr) > 1 else []
-        ret = None
-        for body in body_forms:
-            ret = self.eval(body)
-        return ret
-
-    def eval_let(self, expr):
-        let_forms = expr[1]
-        body_forms = expr[2:] if len(expr) > 2 else []
+                return None, result
+        return self, expr[-1]
+
+    def tail_progn(self, expr):
+        if len(expr) == 1:
+            return None, None
+        for body in expr[1:-1]:
+            self.eval(body)
+        return self, expr[-1]
+
+    def tail_let(self, expr):
+        # Procedures made in the body close over the new frame, whatever
+        # they're defined as; nothing needs moving out of it afterwards
         new_env = Environment(parent=self)
-        for form in let_forms:
+        new_env.let_frame = True
+        if profiler.active:
+            profiler.frame()
+        for form in expr[1]:
+            form[0].local = True
             new_env[form[0].value] = self.eval(form[1])
-
-        ret = None
-        for body in body_forms:
-            ret = new_env.eval(body)
-            if isinstance(ret, Procedure):
-                # Pull the procedure out of the env belonging to `let` and
-                # place it in this one, so we can still access it once the let
-                # form is exited.
-                # TODO: this seems really dirty -- would love to know the right
-                # way to do it.
-                # TODO: SICP 5.2.5 has the right way to do this -- use that.
-                procedure_to_name = {v: k for k, v in ret.parent_env.iteritems()
-                                     if isinstance(v, Procedure)}
-                if ret in procedure_to_name:
-                    name = procedure_to_name[ret]
-                    ret.parent_env.pop(name)
-                    self[name] = ret
-        return ret
+        if len(expr) == 2:
+            return None, None
+        for body in expr[2:-1]:
+            new_env.eval(body)
+        return new_env, expr[-1]
 
     def eval_map(self, expr):
         # TODO: probably non-conforming, can we implement this in lisp?
         proc = self.eval(expr[1])
         args_list = [self.eval(arg) for arg in expr[2:]]
-        ret = [proc(*args) for args in zip(*args_list)]
-        return ret
+        return lazy.map_values(proc, args_list)
 
     def eval_seq(self, expr):
         args = [self.eval(arg) for arg in expr[1:]]
         ret = range(*args)
         return ret
 
-    def eval_proc(self, expr):
-        proc = self.eval(expr[0])
-        args = [self.eval(arg) for arg in expr[1:]]
-        ret = proc(*args)
-        if ret is False:
-            # Lisp!
+    def eval_memoize(self, expr):
+        from memo import memoize, memoize_args
+        return memoize(*[self.eval(arg) for arg in memoize_args(expr)])
+
+    def eval_define_memoized(self, expr):
+        from memo import define_memoized_form
+        return self.eval(define_memoized_form(expr))
+
+    def eval_pmap(self, expr):
+        from parallel import pmap, pmap_args
+        return pmap(*[self.eval(arg) for arg in pmap_args(expr)])
+
+    def eval_profile(self, expr):
+        path = self.eval(expr[2]) if len(expr) > 2 else None
+        return profiler.profile_form(lambda: self.eval(expr[1]), path)
+
+    def eval_defmacro(self, expr):
+        return self.eval(define_macro_form(expr))
+
+    def tail_quasiquote(self, expr):
+        return self, expansion(macros.quasiquote, expr)
+
+    # Plain functions rather than unbound methods, so dispatching through
+    # these tables doesn't cost an extra level of recursion.
+    special_forms = {
+        QUOTE: eval_quote,
+        GETHASH: eval_gethash,
+        LAMBDA: eval_lambda,
+        DEFINE: eval_define,
+        SET: eval_set,
+        MAP: eval_map,
+        SEQ: eval_seq,
+        MEMOIZE: eval_memoize,
+        DEFINE_MEMOIZED: eval_define_memoized,
+        PMAP: eval_pmap,
+        PROFILE: eval_profile,
+        DEFMACRO: eval_defmacro,
+    }
+
+    tail_forms = {
+        IF: tail_if,
+        COND: tail_cond,
+        AND: tail_and,
+        OR: tail_or,
+        PROGN: tail_progn,
+        LET: tail_let,
+        QUASIQUOTE: tail_quasiquote,
+    }
+
+    # How far cache.py can compile a form ahead of time for this engine:
+    # the interpreter just takes the parsed form.
+    cache_tag = 'forms'
+    # Whether compile() expands macros, so its results depend on the macros
+    # defined at the time
+    compile_expands_macros = False
+
+    @staticmethod
+    def compile(expr, genv=None):
+        return expr
+
+    def execute(self, compiled):
+        return self.eval(compiled)
+
+    def eval(self, expr, tail_calls=False):
+        # tail_calls: return a procedure call in tail position as a TailCall,
+        # rather than making it (only while profiling)
+        env = self
+        # Whether the value is the last of an and, which is tested too
+        tested = False
+        while True:
+            if not isinstance(expr, list):
+                ret = env.eval_self(expr)
+                break
+            head = expr[0]
+            if isinstance(head, Symbol):
+                if head in env.tail_forms:
+                    next_env, expr = env.tail_forms[head](env, expr)
+                    if next_env is None:
+                        ret = expr
+                        break
+                    if head is AND:
+                        tested = True
+                    env = next_env
+                    continue
+                if head in env.special_forms:
+                    ret = env.special_forms[head](env, expr)
+                    break
+                proc = env.eval_symbol(head)
+            else:
+                proc = env.eval(head)
+            if type(proc) is Macro:
+                # Evaluate the expansion in place of the call
+                expr = expansion(proc, expr)
+                continue
+            args = [env.eval(arg) for arg in expr[1:]]
+            if type(proc) is Procedure:
+                if profiler.active and profiler.running():
+                    if tail_calls and not tested:
+                        return TailCall(proc, args)
+                    ret = proc(*args)
+                    break
+                limits.local.fuel -= 1
+                if not limits.local.fuel:
+                    limits.refuel()
+                # Tail call: reuse this loop instead of recursing
+                env, expr = proc.bind(args), proc.body
+                continue
+            ret = (profiler.apply(proc, args) if profiler.active
+                   else proc(*args))
+            if ret is False:
+                # Lisp!
+                ret = None
+            break
+        if tested and ret in [None, False]:
             ret = None
         return ret
 
-    def eval(self, expr):
-        if not isinstance(expr, list):
-            return self.eval_self(expr)
-        elif not isinstance(expr, list):
-            return expr
-        elif expr[0] == 'quote':
-            return self.eval_quote(expr)
-        elif expr[0] == 'gethash':
-            return self.eval_gethash(expr)
-        elif expr[0] == 'lambda':
-            return self.eval_lambda(expr)
-        elif expr[0] == 'define':
-            return self.eval_define(expr)
-        elif expr[0] == 'set':
-            return self.eval_set(expr)
-        elif expr[0] == 'if':
-            return self.eval_if(expr)
-        elif expr[0] == 'cond':
-            return self.eval_cond(expr)
-        elif expr[0] == 'and':
-            return self.eval_and(expr)
-        elif expr[0] == 'or':
-            return self.eval_or(expr)
-        elif expr[0] == 'progn':
-            return self.eval_progn(expr)
-        elif expr[0] == 'let':
-            return self.eval_let(expr)
-        elif expr[0] == 'map':
-            return self.eval_map(expr)
-        elif expr[0] == 'seq':
-            return self.eval_seq(expr)
-        else:
-            return self.eval_proc(expr)
-
-
-def std_environment():
-    env = Environment()
-    env.update({
-        '+': lambda *x: sum(x),
-        '-': op.sub,
-        '*': op.mul,
-        '/': op.div,
-        '>': op.gt,
-        '<': op.lt,
-        '>=': op.ge,
-        '<=': op.le,
-        '=': op.eq,
-        '^': op.pow,
-        '%': op.mod,
-        'list': lambda *args: list(args),
-        'make-hash-table': lambda: dict(),              # pylint: disable=W0108
-        'True': True,
-        'None': None,
-        'type': type,
-    })
+
+limits.nesting_codes.add(Environment.eval.__func__.__code__)
+
+
+class Snapshot(Environment):
+    # A read-only copy of an environment's own bindings. Forks of it see its
+    # bindings until they rebind them, so a fork costs O(1) however big the
+    # snapshot is. Procedures defined at the top level of the environment
+    # (or of the ones it was forked from) are made again in a fork the first
+    # time it reads them, so they look up globals in the fork.
+
+    def __init__(self, env, engine_class):
+        dict.__init__(self, env)
+        # Snapshotting a fork copies only what the fork wrote
+        self.parent = self.base = env.base
+        self.genv = self
+        self.copied = {}
+        self.engine_class = engine_class
+        # The environments its procedures can have been defined in
+        self.origins = (env.genv,) + (env.base.origins if env.base is not None
+                                      else ())
+
+    def read_only(self, *args, **kwargs):
+        raise TypeError('Snapshots are read-only')
+
+    __setitem__ = __delitem__ = update = setdefault = read_only
+    pop = popitem = clear = read_only
+
+    def snapshot(self):
+        return self
+
+    def adopt(self, val):
+        # Layered on another snapshot: only forks remake procedures
+        return val
+
+    def fork(self):
+        env = self.engine_class(parent=self)
+        env.base = self
+        env.genv = env
+        env.copied = {}
+        return env
+
+
+def environment_class(engine):
+    if engine == 'interp':
+        return Environment
+    elif engine == 'analyze':
+        from analyze import AnalyzedEnvironment
+        return AnalyzedEnvironment
+    elif engine == 'vm':
+        from vm import VMEnvironment
+        return VMEnvironment
+    raise ValueError('Unknown engine "{}"'.format(engine))
+
+
+primitives = {
+    '+': lambda *x: sum(x),
+    '-': op.sub,
+    '*': op.mul,
+    '/': op.div,
+    '>': op.gt,
+    '<': op.lt,
+    '>=': op.ge,
+    '<=': op.le,
+    '=': op.eq,
+    '^': op.pow,
+    '%': op.mod,
+    'list': lambda *args: list(args),
+    'make-hash-table': lambda: dict(),                  # pylint: disable=W0108
+    'True': True,
+    'None': None,
+    'type': type,
+    'memo-stats': lambda proc: proc.stats(),
+    'memo-clear': lambda proc: proc.clear(),
+}
+primitives.update(lazy.primitives)
+primitives.update(macros.primitives)
+primitives.update(vectors.primitives)
+
+
+def std_source():
+    return '\n'.join('(define {} {})'.format(name, code)
+                     for name, code in sorted(std_procedures.iteritems()))
+
+
+def std_environment(engine=None):
+    from cache import eval_source
+    from transpile import native
+
+    env = environment_class(engine or default_engine)()
+    env.update(primitives)
+    env['native'] = native
     # env.update(vars(math))
 
-    for proc_name, proc_code in std_procedures.iteritems():
-        env[proc_name] = env.eval(parse(proc_code))
+    eval_source(std_source(), env)
     return env
 
 
-def reset_global_env():
+# engine -> Snapshot of its standard environment
+std_snapshots = {}
+
+
+def std_snapshot(engine=None):
+    engine = engine or default_engine
+    if engine not in std_snapshots:
+        std_snapshots[engine] = std_environment(engine).snapshot()
+    return std_snapshots[engine]
+
+
+def reset_global_env(engine=None):
     global global_env                         # pylint: disable=W0603
-    global_env = std_environment()
+    global_env = std_snapshot(engine).fork()
 
 
 reset_global_env()
@@ -0,0 +1,87 @@
+from __future__ import unicode_literals
+
+# Lazy sequences: a Lazy holds a recipe for an iterator rather than the
+# values, so a pipeline like
+#
+#   (force (take 5 (filter odd? (map sq (lazy-seq 0 100000000)))))
+#
+# only ever computes five-odd elements, in constant memory. Each time a Lazy
+# is iterated it starts again from the beginning, like a list would.
+#
+# map over a Lazy is lazy; over lists it still builds a list, and over vectors
+# a vector.
+
+from itertools import count, ifilter, imap, islice
+
+from vectors import Vector, map_vectors
+
+
+class Lazy(object):
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __iter__(self):
+        return iter(self.function(*self.args))
+
+    def __repr__(self):
+        return '<lazy sequence at {:#x}>'.format(id(self))
+
+
+def map_values(proc, args_list):
+    vectors = 0
+    for arg in args_list:
+        if isinstance(arg, Lazy):
+            return Lazy(imap, proc, *args_list)
+        vectors += isinstance(arg, Vector)
+    if vectors and vectors == len(args_list):
+        return map_vectors(proc, args_list)
+    return [proc(*args) for args in zip(*args_list)]
+
+
+def reduce_values(proc, seq, *initial):
+    if isinstance(seq, Vector):
+        return seq.reduce(proc, *initial)
+    return reduce(proc, seq, *initial)
+
+
+def lazy_seq(*args):
+    return Lazy(xrange, *args)
+
+
+def count_from(start=0, step=1):
+    return Lazy(count, start, step)
+
+
+def lazy_map(proc, *args_list):
+    return Lazy(imap, proc, *args_list)
+
+
+def take(n, seq):
+    return Lazy(islice, seq, n)
+
+
+def drop(n, seq):
+    return Lazy(islice, seq, n, None)
+
+
+def lazy_filter(pred, seq):
+    return Lazy(ifilter, pred, seq)
+
+
+def force(seq):
+    return list(seq)
+
+
+primitives = {
+    'lazy-seq': lazy_seq,
+    'count-from': count_from,
+    'lazy-map': lazy_map,
+    'take': take,
+    'drop': drop,
+    'filter': lazy_filter,
+    'reduce': reduce_values,
+    'force': force,
+}
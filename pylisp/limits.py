@@ -0,0 +1,206 @@
+from __future__ import unicode_literals
+
+# Limits on an evaluation: how many procedure calls it can make, how long it
+# can run, and how deeply its calls can nest. Going past any of them raises
+# LimitExceeded, with what the evaluation had used.
+#
+#   with Budget(steps=10 ** 6, seconds=2.0, depth=500):
+#       env.eval(expr)
+#
+#   global_parse_and_eval('(fib 30)', seconds=2.0)
+#
+# The engines count procedure calls down in `local.fuel`, and only call
+# refuel() when it runs out, at most every CHECK_INTERVAL calls. That's the
+# only place the clock and the depth are looked at, so a budget costs next to
+# nothing per call, and no budget costs nothing more than the count. The
+# step limit is exact. With a depth limit, the checks come at least every
+# quarter of it, so calls can nest a quarter deeper than the limit before
+# it's noticed; keep it well inside what Python's recursion limit allows
+# (a few hundred calls, except on the vm).
+#
+# Depth is the number of procedure calls waiting on others to return (in
+# the interpreter, of evaluations waiting on others), counting from where
+# the budget was entered.
+#
+# A budget applies to the thread it's entered on, so evaluations on other
+# threads go on with their own budgets, or none. A task (see tasks.py) can
+# be given one of its own, which applies whenever it's running.
+
+import sys
+import threading
+import time
+
+CHECK_INTERVAL = 100
+
+
+class State(threading.local):
+    # Per thread: the Budget being enforced, and the calls left before it's
+    # next looked at
+    budget = None
+    fuel = CHECK_INTERVAL
+
+
+local = State()
+
+# Code objects whose frames are procedure calls (or, for the interpreter,
+# evaluations) in progress, registered by the engines
+nesting_codes = set()
+
+
+class LimitExceeded(Exception):
+
+    def __init__(self, limit, usage):
+        # limit is 'steps', 'seconds' or 'depth'
+        super(LimitExceeded, self).__init__(
+            'Evaluation went past its {} limit of {} ({} steps, {:.3f}s, '
+            'depth {})'.format({'steps': 'step', 'seconds': 'time',
+                                'depth': 'depth'}[limit],
+                               usage['limits'][limit], usage['steps'],
+                               usage['seconds'], usage['depth']))
+        self.limit = limit
+        self.usage = usage
+
+
+class Budget(object):
+
+    def __init__(self, steps=None, seconds=None, depth=None):
+        self.steps = steps
+        self.seconds = seconds
+        self.depth = depth
+        self.deadline = None
+        self.spent = 0          # steps up to the last refill
+        self.refill = 0         # fuel given at the last refill
+        self.deepest = 0
+        self.start = self.finish = None
+        self.outer = None
+        self.interval = CHECK_INTERVAL
+        # While it's being enforced: nesting() where it started, and steps
+        # spent before that
+        self.base = 0
+        self.resumed = 0
+
+    def __enter__(self):
+        # Nested: what's left of the outer budget limits this one too, and
+        # it pays for the steps taken here
+        self.begin(local.budget)
+        self.resume()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pause()
+        self.finish = time.time()
+
+    def begin(self, outer=None):
+        # Start the clock, within what's left of outer, if it's given
+        self.start = time.time()
+        if self.seconds is not None:
+            self.deadline = self.start + self.seconds
+        if outer is not None:
+            outer.charge()
+            if outer.steps is not None:
+                left = outer.steps - outer.spent
+                self.steps = left if self.steps is None else min(
+                    self.steps, left)
+            if outer.deadline is not None:
+                self.deadline = outer.deadline if self.deadline is None else (
+                    min(self.deadline, outer.deadline))
+            if outer.depth is not None:
+                room = outer.depth - (nesting() - outer.base)
+                self.depth = room if self.depth is None else min(
+                    self.depth, room)
+        if self.depth is not None:
+            self.interval = max(1, min(CHECK_INTERVAL, self.depth // 4))
+
+    def resume(self):
+        # Enforce it on this thread until pause(), over whatever budget was
+        if local.budget is not None:
+            local.budget.charge()
+        self.outer = local.budget
+        self.base = nesting()
+        self.resumed = self.spent
+        local.budget = self
+        self.fill()
+
+    def pause(self):
+        self.charge()
+        outer = local.budget = self.outer
+        if outer is not None:
+            outer.spent += self.spent - self.resumed
+            outer.deepest = max(outer.deepest,
+                                self.deepest + self.base - outer.base)
+            outer.fill()
+        else:
+            local.fuel = CHECK_INTERVAL
+
+    def charge(self):
+        # Count the fuel burned since the last refill
+        self.spent += self.refill - local.fuel
+        self.refill = local.fuel
+
+    def fill(self):
+        fuel = self.interval
+        if self.steps is not None:
+            fuel = min(fuel, self.steps - self.spent)
+        if fuel <= 0:
+            # Out of steps: give it one to spend, so the next call raises
+            fuel = 1
+        local.fuel = self.refill = fuel
+
+    def check(self, depth):
+        if self.steps is not None and self.spent > self.steps:
+            raise LimitExceeded('steps', self.usage())
+        self.deepest = max(self.deepest, depth)
+        if self.depth is not None and depth > self.depth:
+            raise LimitExceeded('depth', self.usage())
+        if self.deadline is not None and time.time() > self.deadline:
+            raise LimitExceeded('seconds', self.usage())
+
+    def usage(self):
+        # What it's used so far, or used in all once it's over
+        steps, end = self.spent, self.finish or time.time()
+        if local.budget is self:
+            steps += self.refill - local.fuel
+        return {
+            'steps': steps,
+            'seconds': end - self.start,
+            'depth': self.deepest,
+            'limits': {'steps': self.steps, 'seconds': self.seconds,
+                       'depth': self.depth},
+        }
+
+
+def nesting():
+    # Procedure calls in progress on this thread's Python stack
+    depth = 0
+    frame = sys._getframe(1)                # pylint: disable=W0212
+    while frame is not None:
+        if frame.f_code in nesting_codes:
+            depth += 1
+        frame = frame.f_back
+    return depth
+
+
+def refuel(calls=0):
+    # The engines call this when fuel runs out, with however many calls
+    # they're keeping off the Python stack
+    budget = local.budget
+    if budget is None:
+        local.fuel = CHECK_INTERVAL
+        return
+    budget.charge()
+    budget.check(calls + nesting() - budget.base)
+    budget.fill()
+
+
+def spend(steps=1, calls=0):
+    # For steps counted somewhere other than fuel itself: procedure calls
+    # made from outside an engine's loop, or the vm's own count
+    local.fuel -= steps
+    if local.fuel <= 0:
+        refuel(calls)
+
+
+def limited(function, steps=None, seconds=None, depth=None):
+    # function(), within a Budget
+    with Budget(steps, seconds, depth):
+        return function()
@@ -0,0 +1,203 @@
+from __future__ import unicode_literals
+
+# Macros. (defmacro name (params) body ...) defines name as a Macro: a
+# procedure from unevaluated forms to the form to evaluate in their place.
+# The last parameter can follow &rest, to take any remaining forms as a list.
+#
+# Templates are easiest to write with quasiquote: `(a ,b ,@c) reads as
+# (quasiquote (a (unquote b) (unquote-splicing c))), which is rewritten into
+# ordinary list-building code.
+#
+# Each call site is expanded only once. analyze and vm expand macros while
+# they analyze or compile the code around them, so a macro has to be defined
+# (in the global environment) before any code using it is evaluated;
+# the interpreter expands a call site the first time it's evaluated, and
+# keeps the expansion on the form (see pylisp.Form) after that.
+
+from itertools import count
+
+from pylisp import Form
+
+gensym_counter = count(1)
+
+
+class Macro(object):
+
+    def __init__(self, name, transformer, rest=False):
+        self.name = name
+        self.transformer = transformer
+        # Whether the transformer's last parameter collects the extra forms
+        self.rest = rest
+
+    def expand(self, form):
+        args = list(form[1:])
+        if self.rest:
+            nfixed = len(self.transformer.arglist) - 1
+            if len(args) < nfixed:
+                raise SyntaxError('{} needs at least {} arguments'.format(
+                    self.name, nfixed))
+            args = args[:nfixed] + [args[nfixed:]]
+        ret = self.transformer(*args)
+        # Lisp!
+        return None if ret is False else ret
+
+    def __call__(self, *args):
+        raise TypeError(
+            'Macro {} was called as a procedure (was it defined after code '
+            'using it was compiled?)'.format(self.name))
+
+    def __repr__(self):
+        return '<macro {}>'.format(self.name)
+
+
+def make_macro(name, transformer, rest):
+    return Macro(name, transformer, rest)
+
+
+def define_macro_form(expr):
+    # (defmacro name (a &rest b) body ...) ->
+    # (define name (make_macro "name" (lambda (a b) (progn body ...)) True))
+    from environments import DEFINE, LAMBDA, PROGN, Symbol
+
+    try:
+        name, params = expr[1], list(expr[2])
+    except IndexError:
+        raise SyntaxError('defmacro needs a name and a parameter list')
+    rest = Symbol('&rest') in params
+    if rest:
+        if params.index(Symbol('&rest')) != len(params) - 2:
+            raise SyntaxError('&rest must come before the last parameter')
+        params.remove(Symbol('&rest'))
+    body = expr[3] if len(expr) == 4 else [PROGN] + expr[3:]
+    return [DEFINE, name, [make_macro, name.value, [LAMBDA, params, body],
+                           rest]]
+
+
+def make_list(*args):
+    return list(args)
+
+
+def append(*lists):
+    ret = []
+    for lst in lists:
+        ret.extend(lst)
+    return ret
+
+
+def quasiquote_form(template, depth=1):
+    # The form that builds template, with its unquotes evaluated
+    from environments import QUOTE, QUASIQUOTE, UNQUOTE, UNQUOTE_SPLICING
+
+    if not isinstance(template, list) or not template:
+        return [QUOTE, template]
+    head = template[0]
+    if head is UNQUOTE:
+        if depth == 1:
+            return template[1]
+        return [make_list, [QUOTE, UNQUOTE],
+                quasiquote_form(template[1], depth - 1)]
+    if head is QUASIQUOTE:
+        return [make_list, [QUOTE, QUASIQUOTE],
+                quasiquote_form(template[1], depth + 1)]
+    # Runs of plain elements become (make_list ...) calls, spliced lists go
+    # in as they are, and all of them are appended together
+    segments = []
+    run = None
+    for element in template:
+        if (isinstance(element, list) and element and
+                element[0] is UNQUOTE_SPLICING and depth == 1):
+            segments.append(element[1])
+            run = None
+        else:
+            if run is None:
+                run = [make_list]
+                segments.append(run)
+            run.append(quasiquote_form(element, depth))
+    if all(isinstance(seg, list) and seg[0] is make_list and
+           all(isinstance(x, list) and x and x[0] is QUOTE for x in seg[1:])
+           for seg in segments):
+        # Nothing unquoted
+        return [QUOTE, template]
+    if len(segments) == 1 and segments[0][0] is make_list:
+        return segments[0]
+    return [append] + segments
+
+
+quasiquote = Macro('quasiquote', quasiquote_form)
+
+
+def expansion(macro, form):
+    # Only forms read from source (or expanded from them) keep theirs
+    cached = getattr(form, 'expansion', None)
+    if cached is not None and cached[0] is macro:
+        return cached[1]
+    expanded = macro.expand(form)
+    if type(form) is Form:
+        expanded = as_form(expanded)
+        form.expansion = macro, expanded
+    return expanded
+
+
+def as_form(expr):
+    # expr with the lists built for it made Forms, so the macro calls and
+    # lambdas in an expansion keep what's worked out about them too. Quoted
+    # data is left alone.
+    from environments import QUOTE
+
+    if type(expr) is not list:
+        return expr
+    if expr and expr[0] is QUOTE:
+        return Form(expr)
+    return Form(as_form(x) for x in expr)
+
+
+def find_macro(head, scope, genv):
+    # The Macro a form with this head calls, if it's a global bound to one
+    from environments import Symbol
+
+    if not isinstance(head, Symbol):
+        return None
+    name = head.value
+    if scope is not None and scope.resolve(name) is not None:
+        return None
+    env = genv
+    while env is not None:
+        if name in env:
+            value = dict.__getitem__(env, name)
+            return value if type(value) is Macro else None
+        env = env.parent
+    return None
+
+
+def macro_expander(scope, genv):
+    # For internal_defines: the expansion of a form, if it's a macro call
+    def expand(form):
+        macro = find_macro(form[0], scope, genv)
+        return expansion(macro, form) if macro is not None else None
+    return expand
+
+
+def has_macros(env):
+    while env is not None:
+        if any(type(value) is Macro for value in env.itervalues()):
+            return True
+        env = env.parent
+    return False
+
+
+def mentions(form, sym):
+    if form is sym:
+        return True
+    return isinstance(form, list) and any(mentions(x, sym) for x in form)
+
+
+def gensym(prefix='g'):
+    # A fresh symbol, for names a macro's expansion binds
+    from environments import Symbol
+
+    return Symbol('#:{}{}'.format(prefix, next(gensym_counter)))
+
+
+primitives = {
+    'gensym': gensym,
+}
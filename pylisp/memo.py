@@ -0,0 +1,104 @@
+from __future__ import unicode_literals
+
+# (memoize proc :max-size N :ttl seconds) wraps proc in a cache keyed by its
+# argument tuple, evicting the least recently used entry once it holds N of
+# them (:max-size None for no limit) and treating entries older than :ttl
+# seconds (if given) as missing. (define-memoized name proc ...) is
+# (define name (memoize proc ...)).
+#
+# (memo-stats proc) gives the hit/miss/eviction counters as a hash table, and
+# (memo-clear proc) empties the cache.
+
+from collections import OrderedDict
+import time
+
+DEFAULT_MAX_SIZE = 128
+
+# Keyword -> position in memoize's argument list
+options = {
+    ':max-size': 1,
+    ':ttl': 2,
+}
+
+clock = time.time
+
+
+class Memoized(object):
+
+    def __init__(self, proc, max_size=DEFAULT_MAX_SIZE, ttl=None):
+        if not callable(proc):
+            raise TypeError('{} is not a procedure'.format(proc))
+        self.proc = proc
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache = OrderedDict()      # args -> (value, expiry time)
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, *args):
+        cache = self.cache
+        try:
+            value, expires = cache.pop(args)
+        except KeyError:
+            pass
+        except TypeError:
+            raise TypeError(
+                'Memoized procedure called with unhashable arguments: '
+                '{}'.format(', '.join(repr(arg) for arg in args)))
+        else:
+            if expires is None or clock() < expires:
+                # Back in as the most recently used
+                cache[args] = value, expires
+                self.hits += 1
+                return value
+            self.evictions += 1
+
+        self.misses += 1
+        value = self.proc(*args)
+        cache[args] = value, (None if self.ttl is None else
+                              clock() + self.ttl)
+        if self.max_size is not None:
+            while len(cache) > self.max_size:
+                cache.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.cache),
+            'max-size': self.max_size,
+            'ttl': self.ttl,
+        }
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+def memoize(proc, max_size=DEFAULT_MAX_SIZE, ttl=None):
+    return Memoized(proc, max_size, ttl)
+
+
+def memoize_args(expr):
+    # The argument forms for memoize(), in order, from a (memoize proc
+    # :keyword value ...) form, with defaults filled in
+    from environments import Symbol
+
+    args = [expr[1], DEFAULT_MAX_SIZE, None]
+    rest = expr[2:]
+    if len(rest) % 2:
+        raise SyntaxError('memoize options must come in :keyword value pairs')
+    for keyword, value in zip(rest[::2], rest[1::2]):
+        if not isinstance(keyword, Symbol) or keyword.value not in options:
+            raise SyntaxError('Unknown memoize option {}'.format(keyword))
+        args[options[keyword.value]] = value
+    return args
+
+
+def define_memoized_form(expr):
+    # (define-memoized name proc ...) -> (define name (memoize proc ...))
+    from environments import DEFINE, MEMOIZE
+
+    return [DEFINE, expr[1], [MEMOIZE] + expr[2:]]
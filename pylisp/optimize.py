@@ -0,0 +1,328 @@
+from __future__ import unicode_literals
+
+# A pass over a procedure's body, run when the procedure is built (when the
+# interpreter evaluates its lambda, or analyze or vm compile it):
+#
+#   (* 60 (* 60 24))         -> 86400   calls of pure primitives on constants
+#   (if True a b)            -> a       branches that can never be taken
+#   (cond (None a) (True b)) -> b
+#   (progn a (progn b c))    -> (progn a b c)
+#   (quote 5)                -> 5
+#
+# A call is only folded while its head means the standard primitive: it
+# isn't bound by the procedure or anything around it, and the global
+# environment still has the primitive under that name. (set '+ ...) stops
+# the name being folded in procedures built in that environment after it,
+# and procedures of that environment already built with something folded on
+# the strength of it are optimized again, from the lambda they were made from
+# (see watch). Other global environments aren't affected.
+#
+# Where the global environment isn't known yet (the vm compiling code for the
+# cache), the primitives are taken to be standard; the vm checks the names
+# that relies on against the environment the procedure is made in, and
+# compiles it again for that environment if they aren't.
+#
+# Macro calls, quoted forms and nested lambdas are left as they are; a
+# nested lambda's body is optimized when it's built in turn.
+
+import numbers
+import weakref
+
+from environments import (
+    AND, COND, DEFINE, GETHASH, IF, LET, MAP, OR, PMAP, PROGN, QUOTE, SEQ, SET,
+    Environment, Symbol, bound_locally, primitives)
+from macros import Macro
+from pylisp import Form, Procedure
+
+# Primitives that always give the same result for the same arguments, and
+# have no effects
+FOLDABLE = frozenset(['+', '-', '*', '/', '>', '<', '>=', '<=', '=', '^', '%'])
+CONSTANTS = frozenset(['True', 'None'])
+
+SPECIAL_FORMS = frozenset(Environment.special_forms) | frozenset(
+    Environment.tail_forms)
+
+# Total nodes removed from procedure bodies
+stats = {'procedures': 0, 'removed': 0}
+
+# Procedure -> (names its body relies on meaning the standard primitives,
+# function to optimize it again with), for procedures with something folded
+# into them
+folded = weakref.WeakKeyDictionary()
+
+NOT_CONSTANT = object()
+
+
+def rebound(genv, name):
+    # Called once a set of name in the global environment genv is done. What
+    # the engines have optimized for genv is stale once its generation moves
+    # on.
+    if name in FOLDABLE or name in CONSTANTS:
+        genv.generation += 1
+        for proc, (assumed, refresh) in folded.items():
+            if name in assumed and home_genv(proc) is genv:
+                del folded[proc]
+                watch(proc, refresh(proc), refresh)
+
+
+def home_genv(proc):
+    # The global environment proc looks up globals in
+    genv = getattr(proc, 'genv', None)
+    return genv if genv is not None else proc.parent_env.genv
+
+
+def is_standard(name, genv):
+    # Whether name means the primitive of that name in genv
+    return genv.defines(name) and genv[name] is primitives[name]
+
+
+def watch(proc, assumed, refresh):
+    # Once any of the names in assumed is set globally, refresh(proc) gives
+    # proc a body optimized again, and returns the names that relies on. The
+    # engines call this for procedures with something folded into them.
+    if assumed:
+        folded[proc] = assumed, refresh
+
+
+def size(form):
+    if isinstance(form, list):
+        return 1 + sum(size(x) for x in form)
+    return 1
+
+
+def is_literal(value):
+    return value is None or isinstance(value, (bool, numbers.Number,
+                                               basestring))
+
+
+class Optimizer(object):
+
+    def __init__(self, bound, genv):
+        # bound(name): whether something around the body binds name
+        self.bound = bound
+        self.genv = genv
+        # Names what's been folded relies on meaning the standard primitives
+        self.assumed = set()
+
+    def relies(self, *forms):
+        self.assumed.update(form.value for form in forms
+                            if isinstance(form, Symbol))
+
+    def standard(self, name, scope):
+        # Whether name still means the primitive of that name here
+        if name in scope or self.bound(name):
+            return False
+        if self.genv is None:
+            return True
+        return is_standard(name, self.genv)
+
+    def constant(self, form, scope):
+        # The value form always evaluates to, or NOT_CONSTANT
+        if isinstance(form, Symbol):
+            if form.value in CONSTANTS and self.standard(form.value, scope):
+                return primitives[form.value]
+            return NOT_CONSTANT
+        if isinstance(form, list):
+            if (len(form) == 2 and form[0] is QUOTE and
+                    'quote' not in scope and is_literal(form[1])):
+                return form[1]
+            return NOT_CONSTANT
+        return form if is_literal(form) else NOT_CONSTANT
+
+    def is_macro_call(self, head, scope):
+        # Calls of anything that isn't known to be a procedure count, since
+        # the arguments of a macro are forms rather than values
+        name = head.value
+        if name in scope or self.bound(name):
+            return False
+        if self.genv is None:
+            return False
+        if not self.genv.defines(name):
+            return True
+        return type(self.genv[name]) is Macro
+
+    def optimize(self, form, scope):
+        if not isinstance(form, list) or not form:
+            return form
+        head = form[0]
+        if isinstance(head, Symbol) and head.value not in scope:
+            if head in SPECIAL_FORMS:
+                special = self.special.get(head)
+                return special(self, form, scope) if special else form
+            if self.is_macro_call(head, scope):
+                return form
+        new = self.all(form, scope)
+        if isinstance(head, Symbol) and head.value in FOLDABLE and \
+                self.standard(head.value, scope):
+            return self.fold(new, scope)
+        return new
+
+    def all(self, forms, scope, start=0):
+        # forms with everything from start on optimized; forms itself if
+        # nothing changed
+        new = forms[:start] + [self.optimize(x, scope) for x in forms[start:]]
+        if all(x is y for x, y in zip(new, forms)):
+            return forms
+        return new
+
+    def fold(self, form, scope):
+        args = [self.constant(arg, scope) for arg in form[1:]]
+        if any(arg is NOT_CONSTANT for arg in args):
+            return form
+        try:
+            ret = primitives[form[0].value](*args)
+        except Exception:                           # pylint: disable=W0703
+            # Leave the error for when it runs
+            return form
+        if ret is False:
+            # Lisp!
+            ret = None
+        if not is_literal(ret):
+            return form
+        self.relies(*form)
+        return ret
+
+    def optimize_quote(self, form, scope):
+        return self.constant(form, scope) if is_literal(form[1]) else form
+
+    def optimize_if(self, form, scope):
+        new = self.all(form, scope, 1)
+        cond = self.constant(new[1], scope)
+        if cond is NOT_CONSTANT:
+            return new
+        self.relies(new[1])
+        if cond:
+            return new[2]
+        return new[3] if len(new) > 3 else None
+
+    def optimize_cond(self, form, scope):
+        clauses = []
+        for clause in form[1:]:
+            clause = self.all(clause, scope)
+            cond = self.constant(clause[0], scope)
+            if cond is NOT_CONSTANT:
+                clauses.append(clause)
+                continue
+            self.relies(clause[0])
+            if cond:
+                if not clauses:
+                    return clause[1]
+                clauses.append(clause)
+                break
+        if not clauses:
+            return None
+        if all(x is y for x, y in zip(clauses, form[1:])) and \
+                len(clauses) == len(form) - 1:
+            return form
+        return [form[0]] + clauses
+
+    def optimize_progn(self, form, scope):
+        body = []
+        for sub in form[1:]:
+            sub = self.optimize(sub, scope)
+            if isinstance(sub, list) and sub and sub[0] is PROGN and \
+                    'progn' not in scope:
+                body.extend(sub[1:])
+            else:
+                body.append(sub)
+        # Constants anywhere but the end do nothing
+        body = [sub for sub in body[:-1]
+                if self.constant(sub, scope) is NOT_CONSTANT] + body[-1:]
+        if not body:
+            return None
+        if len(body) == 1:
+            return body[0]
+        if len(body) == len(form) - 1 and all(
+                x is y for x, y in zip(body, form[1:])):
+            return form
+        return [form[0]] + body
+
+    def optimize_let(self, form, scope):
+        bindings = [self.all(binding, scope, 1) for binding in form[1]]
+        inner = scope | frozenset(binding[0].value for binding in form[1])
+        body = [self.optimize(sub, inner) for sub in form[2:]]
+        if all(x is y for x, y in zip(bindings, form[1])) and all(
+                x is y for x, y in zip(body, form[2:])):
+            return form
+        return [form[0], bindings] + body
+
+    def optimize_args(self, form, scope):
+        return self.all(form, scope, 1)
+
+    def optimize_value(self, form, scope):
+        # define and set: only the value is evaluated
+        return self.all(form, scope, 2)
+
+    special = {
+        QUOTE: optimize_quote,
+        IF: optimize_if,
+        COND: optimize_cond,
+        PROGN: optimize_progn,
+        LET: optimize_let,
+        AND: optimize_args,
+        OR: optimize_args,
+        GETHASH: optimize_args,
+        MAP: optimize_args,
+        SEQ: optimize_args,
+        PMAP: optimize_args,
+        DEFINE: optimize_value,
+        SET: optimize_value,
+    }
+
+
+def optimize_lambda(expr, bound, genv, assumed=None):
+    # The optimized body of (lambda params body). bound(name) says whether
+    # the scopes around the lambda bind name; genv is the global environment
+    # it's built in, or None if that isn't known yet. The names what's folded
+    # relies on (see watch) are added to the set assumed, if it's given.
+    from analyze import internal_defines
+    from macros import macro_expander
+
+    body = expr[2]
+    names = [arg.value for arg in expr[1]]
+    expand = macro_expander(None, genv) if genv is not None else None
+    scope = frozenset(names + internal_defines(body, expand))
+    optimizer = Optimizer(bound, genv)
+    new = optimizer.optimize(body, scope)
+    if assumed is not None:
+        assumed.update(optimizer.assumed)
+    if new is not body:
+        stats['removed'] += size(body) - size(new)
+    stats['procedures'] += 1
+    return new
+
+
+def optimized_body(expr, env):
+    # optimize_lambda for the interpreter, which builds a procedure every
+    # time it evaluates a lambda: the body, and the names it relies on. The
+    # result is kept on the form, if it's a Form, for the next time it's
+    # evaluated in the same global environment (which it doesn't keep alive).
+    genv = env.genv
+    cached = expr.optimized if type(expr) is Form else None
+    if (cached is not None and cached[0]() is genv and
+            cached[1] == genv.generation):
+        return cached[2], cached[3]
+    assumed = set()
+    body = optimize_lambda(expr, bound_locally, genv, assumed)
+    assumed = frozenset(assumed)
+    if type(expr) is Form:
+        expr.optimized = weakref.ref(genv), genv.generation, body, assumed
+    return body, assumed
+
+
+def interpreted_procedure(expr, env):
+    # The interpreter's procedure for the lambda expr, evaluated in env
+    body, assumed = optimized_body(expr, env)
+    proc = Procedure(expr[1], body, env)
+    if env.genv is env:
+        proc.source = expr
+    if assumed:
+        watch(proc, assumed, reoptimize(expr))
+    return proc
+
+
+def reoptimize(expr):
+    def refresh(proc):
+        proc.body, assumed = optimized_body(expr, proc.parent_env)
+        return assumed
+    return refresh
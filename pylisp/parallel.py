@@ -0,0 +1,233 @@
+from __future__ import unicode_literals
+
+# (pmap proc list ... :workers N :chunk-size M) is map run across a pool of
+# worker processes. The pool is forked with the procedure already in place --
+# along with the global environment and everything the procedure closes over
+# -- so only chunks of arguments go out and plain results come back. Results
+# are in input order; the first item to fail raises ParallelMapError.
+#
+# The pool is kept for the next pmap of the same procedure, with the same
+# number of workers, while the global environment's bindings and the
+# variables the procedure (or any procedure it can reach) closes over stay
+# the same; otherwise a new one is forked. Workers only see the values as they
+# were when they were forked, so a procedure that reads a hash table or vector
+# that's changed since should be given it as an argument instead.
+#
+# Needs fork(), so Unix only. pmap runs serially inside a worker, anywhere but
+# the main thread (forking a process with other threads running isn't safe,
+# which rules out the server), and when its arguments can't be pickled.
+
+import cPickle as pickle
+import multiprocessing
+import threading
+
+# Defaults for when a pmap form doesn't give them; workers=None means one per
+# CPU, chunk_size=None splits the work into about four chunks per worker.
+workers = None
+chunk_size = None
+
+# Keyword -> position in pmap's argument list
+options = {
+    ':workers': 1,
+    ':chunk-size': 2,
+}
+
+# The pool, and what it was forked with: (proc, workers, global bindings,
+# closure frames)
+pool = None
+seeded = None
+lock = threading.Lock()
+
+# In a worker: the procedure it was forked with
+in_worker = False
+worker_proc = None
+
+
+class ParallelMapError(Exception):
+
+    def __init__(self, index, item, error):
+        super(ParallelMapError, self).__init__(
+            'pmap failed on item {} ({!r}): {}'.format(index, item, error))
+        self.index = index
+        self.item = item
+        self.error = error
+
+
+def apply_chunk(proc, start, items):
+    # Results for items, which start at index start, or ('error', index,
+    # description) for the first one to raise
+    results = []
+    for index, args in enumerate(items, start):
+        try:
+            ret = proc(*args)
+        except Exception as e:                      # pylint: disable=W0703
+            return 'error', index, '{}: {}'.format(type(e).__name__, e)
+        # Lisp!
+        results.append(None if ret is False else ret)
+    return results
+
+
+def run_chunk(chunk):
+    return apply_chunk(worker_proc, *chunk)
+
+
+def init_worker(proc):
+    global in_worker, worker_proc               # pylint: disable=W0603
+    in_worker = True
+    worker_proc = proc
+
+
+def global_bindings(proc):
+    # The bindings of the global environment proc runs in. A fork's copies
+    # of its base's bindings are left out: the base never changes, and the
+    # workers would read the same.
+    import environments
+
+    env = getattr(proc, 'genv', None)
+    if env is None:
+        env = getattr(getattr(proc, 'parent_env', None), 'genv', None)
+    if env is None:
+        env = environments.global_env
+    copied = env.copied or {}
+    return dict((name, value) for name, value in env.iteritems()
+                if copied.get(name, copied) is not value)
+
+
+def closure_frames(procs):
+    # (frame, its values) for every frame short of the global environment
+    # that procs close over, and that the procedures in those close over
+    from environments import Environment
+    from pylisp import Procedure
+
+    frames = []
+    seen = set()
+    procs = list(procs)
+    while procs:
+        frame = getattr(procs.pop(), 'parent_env', None)
+        while frame is not None and id(frame) not in seen:
+            if isinstance(frame, Environment):
+                if frame.genv is frame:
+                    break
+                values = dict(frame)
+                procs.extend(value for value in values.itervalues()
+                             if isinstance(value, Procedure))
+            else:
+                values = list(frame)
+                procs.extend(value for value in values
+                             if isinstance(value, Procedure))
+            seen.add(id(frame))
+            frames.append((frame, values))
+            frame = frame.parent
+    return frames
+
+
+def same_bindings(old, new):
+    return len(old) == len(new) and all(
+        new.get(name, old) is value for name, value in old.iteritems())
+
+
+def same_frames(old, new):
+    return len(old) == len(new) and all(
+        frame is new_frame and (
+            same_bindings(values, new_values)
+            if isinstance(values, dict) else
+            len(values) == len(new_values) and
+            all(a is b for a, b in zip(values, new_values)))
+        for (frame, values), (new_frame, new_values) in zip(old, new))
+
+
+def worker_pool(proc, num_workers):
+    # A pool forked with proc, reusing the last one if it's still good. Call
+    # with the lock held.
+    from pylisp import Procedure
+
+    global pool, seeded                         # pylint: disable=W0603
+    bindings = global_bindings(proc)
+    frames = closure_frames(
+        [proc] + [value for value in bindings.itervalues()
+                  if isinstance(value, Procedure)])
+    if pool is not None and (seeded[0] is not proc or
+                             seeded[1] != num_workers or
+                             not same_bindings(seeded[2], bindings) or
+                             not same_frames(seeded[3], frames)):
+        shutdown()
+    if pool is None:
+        pool = multiprocessing.Pool(num_workers, init_worker, (proc,))
+        seeded = proc, num_workers, bindings, frames
+    return pool
+
+
+def shutdown():
+    # Stop the pool's workers, if there are any
+    global pool, seeded                         # pylint: disable=W0603
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+    pool = seeded = None
+
+
+def on_main_thread():
+    return isinstance(threading.current_thread(),
+                      threading._MainThread)        # pylint: disable=W0212
+
+
+def picklable(value):
+    try:
+        pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except Exception:                               # pylint: disable=W0703
+        return False
+    return True
+
+
+def pmap(proc, num_workers, size, *lists):
+    items = zip(*lists)
+    num_workers = num_workers or workers or multiprocessing.cpu_count()
+    size = size or chunk_size or max(1, len(items) // (num_workers * 4))
+    chunks = [(start, items[start:start + size])
+              for start in xrange(0, len(items), size)]
+
+    serial = (in_worker or num_workers == 1 or len(chunks) <= 1 or
+              not on_main_thread() or not picklable(items))
+    if serial:
+        return collect((apply_chunk(proc, *chunk) for chunk in chunks), items,
+                       lists)
+    with lock:
+        try:
+            return collect(worker_pool(proc, num_workers).imap(
+                run_chunk, chunks), items, lists)
+        except BaseException:
+            # Don't leave workers busy with the rest of it
+            shutdown()
+            raise
+
+
+def collect(results, items, lists):
+    ret = []
+    for result in results:
+        if isinstance(result, tuple):
+            _, index, error = result
+            item = items[index] if len(lists) > 1 else items[index][0]
+            raise ParallelMapError(index, item, error)
+        ret.extend(result)
+    return ret
+
+
+def pmap_args(expr):
+    # The argument forms for pmap(), in order, from a (pmap proc list ...
+    # :keyword value ...) form, with defaults filled in
+    from environments import Symbol
+
+    args = [expr[1], None, None]
+    lists = []
+    rest = iter(expr[2:])
+    for form in rest:
+        if isinstance(form, Symbol) and form.value.startswith(':'):
+            if form.value not in options:
+                raise SyntaxError('Unknown pmap option {}'.format(form))
+            try:
+                args[options[form.value]] = next(rest)
+            except StopIteration:
+                raise SyntaxError('No value for pmap option {}'.format(form))
+        else:
+            lists.append(form)
+    return args + lists
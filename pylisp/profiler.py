@@ -0,0 +1,209 @@
+from __future__ import unicode_literals
+
+# Opt-in profiler for Lisp code. While it's on, the engines report every
+# procedure call (and every let frame) here, and each procedure's calls,
+# frames, self time and cumulative time are collected by name, along with the
+# time spent in each distinct call stack. A run is profiled in the thread
+# that started it, and the others carry on unprofiled. `active` counts the
+# threads profiling; while it's 0, all the engines pay is a check of it per
+# call.
+#
+#   (profile expr)              evaluate expr, print a report, return its value
+#   (profile expr "out.folded") also write collapsed stacks, for flamegraph.pl
+#
+# From Python, profile(function, *args) runs function under the profiler and
+# leaves the results where last() returns them, in that thread.
+#
+# A tail call ends its caller as far as the profiler is concerned, just as it
+# does on the engines' stacks.
+
+from collections import defaultdict
+import io
+import threading
+import time
+
+active = 0          # threads profiling
+active_lock = threading.Lock()
+
+# Per thread: .current, the Profiler collecting results while it profiles,
+# and .last, the Profiler from its last finished run
+local = threading.local()
+
+timer = time.time
+
+ROOT = '<profile>'
+TOPLEVEL = '<toplevel>'
+
+CALLS, FRAMES, SELF, CUMULATIVE = range(4)
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.stats = {}                     # name -> [calls, frames, self,
+                                            #          cumulative]
+        self.stack = []                     # [name, start, child time, path]
+        self.running = defaultdict(int)     # name -> activations on stack
+        self.stacks = defaultdict(float)    # collapsed stack -> self time
+
+    def get_stats(self, name):
+        try:
+            return self.stats[name]
+        except KeyError:
+            stats = self.stats[name] = [0, 0, 0.0, 0.0]
+            return stats
+
+    def enter(self, name):
+        stats = self.get_stats(name)
+        stats[CALLS] += 1
+        # The procedure's own frame
+        stats[FRAMES] += 1
+        self.running[name] += 1
+        path = self.stack[-1][3] + ';' + name if self.stack else name
+        self.stack.append([name, timer(), 0.0, path])
+
+    def leave(self):
+        name, start, child, path = self.stack.pop()
+        elapsed = timer() - start
+        stats = self.stats[name]
+        stats[SELF] += elapsed - child
+        self.running[name] -= 1
+        if not self.running[name]:
+            # Outermost activation: don't count recursive calls twice
+            stats[CUMULATIVE] += elapsed
+        if self.stack:
+            self.stack[-1][2] += elapsed
+        self.stacks[path] += elapsed - child
+
+    def tail(self, name):
+        self.leave()
+        self.enter(name)
+
+    def frame(self):
+        # A let frame, charged to the running procedure
+        self.get_stats(self.stack[-1][0] if self.stack else TOPLEVEL)[
+            FRAMES] += 1
+
+    def report(self, sort='self', limit=None):
+        key = {'calls': CALLS, 'frames': FRAMES, 'self': SELF,
+               'cumulative': CUMULATIVE}[sort]
+        rows = sorted(self.stats.iteritems(), key=lambda item: -item[1][key])
+        lines = ['{:>9} {:>9} {:>11} {:>11}  {}'.format(
+            'calls', 'frames', 'self (s)', 'cumul. (s)', 'procedure')]
+        for name, stats in rows[:limit]:
+            lines.append('{:>9} {:>9} {:>11.6f} {:>11.6f}  {}'.format(
+                stats[CALLS], stats[FRAMES], stats[SELF], stats[CUMULATIVE],
+                name))
+        return '\n'.join(lines)
+
+    def collapsed(self):
+        # One "outer;inner;innermost microseconds" line per stack
+        return '\n'.join('{} {}'.format(path, int(round(seconds * 1e6)))
+                         for path, seconds in sorted(self.stacks.iteritems()))
+
+
+primitive_names = {}
+
+
+def proc_name(proc):
+    name = getattr(proc, 'name', None)
+    if name:
+        return name
+    code = getattr(proc, 'code', None)
+    if getattr(code, 'name', None):
+        return code.name
+    if hasattr(proc, 'body'):
+        return 'lambda'
+    if not primitive_names:
+        from environments import primitives
+        primitive_names.update((id(value), key)
+                               for key, value in primitives.iteritems())
+    return primitive_names.get(id(proc)) or getattr(
+        proc, '__name__', type(proc).__name__)
+
+
+def running():
+    # This thread's Profiler, if it's profiling
+    return getattr(local, 'current', None)
+
+
+def last():
+    return getattr(local, 'last', None)
+
+
+# The engines' reports; in a thread that isn't profiling, they're dropped
+
+def enter(name):
+    profiler = running()
+    if profiler is not None:
+        profiler.enter(name)
+
+
+def leave():
+    profiler = running()
+    if profiler is not None:
+        profiler.leave()
+
+
+def tail(name):
+    profiler = running()
+    if profiler is not None:
+        profiler.tail(name)
+
+
+def frame():
+    profiler = running()
+    if profiler is not None:
+        profiler.frame()
+
+
+def call(proc, function, *args):
+    # Run function(*args) as a call of proc
+    profiler = running()
+    if profiler is None:
+        return function(*args)
+    profiler.enter(proc_name(proc))
+    try:
+        return function(*args)
+    finally:
+        profiler.leave()
+
+
+def apply(proc, args):
+    # Call proc, which may or may not report its own calls
+    if getattr(proc, 'traced', False):
+        return proc(*args)
+    return call(proc, proc, *args)
+
+
+def profile(function, *args):
+    global active                           # pylint: disable=W0603
+    if running() is not None:
+        # Nested: part of the run already going
+        return function(*args)
+    profiler = local.current = Profiler()
+    with active_lock:
+        active += 1
+    profiler.enter(ROOT)
+    try:
+        return function(*args)
+    finally:
+        # An error can leave calls open
+        while profiler.stack:
+            profiler.leave()
+        with active_lock:
+            active -= 1
+        local.current = None
+        local.last = profiler
+
+
+def profile_form(function, path=None):
+    # (profile expr [path])
+    if running() is not None:
+        return function()
+    ret = profile(function)
+    print last().report()
+    if path is not None:
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(last().collapsed() + '\n')
+    return ret
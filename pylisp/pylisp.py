@@ -2,7 +2,30 @@
 
 from __future__ import unicode_literals
 
-from repl import read_loop
+import limits
+import profiler
+
+
+class Form(list):
+    # A list read as code. What's worked out about it the first time it's
+    # evaluated is kept on it, so it lasts as long as the form does.
+    expansion = None    # (macro, expansion) of a macro call
+    optimized = None    # (global environment, generation, body, names it
+                        # relies on) of a lambda, see optimize.optimized_body
+
+    def __reduce__(self):
+        # Just the list: the rest is worked out again when it's needed
+        return Form, (list(self),)
+
+
+class TailCall(object):
+    # A procedure call in tail position, handed back to the caller's
+    # trampoline to make
+    __slots__ = ('proc', 'args')
+
+    def __init__(self, proc, args):
+        self.proc = proc
+        self.args = args
 
 
 class Procedure(object):
@@ -11,20 +34,64 @@ class Procedure(object):
     # the `isinstance(expr, Symbol)` test fails -- __main__.Symbol !=
     # pylisp.Symbol
 
+    # The name it was first defined under, for the profiler
+    name = None
+    # __call__ reports calls to the profiler itself
+    traced = True
+    # The lambda it was made from, if it was made at the top level of a
+    # global environment (see Environment.adopt)
+    source = None
+
     def __init__(self, arglist, body, parent_env):
         self.arglist = arglist
         self.body = body
         self.parent_env = parent_env
+        for arg in arglist:
+            arg.local = True
 
-    def __call__(self, *args):
+    def home(self):
+        # The global environment it was made at the top level of, if any
+        return self.parent_env if self.source is not None else None
+
+    def rebind(self, genv):
+        # The procedure its lambda makes at the top level of genv
+        from optimize import interpreted_procedure
+        return interpreted_procedure(self.source, genv)
+
+    def bind(self, args):
         from environments import Environment
 
         env = Environment(parent=self.parent_env)
         for arg, val in zip(self.arglist, args):
             assert isinstance(arg.value, basestring)
             env[arg.value] = val
-        return env.eval(self.body)
+        return env
+
+    def __call__(self, *args):
+        limits.spend()
+        if profiler.active:
+            return profiler.call(self, run_traced, self, args)
+        return self.bind(args).eval(self.body)
+
+
+def run_traced(proc, args):
+    # Procedure.__call__ while profiling. Tail calls come back as TailCalls
+    # rather than running in the same eval loop, so the profiler sees them.
+    ret = proc.bind(args).eval(proc.body, True)
+    while type(ret) is TailCall:
+        limits.spend()
+        proc = ret.proc
+        profiler.tail(profiler.proc_name(proc))
+        ret = proc.bind(ret.args).eval(proc.body, True)
+    return ret
+
+
+def name_procedure(value, name):
+    if isinstance(value, Procedure) and value.name is None:
+        value.name = name
 
 
 if __name__ == '__main__':
-    read_loop()
+    import sys
+    from cli import main
+    sys.exit(main())
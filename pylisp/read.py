@@ -1,59 +1,209 @@
 from __future__ import unicode_literals
 
+import codecs
+import re
+
+from pylisp import Form
+
+# One token per match, after any whitespace: a special character (or ,@), or
+# a run of anything else (an atom). Matching an atom stops at the end of the
+# buffer, so a Reader holds on to an atom at the end of a chunk until it knows
+# it's whole.
+token_re = re.compile(r'''\s*(?:(,@|[()'"`,])|([^\s()'"`,]+))''')
+# The end of the current string literal, or the next escape in it
+string_re = re.compile(r'["\\]')
+
+
+# Characters an int or float (including inf and nan) can start with
+numeric_starts = frozenset('0123456789+-.iInN')
+
 
 def atom(x):
     from environments import Symbol
-    try:
-        return int(x)
-    except ValueError:
+    if x[0] in numeric_starts:
         try:
-            return float(x)
+            return int(x)
         except ValueError:
-            return Symbol(x)
+            try:
+                return float(x)
+            except ValueError:
+                pass
+    # Interned -- every occurrence of a name shares one Symbol
+    return Symbol(x)
 
 
 def tokenize(chars):
-    special = '()"\''
-    for s in special:
-        chars = chars.replace(s, ' {} '.format(s))
-    return chars.split()
+    return [special or word for special, word in token_re.findall(chars)]
 
 
-def parse(expr):
-    return read_from_tokens(tokenize(expr))
+class Reader(object):
+    # Incremental reader: feed() it text in chunks of any size, and it returns
+    # the top-level forms completed so far. Each character is scanned once,
+    # and the reader's state (open lists, pending quotes, a partial atom or
+    # string) carries over between chunks.
 
+    def __init__(self):
+        from environments import QUOTE, QUASIQUOTE, UNQUOTE, UNQUOTE_SPLICING
 
-def read_from_tokens(tokens, level=0):
-    if not tokens:
-        raise SyntaxError('No input')
-    ret = None
-    t = tokens.pop(0)
-    quote = False
-    if t == "'":
-        quote = True
-        t = tokens.pop(0)
-    if t == '"':
-        L = []
-        while tokens[0] != '"':
-            L.append(tokens.pop(0))
-        # Pop off final '"'
-        tokens.pop(0)
-        ret = ' '.join(L)
-    elif t == '(':
-        L = []
-        while tokens[0] != ')':
-            L.append(read_from_tokens(tokens, level=level + 1))
-        # Pop off final ')'
-        tokens.pop(0)
-        if level == 0 and tokens:
-            raise SyntaxError('Unexpected data after parse: {}'.format(
-                ' '.join(tokens)))
-        ret = L
-    elif t == ')':
-        raise SyntaxError('Unexpected ")"')
+        # Prefix -> the symbol of the form it wraps the next datum in
+        self.prefixes = {"'": QUOTE, '`': QUASIQUOTE, ',': UNQUOTE,
+                         ',@': UNQUOTE_SPLICING}
+        # Open lists, and the symbols of pending prefixes
+        self.stack = []
+        self.pending = ''       # unconsumed text: a possibly partial atom
+        self.string = None      # pieces of a string literal being read
+        self.escape = False
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        # Position of the start of the text being fed
+        self.line, self.column = 1, 0
+
+    @property
+    def depth(self):
+        return sum(1 for frame in self.stack if type(frame) is Form)
+
+    @property
+    def in_string(self):
+        return self.string is not None
+
+    @property
+    def idle(self):
+        # True between top-level forms
+        return not self.stack and not self.pending and self.string is None
+
+    def position(self, text, pos):
+        newlines = text.count('\n', 0, pos)
+        if newlines:
+            return self.line + newlines, pos - text.rindex('\n', 0, pos) - 1
+        return self.line, self.column + pos
+
+    def error(self, message, text, pos):
+        line, column = self.position(text, pos)
+        return SyntaxError('{} at line {}, column {}'.format(
+            message, line, column + 1))
+
+    def complete(self, datum, forms):
+        stack = self.stack
+        while stack and type(stack[-1]) is not Form:
+            datum = Form([stack.pop(), datum])
+        if stack:
+            stack[-1].append(datum)
+        else:
+            forms.append(datum)
+
+    def read_string(self, text, pos, forms):
+        # Continue a string literal; returns the position after it, or None
+        # if the text ran out first.
+        while True:
+            if self.escape:
+                if pos == len(text):
+                    return None
+                self.string.append(text[pos])
+                self.escape = False
+                pos += 1
+            m = string_re.search(text, pos)
+            if m is None:
+                self.string.append(text[pos:])
+                return None
+            self.string.append(text[pos:m.start()])
+            pos = m.end()
+            if m.group() == '\\':
+                self.escape = True
+                continue
+            datum, self.string = ''.join(self.string), None
+            self.complete(datum, forms)
+            return pos
+
+    def feed(self, chunk):
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk)
+        text = self.pending + chunk
+        self.pending = ''
+        forms = []
+        end = len(text)
+        pos = 0
+        if self.string is not None:
+            pos = self.read_string(text, pos, forms)
+        stack = self.stack
+        match = token_re.match
+        form = Form
+        while pos is not None and pos < end:
+            m = match(text, pos)
+            if m is None:
+                # Only whitespace left
+                pos = end
+                break
+            special, word = m.groups()
+            if word is not None:
+                if m.end() == end:
+                    # Might continue in the next chunk
+                    self.pending = word
+                    end = m.start(2)
+                    break
+                datum = atom(word)
+                if stack and type(stack[-1]) is form:
+                    stack[-1].append(datum)
+                else:
+                    self.complete(datum, forms)
+            elif special == '(':
+                stack.append(form())
+            elif special == ')':
+                if not stack or type(stack[-1]) is not form:
+                    raise self.error('Unexpected ")"', text, m.end() - 1)
+                self.complete(stack.pop(), forms)
+            elif special == '"':
+                self.string = []
+                pos = self.read_string(text, m.end(), forms)
+                continue
+            elif special == ',' and m.end() == end:
+                # Might be the start of ,@
+                self.pending = special
+                end = m.start(1)
+                break
+            else:
+                stack.append(self.prefixes[special])
+            pos = m.end()
+        self.line, self.column = self.position(text, end)
+        return forms
+
+    def close(self):
+        # End of input: finish a trailing atom, complain about anything open
+        forms = []
+        if self.pending == ',':
+            raise self.error('Unexpected end of input', '', 0)
+        if self.pending:
+            word, self.pending = self.pending, ''
+            self.complete(atom(word), forms)
+            self.line, self.column = self.position(word, len(word))
+        if self.string is not None:
+            raise self.error('Unterminated string', '', 0)
+        if self.stack:
+            raise self.error('Unexpected end of input', '', 0)
+        return forms
+
+
+def read_forms(source, chunk_size=64 * 1024):
+    # Yield the top-level forms in source -- a string, a file-like object or
+    # an iterable of chunks -- one at a time.
+    reader = Reader()
+    if isinstance(source, basestring):
+        chunks = [source]
+    elif hasattr(source, 'read'):
+        chunks = iter(lambda: source.read(chunk_size), source.read(0))
     else:
-        ret = atom(t)
+        chunks = source
+    for chunk in chunks:
+        for form in reader.feed(chunk):
+            yield form
+    for form in reader.close():
+        yield form
+
 
-    if quote:
-        ret = ['quote', ret]
+def parse(expr):
+    forms = read_forms(expr)
+    try:
+        ret = next(forms)
+    except StopIteration:
+        raise SyntaxError('No input')
+    for extra in forms:
+        raise SyntaxError('Unexpected data after parse: {}'.format(extra))
     return ret
@@ -1,63 +1,73 @@
 from __future__ import unicode_literals
 
-import readline
+from utils import Colors
 
-from utils import Colors, parens_balanced
 
-
-# TODO: http://pymotw.com/2/readline/
-# Use readline for completing function names
-readline.parse_and_bind('tab: complete')
-readline.parse_and_bind('set editing-mode emacs')
-
-
-def global_parse_and_eval(expr):
+def global_parse_and_eval(expr, steps=None, seconds=None, depth=None):
+    # With any of the limits, a runaway evaluation raises LimitExceeded (see
+    # limits.py)
     from environments import global_env
+    from limits import limited
     from read import parse
 
-    return global_env.eval(parse(expr))
+    expr = parse(expr)
+    if steps is None and seconds is None and depth is None:
+        return global_env.eval(expr)
+    return limited(lambda: global_env.eval(expr), steps, seconds, depth)
 
 
 def read_loop():
-    from environments import global_env
-    from read import parse
+    # Only the interactive REPL needs readline, so it isn't imported until now
+    import readline
+
+    # TODO: http://pymotw.com/2/readline/
+    # Use readline for completing function names
+    readline.parse_and_bind('tab: complete')
+    readline.parse_and_bind('set editing-mode emacs')
     try:
         readline.read_history_file('.pylisp_history')
     except IOError:
         pass
+    eval_loop(raw_input)
+    print
+    readline.write_history_file('.pylisp_history')
+
+
+def eval_loop(read_line):
+    # Read lines with read_line(prompt) until EOFError, evaluating each
+    # top-level form as soon as it's complete. The Reader carries what it's
+    # seen of a partial form (open lists, a string literal...) from one line
+    # to the next, so each line is only scanned once.
+    from environments import global_env
+    from read import Reader
+
     count = 1
-    complete_expr = []
-    indent = 0
+    reader = Reader()
     while True:
         try:
-            prompt = ((Colors.red('[{}]'.format(count)) + ' > ') if not
-                      complete_expr else '...   ' + '  ' * indent)
+            prompt = ((Colors.red('[{}]'.format(count)) + ' > ') if
+                      reader.idle else '...   ' + '  ' * reader.depth)
             try:
-                expr = raw_input(prompt)
+                line = read_line(prompt)
             except EOFError:
                 break
-            if not expr:
+            try:
+                forms = reader.feed(line + '\n')
+            except SyntaxError as e:
+                print 'Error: {}'.format(e)
+                reader = Reader()
                 continue
-            # Complete sexp, or multi-line entry?
-            complete_expr.append(expr)
-            balanced, indent = parens_balanced(complete_expr)
-            if balanced:
-                # Complete sexp, try to eval
+            for form in forms:
                 try:
-                    expr = ' '.join(complete_expr)
-                    complete_expr = []
-                    ret = global_env.eval(parse(expr))
+                    ret = global_env.eval(form)
                 except Exception, e:                    # pylint: disable=W0703
                     print 'Error: {}'.format(e)
                     continue
                 print Colors.green('[{}]'.format(count)) + ' {}'.format(ret)
                 print
                 count += 1
-            else:
-                # Incomplete sexp, still building
-                continue
         except KeyboardInterrupt:
+            # Throw away any partial form
             print 'KeyboardInterrupt'
+            reader = Reader()
             continue
-    print
-    readline.write_history_file('.pylisp_history')
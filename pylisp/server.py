@@ -0,0 +1,393 @@
+from __future__ import unicode_literals
+
+# Evaluation server, for many clients at once on a Unix socket or TCP on
+# localhost.
+#
+#   python -m pylisp.server --unix /tmp/pylisp.sock
+#   python -m pylisp.server --port 7777 --workers 8 --timeout 5
+#
+# Each connection is a session with its own environment, which lasts until
+# the client disconnects. Sessions start as forks of the standard
+# environment, so opening one costs next to nothing.
+#
+# Messages both ways are a 4-byte big-endian length, then that many bytes of
+# UTF-8 JSON. A client sends one request and reads the response before
+# sending the next:
+#
+#   {"source": "(+ 1 2)"}       ->  {"value": "3"}
+#                               or  {"error": "ValueError: ..."}
+#   {"op": "metrics"}           ->  {"metrics": {...}}
+#
+# Evaluations run on a pool of `workers` threads, each evaluation as a task
+# (see tasks.py) on its worker's own loop, so one that never gives way --
+# deep in a primitive, say -- only holds up its own worker. Requests beyond
+# that wait in a queue of at most `queue_size`, and any more are turned away.
+# An evaluation has a budget of `timeout` seconds (see limits.py), which the
+# vm checks as it goes, so one still running then is stopped where it is;
+# one waiting on a Future is stopped then too. One that can't be stopped --
+# stuck in a primitive that never calls back into the vm -- gets its
+# EvalTimeout response anyway, GRACE seconds later, and its worker is
+# replaced with a fresh one.
+
+from collections import deque
+import argparse
+import json
+import Queue
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+
+from cli import to_string
+from limits import Budget, LimitExceeded
+from tasks import Future, Loop, Timeout, evaluate, session
+
+HEADER = struct.Struct(b'>I')
+MAX_MESSAGE = 16 * 1024 * 1024
+
+# Latencies the percentiles are taken over
+LATENCY_WINDOW = 1000
+
+# Seconds past its timeout an evaluation has to stop before it's given up on
+GRACE = 1.0
+
+
+class EvalTimeout(Exception):
+    pass
+
+
+class Busy(Exception):
+    pass
+
+
+class RemoteError(Exception):
+    pass
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            if chunks:
+                raise EOFError('Connection closed mid-message')
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    # The next message, or None once the other end has closed
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > MAX_MESSAGE:
+        raise ValueError('Message of {} bytes is too big'.format(size))
+    data = recv_exactly(sock, size) if size else b''
+    if data is None:
+        raise EOFError('Connection closed mid-message')
+    return json.loads(data.decode('utf-8'))
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Job(Future):
+    # An evaluation's value, for the Dispatcher
+
+    def __init__(self, source, env):
+        super(Job, self).__init__()
+        self.source = source
+        self.env = env
+        self.started = threading.Event()
+        self.worker = None      # the thread running it, while it runs
+
+
+class Dispatcher(object):
+    # Runs evaluations, from any thread, on a pool of worker threads
+
+    def __init__(self, workers=4, queue_size=100, timeout=10.0):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # A Job for each evaluation yet to start, or None to stop a worker
+        self.waiting = Queue.Queue()
+        self.queued = 0
+        self.running = 0
+        # Workers given up on, still running what they were given
+        self.stuck = 0
+        for _ in xrange(workers):
+            self.start_worker()
+
+    def start_worker(self):
+        thread = threading.Thread(target=self.work)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, source, env):
+        # A Job evaluating source in env
+        job = Job(source, env)
+        with self.lock:
+            if self.queued + self.running >= self.workers + self.queue_size:
+                raise Busy('{} evaluations already waiting'.format(
+                    self.queued))
+            self.queued += 1
+        self.waiting.put(job)
+        return job
+
+    def result(self, job):
+        # job's value, once it's done or should have been
+        job.started.wait()
+        try:
+            return job.result(self.timeout + GRACE)
+        except Timeout:
+            self.give_up(job)
+            raise self.timed_out()
+
+    def give_up(self, job):
+        # Leave job's worker to it, and start another in its place
+        with self.lock:
+            if job.done():
+                return
+            job.set_exception(self.timed_out())
+            job.worker = None
+            self.running -= 1
+            self.stuck += 1
+        self.start_worker()
+
+    def work(self):
+        while True:
+            job = self.waiting.get()
+            if job is None:
+                return
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+                job.worker = threading.current_thread()
+            job.started.set()
+            try:
+                value, error = self.run(job.source, job.env), None
+            except Exception as e:                  # pylint: disable=W0703
+                value, error = None, e
+            with self.lock:
+                if job.worker is None:
+                    # Given up on, and replaced
+                    self.stuck -= 1
+                    return
+                job.worker = None
+                self.running -= 1
+                if error is None:
+                    job.set_result(value)
+                else:
+                    job.set_exception(error)
+
+    def timed_out(self):
+        return EvalTimeout('Evaluation took more than {}s'.format(
+            self.timeout))
+
+    def run(self, source, env):
+        # source's value in env, on a loop of this worker's own
+        loop = Loop()
+        timeout = self.timed_out()
+        task = evaluate(source, env, loop,
+                        budget=Budget(seconds=self.timeout))
+        # The budget stops it while it runs; this, while it waits
+        loop.call_later(self.timeout, task.cancel, timeout)
+        try:
+            return loop.run_until_complete(task)
+        except LimitExceeded as e:
+            if e.limit == 'seconds':
+                raise timeout
+            raise
+
+    def queue_depth(self):
+        with self.lock:
+            return self.queued
+
+    def stop(self):
+        for _ in xrange(self.workers):
+            self.waiting.put(None)
+
+
+class Handler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        env = session()
+        server.session_started()
+        try:
+            while True:
+                try:
+                    request = recv_message(self.request)
+                except (EOFError, ValueError, socket.error):
+                    break
+                if request is None:
+                    break
+                send_message(self.request, server.respond(request, env))
+        except socket.error:
+            pass
+        finally:
+            server.session_ended()
+
+
+class EvalServerMixin:                              # pylint: disable=W0232
+    # The state shared by the Unix and TCP servers. Old-style, like
+    # SocketServer's own mixins.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def setup_evaluation(self, workers, queue_size, timeout):
+        self.dispatcher = Dispatcher(workers, queue_size, timeout)
+        self.metrics_lock = threading.Lock()
+        self.sessions = 0
+        self.counts = {'requests': 0, 'errors': 0, 'timeouts': 0, 'busy': 0}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def session_started(self):
+        with self.metrics_lock:
+            self.sessions += 1
+
+    def session_ended(self):
+        with self.metrics_lock:
+            self.sessions -= 1
+
+    def respond(self, request, env):
+        if not isinstance(request, dict):
+            return {'error': 'ValueError: a request is a JSON object'}
+        if request.get('op') == 'metrics':
+            return {'metrics': self.metrics()}
+        source = request.get('source')
+        if not isinstance(source, basestring):
+            return {'error': 'ValueError: request has no source'}
+        start = time.time()
+        outcome = 'requests'
+        try:
+            dispatcher = self.dispatcher
+            value = dispatcher.result(dispatcher.submit(source, env))
+            return {'value': to_string(value)}
+        except Exception as e:                      # pylint: disable=W0703
+            outcome = {EvalTimeout: 'timeouts', Busy: 'busy'}.get(
+                type(e), 'errors')
+            return {'error': '{}: {}'.format(type(e).__name__, e)}
+        finally:
+            with self.metrics_lock:
+                self.counts['requests'] += 1
+                if outcome != 'requests':
+                    self.counts[outcome] += 1
+                if outcome != 'busy':
+                    self.latencies.append(time.time() - start)
+
+    def metrics(self):
+        with self.metrics_lock:
+            latencies = sorted(self.latencies)
+            metrics = dict(self.counts, sessions=self.sessions)
+        metrics.update(
+            queue_depth=self.dispatcher.queue_depth(),
+            running=self.dispatcher.running,
+            stuck=self.dispatcher.stuck,
+            latency_p50=percentile(latencies, 0.5),
+            latency_p90=percentile(latencies, 0.9),
+            latency_p99=percentile(latencies, 0.99),
+        )
+        return metrics
+
+    def server_close(self):
+        self.dispatcher.stop()
+        SocketServer.TCPServer.server_close(self)
+
+
+class UnixEvalServer(EvalServerMixin, SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    pass
+
+
+class TCPEvalServer(EvalServerMixin, SocketServer.ThreadingMixIn,
+                    SocketServer.TCPServer):
+    pass
+
+
+def make_server(address, workers=4, queue_size=100, timeout=10.0):
+    # A server listening on address: a Unix socket's path, or a TCP port on
+    # localhost. Call serve_forever() to run it.
+    if isinstance(address, basestring):
+        server = UnixEvalServer(address, Handler)
+    else:
+        server = TCPEvalServer(('127.0.0.1', address), Handler)
+    server.setup_evaluation(workers, queue_size, timeout)
+    return server
+
+
+class Client(object):
+
+    def __init__(self, address):
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = ('127.0.0.1', address)
+        self.sock.connect(address)
+
+    def request(self, message):
+        send_message(self.sock, message)
+        response = recv_message(self.sock)
+        if response is None:
+            raise EOFError('Server closed the connection')
+        return response
+
+    def eval(self, source):
+        # The printed value of the last form in source
+        response = self.request({'source': source})
+        if 'error' in response:
+            raise RemoteError(response['error'])
+        return response['value']
+
+    def metrics(self):
+        return self.request({'op': 'metrics'})['metrics']
+
+    def close(self):
+        self.sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pylisp.server',
+        description='Serve isolated evaluation sessions on a local socket.')
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--unix', metavar='PATH', help='Unix socket to create')
+    where.add_argument('--port', type=int, help='TCP port on localhost')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='evaluations run at once (default 4)')
+    parser.add_argument('--queue-size', type=int, default=100,
+                        help='evaluations that can wait (default 100)')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds an evaluation can take (default 10)')
+    args = parser.parse_args(argv)
+
+    server = make_server(args.unix if args.unix else args.port, args.workers,
+                         args.queue_size, args.timeout)
+    print >> sys.stderr, 'pylisp: serving on {}'.format(
+        args.unix or 'localhost:{}'.format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+from __future__ import unicode_literals
+
+# Cooperative evaluation: many evaluations interleaved on one thread, none of
+# them blocking the others while they wait for I/O.
+#
+#   loop = Loop()
+#   task = evaluate('(+ (lookup 1) (fib 20))', env, loop)
+#   loop.run_until_complete(task)
+#
+# Tasks run on the vm, whose state is all in its own registers, so it can
+# put an evaluation aside and pick it up again later. A task gives the loop
+# back every `slice` procedure calls, and whenever it calls an
+# AsyncPrimitive that returns a Future, until the Future is done. Each task
+# has its own environment: by default a fork of the standard one, which costs
+# next to nothing.
+#
+# A task can be given a limits.Budget, which is enforced whenever it runs
+# (and counts from when it first does), and not on the rest of the loop.
+#
+# Only calls the vm makes itself can wait. An AsyncPrimitive called from
+# inside another primitive (map, reduce...) blocks until its Future is done,
+# and can't wait for the loop it's blocking; call it directly instead.
+
+from collections import deque
+from itertools import count
+import heapq
+import Queue
+import threading
+import time
+
+# Procedure calls a task makes before giving the loop back
+SLICE = 1000
+
+local = threading.local()
+
+
+class Timeout(Exception):
+    pass
+
+
+class Future(object):
+    # A result that isn't there yet. It can be set from any thread, and
+    # callbacks run in the thread that sets it.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks = []
+        self._result = self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        # Raises Timeout if it isn't done within timeout seconds
+        if not self._event.wait(timeout):
+            raise Timeout('Not done after {}s'.format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, function):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(function)
+                return
+        function(self)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            if self._event.is_set():
+                raise ValueError('Future is already done')
+            self._result, self._exception = result, exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for function in callbacks:
+            function(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+
+class AsyncPrimitive(object):
+    # A primitive whose function can return a Future rather than a value.
+    # A task waits for it without holding up the loop; anywhere else, the
+    # call blocks until it's done.
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args):
+        ret = self.function(*args)
+        if isinstance(ret, Future):
+            if not ret.done() and getattr(local, 'loop', None) is not None:
+                raise RuntimeError(
+                    'An AsyncPrimitive called by another primitive would '
+                    'block the loop')
+            return ret.result()
+        return ret
+
+
+class Loop(object):
+
+    def __init__(self):
+        self.ready = deque()
+        # (when, n, function, args)
+        self.timers = []
+        self.counter = count()
+        # Callbacks from other threads
+        self.incoming = Queue.Queue()
+
+    def call_soon(self, function, *args):
+        self.ready.append((function, args))
+
+    def call_soon_threadsafe(self, function, *args):
+        self.incoming.put((function, args))
+
+    def call_later(self, delay, function, *args):
+        heapq.heappush(self.timers, (time.time() + delay, next(self.counter),
+                                     function, args))
+
+    def run_once(self):
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+        else:
+            timeout = 0.1
+        try:
+            while True:
+                self.ready.append(self.incoming.get(timeout > 0, timeout))
+                timeout = 0
+        except Queue.Empty:
+            pass
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, function, args = heapq.heappop(self.timers)
+            self.ready.append((function, args))
+        # Only what's ready now: anything these add waits for the next turn
+        for _ in xrange(len(self.ready)):
+            function, args = self.ready.popleft()
+            function(*args)
+
+    def run_until_complete(self, future):
+        previous, local.loop = getattr(local, 'loop', None), self
+        try:
+            while not future.done():
+                self.run_once()
+        finally:
+            local.loop = previous
+        return future.result()
+
+
+class Task(Future):
+    # The evaluation of a sequence of forms, as a Future of the last one's
+    # value
+
+    def __init__(self, forms, env, loop, slice_=SLICE, budget=None):
+        from vm import VMEnvironment
+
+        super(Task, self).__init__()
+        if not isinstance(env, VMEnvironment):
+            raise TypeError('Tasks run on the vm engine')
+        self.forms = iter(forms)
+        self.env = env
+        self.loop = loop
+        self.slice = slice_
+        self.budget = budget
+        # The vm's registers while it's suspended, and the Future it's
+        # waiting for, if any
+        self.state = None
+        self.awaiting = None
+        self.code = None
+        self.value = None
+        loop.call_soon(self.step)
+
+    def step(self):
+        from bytecode import compile_toplevel
+        from vm import SUSPENDED, run
+
+        if self.done():
+            # Cancelled
+            return
+        budget = self.budget
+        if budget is not None:
+            if budget.start is None:
+                budget.begin()
+            budget.resume()
+        try:
+            while True:
+                if self.code is None:
+                    for form in self.forms:
+                        self.code = compile_toplevel(form, self.env)
+                        break
+                    else:
+                        self.set_result(self.value)
+                        return
+                ret = run(self.code, None, self.env, task=self)
+                if ret is SUSPENDED:
+                    if self.awaiting is not None:
+                        self.awaiting.add_done_callback(self.wake)
+                    else:
+                        self.loop.call_soon(self.step)
+                    return
+                self.value = ret
+                self.code = None
+        except Exception as e:                      # pylint: disable=W0703
+            self.set_exception(e)
+        finally:
+            if budget is not None:
+                budget.pause()
+                if self.done():
+                    budget.finish = time.time()
+
+    def cancel(self, exception):
+        # Fail with exception, unless it's done already. It won't run again.
+        if not self.done():
+            self.set_exception(exception)
+
+    def wake(self, _future):
+        self.loop.call_soon_threadsafe(self.step)
+
+    def awaited(self):
+        # For the vm, resuming: the result of the Future it waited for
+        future, self.awaiting = self.awaiting, None
+        return future.result()
+
+
+def session():
+    # A fresh environment for a task
+    from environments import std_snapshot
+
+    return std_snapshot('vm').fork()
+
+
+def evaluate(source, env=None, loop=None, slice_=SLICE, budget=None):
+    # A Task evaluating source (text, or a list of parsed forms) in env
+    from read import read_forms
+
+    forms = read_forms(source) if isinstance(source, basestring) else source
+    return Task(forms, env if env is not None else session(),
+                loop or Loop(), slice_, budget)
+
+
+def gather(futures):
+    # A Future of the list of their results, which fails if any of them does
+    futures = list(futures)
+    gathered = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(future):
+        with lock:
+            if gathered.done():
+                return
+            if future._exception is not None:   # pylint: disable=W0212
+                gathered.set_exception(future._exception)
+                return
+            remaining[0] -= 1
+            if not remaining[0]:
+                gathered.set_result([f.result() for f in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(finished)
+    return gathered
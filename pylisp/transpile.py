@@ -0,0 +1,361 @@
+from __future__ import unicode_literals
+
+# Lowers a procedure to a real Python function: the body becomes a Python
+# expression tree (ast), with arguments as Python locals, `if` as a
+# conditional expression and the arithmetic/comparison primitives inlined as
+# Python operators. Anything we can't translate faithfully -- nested lambdas,
+# define, set, map, quasiquote, macro calls, closures over local variables --
+# raises Unsupported, and `native` then hands back the interpreted procedure
+# unchanged.
+#
+# Inlining a primitive is decided when the procedure is transpiled, so a later
+# `set` of e.g. `+` isn't seen by native procedures defined before it.
+#
+# Native procedures run on the Python stack, so deep recursion in them is
+# bounded by the recursion limit, tail calls included. Their calls count
+# against a budget and show up in the profiler as anyone else's do.
+
+import ast
+import copy
+from operator import attrgetter
+
+from environments import (
+    Environment, Symbol, primitives, QUOTE, GETHASH, LAMBDA, IF, COND, AND,
+    OR, PROGN, LET,
+)
+import limits
+from macros import Macro
+import profiler
+from pylisp import Procedure
+
+
+class Unsupported(Exception):
+    pass
+
+
+class NativeProcedure(Procedure):
+
+    def __init__(self, arglist, body, parent_env, function):
+        super(NativeProcedure, self).__init__(arglist, body, parent_env)
+        self.function = function
+
+    # The generated function counts and reports its own calls (see PROLOGUE)
+    traced = True
+
+    # Calling the instance calls the generated function directly, without
+    # an extra Python-level frame in between.
+    __call__ = property(attrgetter('function'))
+
+
+binary_operators = {
+    '-': ast.Sub,
+    '*': ast.Mult,
+    '/': ast.Div,
+    '^': ast.Pow,
+    '%': ast.Mod,
+}
+
+comparisons = {
+    '<': ast.Lt,
+    '>': ast.Gt,
+    '<=': ast.LtE,
+    '>=': ast.GtE,
+    '=': ast.Eq,
+}
+
+# Closure variables of the generated factory function
+ENV, CONSTS, NONES = '__env__', '__consts__', '__nones__'
+LIMITS, PROFILER, PROC = '__limits__', '__profiler__', '__proc__'
+
+# What a native procedure does before its body, as the engines do for each
+# call: spend a step of any budget (see limits.py) and, while profiling, run
+# the body (a copy of it in __body__) as a reported call
+PROLOGUE = '''
+def native({args}):
+    __limits__.local.fuel -= 1
+    if not __limits__.local.fuel:
+        __limits__.refuel()
+    if __profiler__.active:
+        return __profiler__.call(__proc__[0], __body__, {args})
+'''
+
+
+# Python 2's ast wants identifiers as byte strings, not unicode
+
+def load(name):
+    return ast.Name(id=str(name), ctx=ast.Load())
+
+
+def param(name):
+    return ast.Name(id=str(name), ctx=ast.Param())
+
+
+def arguments(names):
+    return ast.arguments(args=[param(n) for n in names], vararg=None,
+                         kwarg=None, defaults=[])
+
+
+class Transpiler(object):
+
+    def __init__(self, genv):
+        self.genv = genv
+        self.consts = []
+        self.nlocals = 0
+
+    def new_local(self):
+        self.nlocals += 1
+        return 'v{}'.format(self.nlocals)
+
+    def is_primitive(self, name, scope):
+        if name in scope or name not in primitives:
+            return False
+        try:
+            return self.genv[name] is primitives[name]
+        except ValueError:
+            return False
+
+    def is_macro(self, name, scope):
+        if name in scope:
+            return False
+        try:
+            return isinstance(self.genv[name], Macro)
+        except ValueError:
+            return False
+
+    def const(self, value):
+        if value is None or value is True or value is False:
+            return load(repr(value))
+        elif isinstance(value, (int, long, float)):
+            return ast.Num(n=value)
+        elif isinstance(value, basestring):
+            return ast.Str(s=value)
+        self.consts.append(value)
+        return ast.Subscript(value=load(CONSTS),
+                             slice=ast.Index(value=ast.Num(
+                                 n=len(self.consts) - 1)),
+                             ctx=ast.Load())
+
+    def symbol(self, sym, scope):
+        name = sym.value
+        if name in scope:
+            return load(scope[name])
+        if self.is_primitive(name, scope) and name in ('True', 'None'):
+            return load(name)
+        return ast.Subscript(value=load(ENV),
+                             slice=ast.Index(value=ast.Str(s=name)),
+                             ctx=ast.Load())
+
+    def sequence(self, exprs, scope):
+        if not exprs:
+            return self.const(None)
+        if len(exprs) == 1:
+            return self.expr(exprs[0], scope)
+        # (a, b, c)[-1]
+        return ast.Subscript(
+            value=ast.Tuple(elts=[self.expr(e, scope) for e in exprs],
+                            ctx=ast.Load()),
+            slice=ast.Index(value=ast.Num(n=-1)), ctx=ast.Load())
+
+    def test(self, expr, scope):
+        # Translate expr where only its truthiness matters
+        if (isinstance(expr, list) and len(expr) == 3 and
+                isinstance(expr[0], Symbol) and
+                expr[0].value in comparisons and
+                self.is_primitive(expr[0].value, scope)):
+            return ast.Compare(left=self.expr(expr[1], scope),
+                               ops=[comparisons[expr[0].value]()],
+                               comparators=[self.expr(expr[2], scope)])
+        return self.expr(expr, scope)
+
+    def expr(self, expr, scope):
+        if isinstance(expr, Symbol):
+            return self.symbol(expr, scope)
+        elif not isinstance(expr, list):
+            return self.const(expr)
+        head = expr[0] if expr else None
+        if head is QUOTE:
+            return self.const(expr[1])
+        elif head is IF:
+            return ast.IfExp(
+                test=self.test(expr[1], scope),
+                body=self.expr(expr[2], scope),
+                orelse=self.expr(expr[3] if len(expr) > 3 else None, scope))
+        elif head is COND:
+            ret = self.const(None)
+            for cond, result in reversed(expr[1:]):
+                ret = ast.IfExp(test=self.test(cond, scope),
+                                body=self.expr(result, scope), orelse=ret)
+            return ret
+        elif head is AND:
+            return self.and_(expr[1:], scope)
+        elif head is OR:
+            return self.or_(expr[1:], scope)
+        elif head is PROGN:
+            return self.sequence(expr[1:], scope)
+        elif head is LET:
+            return self.let(expr, scope)
+        elif head is GETHASH:
+            table = self.expr(expr[2], scope)
+            return ast.Call(func=ast.Attribute(value=table, attr=str('get'),
+                                               ctx=ast.Load()),
+                            args=[self.expr(expr[1], scope)], keywords=[],
+                            starargs=None, kwargs=None)
+        elif isinstance(head, Symbol) and (
+                head in Environment.special_forms or
+                head in Environment.tail_forms or
+                self.is_macro(head.value, scope)):
+            raise Unsupported('{} is not supported'.format(head.value))
+        return self.call(expr, scope)
+
+    def and_(self, exprs, scope):
+        # Each value is tested against None/False, as in Environment.tail_and:
+        # `rest if value not in __nones__ else None`, and the last one is
+        # (lambda t: t if t not in __nones__ else None)(value)
+        if not exprs:
+            return self.const(True)
+        if len(exprs) == 1:
+            tmp = self.new_local()
+            test = ast.Lambda(
+                args=arguments([tmp]),
+                body=ast.IfExp(
+                    test=ast.Compare(left=load(tmp), ops=[ast.NotIn()],
+                                     comparators=[load(NONES)]),
+                    body=load(tmp), orelse=self.const(None)))
+            return ast.Call(func=test, args=[self.expr(exprs[0], scope)],
+                            keywords=[], starargs=None, kwargs=None)
+        return ast.IfExp(
+            test=ast.Compare(left=self.expr(exprs[0], scope),
+                             ops=[ast.NotIn()], comparators=[load(NONES)]),
+            body=self.and_(exprs[1:], scope), orelse=self.const(None))
+
+    def or_(self, exprs, scope):
+        # (lambda t: t if t not in __nones__ else rest)(value)
+        if not exprs:
+            return self.const(None)
+        if len(exprs) == 1:
+            return self.expr(exprs[0], scope)
+        tmp = self.new_local()
+        test = ast.Lambda(
+            args=arguments([tmp]),
+            body=ast.IfExp(
+                test=ast.Compare(left=load(tmp), ops=[ast.NotIn()],
+                                 comparators=[load(NONES)]),
+                body=load(tmp), orelse=self.or_(exprs[1:], scope)))
+        return ast.Call(func=test, args=[self.expr(exprs[0], scope)],
+                        keywords=[], starargs=None, kwargs=None)
+
+    def let(self, expr, scope):
+        # ((lambda v1 v2: body) value1 value2), with no lambdas in the body
+        # that could capture the bindings
+        if contains_lambda(expr[2:]):
+            raise Unsupported('closure under let')
+        inner = dict(scope)
+        names = []
+        for form in expr[1]:
+            names.append(self.new_local())
+            inner[form[0].value] = names[-1]
+        fn = ast.Lambda(args=arguments(names),
+                        body=self.sequence(expr[2:], inner))
+        return ast.Call(func=fn, args=[self.expr(form[1], scope)
+                                       for form in expr[1]],
+                        keywords=[], starargs=None, kwargs=None)
+
+    def call(self, expr, scope):
+        head, args = expr[0], expr[1:]
+        if isinstance(head, Symbol) and self.is_primitive(head.value, scope):
+            name = head.value
+            if name == '+':
+                operands = [self.expr(a, scope) for a in args]
+                if len(operands) < 2:
+                    # sum() semantics
+                    operands.insert(0, ast.Num(n=0))
+                ret = operands[0]
+                for operand in operands[1:]:
+                    ret = ast.BinOp(left=ret, op=ast.Add(), right=operand)
+                return ret
+            elif name in binary_operators and len(args) == 2:
+                return ast.BinOp(left=self.expr(args[0], scope),
+                                 op=binary_operators[name](),
+                                 right=self.expr(args[1], scope))
+            elif name in comparisons and len(args) == 2:
+                # False -> None, as for any primitive call
+                return ast.BoolOp(op=ast.Or(), values=[
+                    self.test(expr, scope), self.const(None)])
+        return ast.Call(func=self.expr(head, scope),
+                        args=[self.expr(a, scope) for a in args],
+                        keywords=[], starargs=None, kwargs=None)
+
+
+def contains_lambda(exprs):
+    for expr in exprs:
+        if isinstance(expr, list) and expr:
+            if expr[0] is QUOTE:
+                continue
+            if expr[0] is LAMBDA:
+                return True
+            if contains_lambda(expr):
+                return True
+    return False
+
+
+def closure_globals(proc):
+    # The global environment of a procedure that closes over nothing else
+    genv = getattr(proc, 'genv', None)
+    if genv is not None:
+        if proc.parent_env is not None:
+            raise Unsupported('closes over local variables')
+        return genv
+    if not isinstance(proc.parent_env, Environment):
+        raise Unsupported('unknown procedure type')
+    if proc.parent_env.parent is not proc.parent_env.base:
+        # The only parent of a global environment is its fork base
+        raise Unsupported('closes over local variables')
+    return proc.parent_env
+
+
+def transpile(proc):
+    if isinstance(proc, NativeProcedure):
+        return proc
+    if not isinstance(proc, Procedure) or proc.body is None:
+        raise Unsupported('{} has no source'.format(proc))
+    genv = closure_globals(proc)
+    transpiler = Transpiler(genv)
+    scope = {}
+    for arg in proc.arglist:
+        scope[arg.value] = transpiler.new_local()
+    body = transpiler.expr(proc.body, scope)
+
+    # def __make__(__env__, __consts__, __nones__, __limits__, ...):
+    #     def __body__(v1, ...):
+    #         return body
+    #     def native(v1, ...):
+    #         PROLOGUE
+    #         return body
+    #     return native
+    names = [scope[a.value] for a in proc.arglist]
+    plain = ast.FunctionDef(
+        name=str('__body__'), args=arguments(names),
+        body=[ast.Return(value=copy.deepcopy(body))], decorator_list=[])
+    inner = ast.parse(PROLOGUE.format(args=', '.join(names))).body[0]
+    inner.body.append(ast.Return(value=body))
+    outer = ast.FunctionDef(
+        name=str('__make__'),
+        args=arguments([ENV, CONSTS, NONES, LIMITS, PROFILER, PROC]),
+        body=[plain, inner, ast.Return(value=load('native'))],
+        decorator_list=[])
+    module = ast.fix_missing_locations(ast.Module(body=[outer]))
+    namespace = {}
+    exec compile(module, '<pylisp native>', 'exec', 0, True) in namespace
+    cell = [None]
+    function = namespace['__make__'](genv, transpiler.consts, (None, False),
+                                     limits, profiler, cell)
+    cell[0] = ret = NativeProcedure(proc.arglist, proc.body, genv, function)
+    return ret
+
+
+def native(proc):
+    try:
+        return transpile(proc)
+    except Unsupported:
+        # Keep running it on the interpreter
+        return proc
@@ -0,0 +1,178 @@
+from __future__ import unicode_literals
+
+# Numeric vectors, stored unboxed in an array.array (or a NumPy array, if
+# NumPy is installed). The arithmetic and comparison primitives work on them
+# element by element -- with a number on either side, it's applied to every
+# element -- since Vector implements the Python operators they're built on.
+# Comparisons give vectors of 1s and 0s.
+#
+# (map proc v ...) over vectors gives a vector, calling an arithmetic
+# primitive just once on the whole vectors, and (reduce + v) and (reduce * v)
+# run in C.
+
+from array import array
+from itertools import imap, repeat
+import operator as op
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Vector(object):
+    __slots__ = ('data',)
+    __hash__ = None
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data if numpy is None else self.tolist())
+
+    def __nonzero__(self):
+        # Like a list: only the empty vector is false
+        return len(self.data) > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # Always a copy, as for a list
+            return Vector(self.data[index] if numpy is None
+                          else self.data[index].copy())
+        return self.data[index] if numpy is None else self.data[index].item()
+
+    def __setitem__(self, index, value):
+        if numpy is None:
+            try:
+                self.data[index] = value
+            except TypeError:
+                if not isinstance(value, float):
+                    raise
+                # A float in an int vector makes it a float vector
+                self.data = array(b'd', self.data)
+                self.data[index] = value
+        else:
+            if isinstance(value, float) and self.data.dtype.kind in 'biu':
+                self.data = self.data.astype(float)
+            self.data[index] = value
+
+    def __repr__(self):
+        return '#({})'.format(' '.join(repr(x) for x in self.tolist()))
+
+    def tolist(self):
+        return self.data.tolist()
+
+    def reduce(self, proc, *initial):
+        from environments import primitives
+
+        if proc is primitives['+']:
+            total = self.data.sum().item() if numpy else sum(self.data)
+            return total + initial[0] if initial else total
+        if proc is primitives['*'] and numpy is not None:
+            product = self.data.prod().item()
+            return product * initial[0] if initial else product
+        return reduce(proc, self, *initial)
+
+
+def from_values(values):
+    if numpy is not None:
+        data = numpy.array(list(values))
+        if data.dtype.kind not in 'biuf':
+            raise TypeError('Vectors can only hold numbers')
+        return Vector(data)
+    values = list(values)
+    try:
+        return Vector(array(b'l', values))
+    except (TypeError, OverflowError):
+        try:
+            return Vector(array(b'd', values))
+        except TypeError:
+            raise TypeError('Vectors can only hold numbers')
+
+
+def elementwise(function, a, b):
+    # Apply function to each pair of elements; a or b may be a number
+    x = a.data if isinstance(a, Vector) else a
+    y = b.data if isinstance(b, Vector) else b
+    if numpy is not None:
+        data = function(x, y)
+        return Vector(data.astype(int) if data.dtype.kind == 'b' else data)
+    if isinstance(a, Vector) and isinstance(b, Vector):
+        if len(x) != len(y):
+            raise ValueError(
+                'Vectors have different lengths: {} and {}'.format(
+                    len(x), len(y)))
+    else:
+        x = x if isinstance(a, Vector) else repeat(x)
+        y = y if isinstance(b, Vector) else repeat(y)
+    return from_values(imap(function, x, y))
+
+
+def binary(function, reflected=False):
+    def method(self, other):
+        # Not bools, so `v in [None, False]` doesn't compare element-wise
+        if (not isinstance(other, (Vector, int, long, float)) or
+                isinstance(other, bool)):
+            return NotImplemented
+        if reflected:
+            return elementwise(function, other, self)
+        return elementwise(function, self, other)
+    return method
+
+
+for name, function in [('add', op.add), ('sub', op.sub), ('mul', op.mul),
+                       ('div', op.div), ('truediv', op.truediv),
+                       ('mod', op.mod), ('pow', op.pow)]:
+    setattr(Vector, str('__{}__'.format(name)), binary(function))
+    setattr(Vector, str('__r{}__'.format(name)), binary(function, True))
+
+for name, function in [('lt', op.lt), ('le', op.le), ('gt', op.gt),
+                       ('ge', op.ge), ('eq', op.eq), ('ne', op.ne)]:
+    setattr(Vector, str('__{}__'.format(name)), binary(function))
+
+
+# Names of the primitives that work on whole vectors at once
+elementwise_primitives = ['+', '-', '*', '/', '%', '^',
+                          '<', '<=', '>', '>=', '=']
+
+
+def map_vectors(proc, vectors):
+    from environments import primitives
+
+    for name in elementwise_primitives:
+        if proc is primitives[name]:
+            return proc(*vectors)
+    results = [proc(*args) for args in zip(*vectors)]
+    try:
+        return from_values(results)
+    except TypeError:
+        # Not all numbers
+        return results
+
+
+def make_vector(n, fill=0):
+    if numpy is not None:
+        return Vector(numpy.full(n, fill))
+    return Vector(from_values([fill]).data * n)
+
+
+def vector_set(vector, index, value):
+    vector[index] = value
+    return value
+
+
+primitives = {
+    'vector': lambda *values: from_values(values),
+    'make-vector': make_vector,
+    'list->vector': from_values,
+    'vector->list': lambda vector: vector.tolist(),
+    'vector?': lambda x: isinstance(x, Vector),
+    'vector-length': len,
+    'vector-ref': lambda vector, index: vector[index],
+    'vector-set': vector_set,
+    'vector-slice': lambda vector, start, stop=None, step=None: vector[
+        start:stop:step],
+}
@@ -0,0 +1,365 @@
+from __future__ import unicode_literals
+
+# Stack machine for the bytecode produced by bytecode.py. Calls between
+# VMProcedures push onto the machine's own call stack rather than Python's,
+# so they don't recurse through the interpreter: recursion, tail or not, goes
+# as deep as memory allows, with no recursion limit to raise. A call costs a
+# Frame and a 4-tuple on that stack, rather than a few Python frames.
+
+import threading
+import weakref
+
+from analyze import Frame, UNBOUND, unbound_error
+from bytecode import (
+    CONST, LOAD_LOCAL, LOAD_GLOBAL, DEFINE_LOCAL, DEFINE_GLOBAL, SET_LOCAL,
+    SET_GLOBAL, LOAD_HASH, STORE_HASH, POP, JUMP, JUMP_IF_FALSE, AND_TEST,
+    OR_TEST, MAKE_CLOSURE, ENTER_LET, LEAVE_LET, CALL, TAIL_CALL, RETURN,
+    MAP_CALL, BUILD_SEQ, SLOT_BITS, SLOT_MASK, compile_toplevel, opnames,
+    recompile_lambda,
+)
+from environments import Environment, Symbol
+from lazy import map_values
+import limits
+from optimize import is_standard, rebound, watch
+import profiler
+from pylisp import Procedure, name_procedure
+from tasks import AsyncPrimitive, Future
+
+
+class VMProcedure(Procedure):
+
+    def __init__(self, code, parent_env, genv):
+        arglist = [Symbol(name) for name in code.argnames]
+        super(VMProcedure, self).__init__(arglist, code.body, parent_env)
+        self.code = code
+        self.genv = genv
+
+    def home(self):
+        # Code doesn't depend on the global environment, so any procedure
+        # made at the top level can be rebound
+        return self.genv if self.parent_env is None else None
+
+    def rebind(self, genv):
+        if self.code.assumed:
+            return watched_procedure(self.code, None, genv)
+        return VMProcedure(self.code, None, genv)
+
+    def bind(self, args):
+        nslots = self.code.nslots
+        values = list(args)
+        if len(values) != nslots:
+            values = (values + [UNBOUND] * nslots)[:nslots]
+        frame = Frame(values)
+        frame.parent = self.parent_env
+        return frame
+
+    def __call__(self, *args):
+        limits.spend()
+        if profiler.active:
+            return profiler.call(self, run, self.code, self.bind(args),
+                                 self.genv, True)
+        return run(self.code, self.bind(args), self.genv)
+
+
+class VMEnvironment(Environment):
+
+    # Code objects are plain data, so the cache can hold them. The opcode
+    # table is part of the tag, so renumbering opcodes invalidates old files.
+    cache_tag = 'vm ' + ' '.join(opnames)
+    compile_expands_macros = True
+    compile = staticmethod(compile_toplevel)
+    # Code -> (generation, Code compiled again for this environment), for
+    # code with something folded into it that a set has made stale here
+    recompiled = None
+
+    def execute(self, compiled):
+        if local.evaluating:
+            # Part of the evaluation already going, e.g. through eval
+            return run(compiled, None, self)
+        local.evaluating = True
+        local.max_depth = 0
+        try:
+            return run(compiled, None, self)
+        finally:
+            local.evaluating = False
+
+    def eval(self, expr):
+        return self.execute(compile_toplevel(expr, self))
+
+
+def frame_at(frame, addr):
+    for _ in xrange(addr >> SLOT_BITS):
+        frame = frame.parent
+    return frame
+
+
+def pop_n(stack, n):
+    if not n:
+        return []
+    values = stack[-n:]
+    del stack[-n:]
+    return values
+
+
+def current_code(code, genv):
+    # code, or if a name folded into it doesn't mean the primitive in genv,
+    # code compiled again for genv
+    if all(is_standard(name, genv) for name in code.assumed):
+        return code
+    recompiled = getattr(genv, 'recompiled', None)
+    if recompiled is None:
+        recompiled = genv.recompiled = weakref.WeakKeyDictionary()
+    latest = recompiled.get(code)
+    if latest is None or latest[0] != genv.generation:
+        latest = recompiled[code] = (genv.generation,
+                                     recompile_lambda(code, genv))
+    return latest[1]
+
+
+def watched_procedure(code, frame, genv):
+    proc = VMProcedure(current_code(code, genv), frame, genv)
+    watch(proc, proc.code.assumed, refresh)
+    return proc
+
+
+def refresh(proc):
+    proc.code = current_code(proc.code, proc.genv)
+    proc.body = proc.code.body
+    return proc.code.assumed
+
+
+def profile_thunk(proc, path=None):
+    # (profile expr [path]), with expr compiled as the body of proc
+    return profiler.profile_form(
+        lambda: run(proc.code, proc.bind(()), proc.genv), path)
+
+
+class State(threading.local):
+    # Per thread: the deepest the call stack has been since its last
+    # evaluation began, and whether one is going
+    max_depth = 0
+    evaluating = False
+
+
+local = State()
+
+
+def max_depth():
+    return local.max_depth
+
+
+# What run returns when it suspends a task
+SUSPENDED = object()
+
+
+def run(code, frame, genv, entered=False, task=None):
+    # While profiling, calls between VMProcedures are reported here. entered
+    # means the caller reported this one, so a tail call from the bottom of
+    # the call stack replaces it; opened, that the bottom one was reported
+    # here and has to be closed here.
+    #
+    # task is the tasks.Task this run belongs to, if any. Every task.slice
+    # procedure calls, or when an AsyncPrimitive returns a Future, the run
+    # saves its registers in task.state and returns SUSPENDED; running it
+    # again with the same task picks up from there.
+    max_depth = 0
+    if task is None or task.state is None:
+        stack = []
+        calls = []
+        opened = False
+        pc = 0
+        resumed = None
+    else:
+        (stack, calls, opened, entered, code, pc, frame, genv,
+         resumed) = task.state
+        task.state = None
+    instrs, consts, names = code.code, code.consts, code.names
+    # Procedure calls left before the budget is checked (see limits.py) or,
+    # for a task, before yielding if that's sooner; `given` is what fuel
+    # started at, and `left` what's left of the task's slice
+    given = fuel = limits.local.fuel
+    if task is not None:
+        left = task.slice
+        if left < fuel:
+            given = fuel = left
+    if resumed is not None:
+        # The call that suspended (resumed is its opcode) returns what it
+        # was waiting for
+        ret = task.awaited()
+        stack.append(None if ret is False else ret)
+        if resumed == TAIL_CALL:
+            if not calls:
+                return stack.pop()
+            code, pc, frame, genv = calls.pop()
+            instrs, consts, names = code.code, code.consts, code.names
+    while True:
+        op = instrs[pc]
+        arg = instrs[pc + 1]
+        pc += 2
+
+        if op == LOAD_LOCAL:
+            if arg <= SLOT_MASK:
+                val = frame[arg]
+            else:
+                val = frame_at(frame, arg)[arg & SLOT_MASK]
+            if val is UNBOUND:
+                raise unbound_error(code.varnames[arg])
+            stack.append(val)
+        elif op == LOAD_GLOBAL:
+            stack.append(genv[names[arg]])
+        elif op == CONST:
+            stack.append(consts[arg])
+        elif op == JUMP_IF_FALSE:
+            if not stack.pop():
+                pc = arg
+        elif op == CALL or op == TAIL_CALL:
+            if arg:
+                args = stack[-arg:]
+                del stack[-arg:]
+            else:
+                args = []
+            proc = stack.pop()
+            if type(proc) is VMProcedure:
+                if profiler.active:
+                    name = profiler.proc_name(proc)
+                    if op == TAIL_CALL and (calls or entered):
+                        profiler.tail(name)
+                    else:
+                        profiler.enter(name)
+                        if op == TAIL_CALL:
+                            entered = opened = True
+                if op == CALL:
+                    calls.append((code, pc, frame, genv))
+                    if len(calls) > max_depth:
+                        max_depth = len(calls)
+                        if max_depth > local.max_depth:
+                            local.max_depth = max_depth
+                code, genv = proc.code, proc.genv
+                if arg == code.nslots:
+                    frame = Frame(args)
+                    frame.parent = proc.parent_env
+                else:
+                    frame = proc.bind(args)
+                instrs, consts, names = code.code, code.consts, code.names
+                pc = 0
+                fuel -= 1
+                if not fuel:
+                    limits.spend(given, len(calls))
+                    if task is not None:
+                        left -= given
+                        if not left:
+                            task.state = (stack, calls, opened, entered, code,
+                                          pc, frame, genv, None)
+                            return SUSPENDED
+                    given = fuel = limits.local.fuel
+                    if task is not None and left < fuel:
+                        given = fuel = left
+                continue
+            if type(proc) is AsyncPrimitive and task is not None:
+                ret = proc.function(*args)
+                if isinstance(ret, Future):
+                    limits.spend(given - fuel)
+                    task.awaiting = ret
+                    task.state = (stack, calls, opened, entered, code, pc,
+                                  frame, genv, op)
+                    return SUSPENDED
+            else:
+                ret = (profiler.apply(proc, args) if profiler.active
+                       else proc(*args))
+            if ret is False:
+                # Lisp!
+                ret = None
+            stack.append(ret)
+            if op == TAIL_CALL:
+                if not calls:
+                    if opened:
+                        profiler.leave()
+                    limits.spend(given - fuel)
+                    return stack.pop()
+                if profiler.active:
+                    profiler.leave()
+                code, pc, frame, genv = calls.pop()
+                instrs, consts, names = code.code, code.consts, code.names
+        elif op == RETURN:
+            if not calls:
+                if opened:
+                    profiler.leave()
+                limits.spend(given - fuel)
+                return stack.pop()
+            if profiler.active:
+                profiler.leave()
+            code, pc, frame, genv = calls.pop()
+            instrs, consts, names = code.code, code.consts, code.names
+        elif op == JUMP:
+            pc = arg
+        elif op == POP:
+            stack.pop()
+        elif op == AND_TEST:
+            if stack[-1] in [None, False]:
+                stack[-1] = None
+                pc = arg
+            else:
+                stack.pop()
+        elif op == OR_TEST:
+            if stack[-1] not in [None, False]:
+                pc = arg
+            else:
+                stack.pop()
+        elif op == LOAD_HASH:
+            key = stack.pop()
+            stack.append(stack.pop().get(key))
+        elif op == STORE_HASH:
+            key = stack.pop()
+            table = stack.pop()
+            table[key] = stack[-1]
+        elif op == ENTER_LET:
+            new_frame = Frame(pop_n(stack, arg))
+            new_frame.parent = frame
+            frame = new_frame
+            if profiler.active:
+                profiler.frame()
+        elif op == LEAVE_LET:
+            frame = frame.parent
+        elif op == MAKE_CLOSURE:
+            sub = consts[arg]
+            stack.append(VMProcedure(sub, frame, genv) if not sub.assumed
+                         else watched_procedure(sub, frame, genv))
+        elif op == DEFINE_GLOBAL:
+            name = names[arg]
+            if genv.defines(name):
+                raise ValueError('{} already defined in environment'.format(
+                    Symbol(name)))
+            genv[name] = stack[-1]
+            name_procedure(stack[-1], name)
+        elif op == DEFINE_LOCAL:
+            target = frame_at(frame, arg)
+            if target[arg & SLOT_MASK] is not UNBOUND:
+                raise ValueError('{} already defined in environment'.format(
+                    Symbol(code.varnames[arg])))
+            target[arg & SLOT_MASK] = stack[-1]
+            name_procedure(stack[-1], code.varnames[arg])
+        elif op == SET_LOCAL:
+            target = frame_at(frame, arg)
+            if target[arg & SLOT_MASK] is UNBOUND:
+                raise ValueError('{} not found in environment'.format(
+                    Symbol(code.varnames[arg])))
+            target[arg & SLOT_MASK] = stack[-1]
+        elif op == SET_GLOBAL:
+            sym = stack.pop()
+            if not isinstance(sym, Symbol):
+                raise TypeError('{} is not a Symbol'.format(sym))
+            if not genv.defines(sym.value):
+                raise ValueError('{} not found in environment'.format(sym))
+            genv[sym.value] = stack[-1]
+            rebound(genv, sym.value)
+        elif op == MAP_CALL:
+            args_list = pop_n(stack, arg)
+            proc = stack.pop()
+            stack.append(map_values(proc, args_list))
+        elif op == BUILD_SEQ:
+            stack.append(range(*pop_n(stack, arg)))
+        else:
+            raise ValueError('Unknown opcode {}'.format(op))
+
+
+limits.nesting_codes.add(run.__code__)
@@ -36,6 +36,11 @@ setup(
     scripts=[
         # 'bin/script1',
     ],
+    entry_points={
+        'console_scripts': [
+            'pylisp = pylisp.cli:main',
+        ],
+    },
     include_package_data=True,
     zip_safe=False,
     install_requires=[
@@ -44,6 +49,7 @@ setup(
     ],
     extras_require={
         'tests': tests_require,
+        'numpy': ['numpy'],
     },
     tests_require=tests_require,
     test_suite='py.test',
@@ -1,5 +1,24 @@
 import pytest
 
+from pylisp import cache, environments
+
+
+@pytest.fixture(autouse=True, scope='session')
+def cache_dir(tmpdir_factory):
+    # Never the user's own cache, whatever PYLISP_CACHE_DIR says
+    previous = cache.cache_dir
+    cache.cache_dir = str(tmpdir_factory.mktemp('cache'))
+    yield cache.cache_dir
+    cache.cache_dir = previous
+
+
+@pytest.fixture(autouse=True, params=['interp', 'analyze', 'vm'])
+def engine(request):
+    environments.default_engine = request.param
+    environments.reset_global_env()
+    yield request.param
+    environments.default_engine = 'interp'
+
 
 @pytest.fixture
 def addition_sexp():
@@ -48,17 +67,13 @@ def memoized_fib_sexp():
                         (+ (memo-fib (- x 1)) (memo-fib (- x 2)))))))))'''
 
 
+@pytest.fixture
 def memoize_sexp():
-    return """(defmacro memoize (func)
-                `(let ((memo (make-hash-table)))
-                   (if (gethash x 'memo) (gethash x 'memo)
-                     (setf (gethash x 'memo) ,(func x)))))))"""
-
-pass
-
-'''
-(memoize
-  (define fib (lambda (x)
-    (if (< x 2) x
-      (+ (fib (- x 1)) (fib (- x 2)))))))
-'''
+    # Memoization written into the procedure itself, with no wrapper to call
+    return """(defmacro define-memo (name arg body)
+                (let ((memo (gensym)))
+                  `(progn
+                     (define ,memo (make-hash-table))
+                     (define ,name (lambda (,arg)
+                       (if (gethash ,arg ,memo) (gethash ,arg ,memo)
+                         (set (gethash ,arg ,memo) ,body)))))))"""
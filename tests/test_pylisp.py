@@ -1,7 +1,24 @@
+import io
+import pickle
+import threading
+import time
+import weakref
+
 import pytest
 
 from pylisp import tokenize, parse, Symbol, Procedure, global_parse_and_eval
-from pylisp.environments import reset_global_env
+from pylisp import benchmark, cache, cli, environments, memo, parallel
+from pylisp import optimize, profiler, server, tasks, vm
+from pylisp.bytecode import compile_toplevel, disassemble
+from pylisp.environments import reset_global_env, std_environment
+from pylisp.limits import Budget, LimitExceeded
+from pylisp.optimize import optimize_lambda
+from pylisp.read import Reader, read_forms
+from pylisp.repl import eval_loop
+from pylisp.server import Client, RemoteError, make_server
+from pylisp.tasks import AsyncPrimitive, Future, Loop
+from pylisp.transpile import NativeProcedure
+from pylisp.vm import run
 
 
 class PylispTestCase(object):
@@ -22,13 +39,12 @@ class TestTokenize(PylispTestCase):
     def test_tokenize_string(self):
         assert len(tokenize('"This is a single string"')) == 7
 
-    @pytest.mark.xfail
     def test_tokenize_backquote(self):
-        pass
+        assert tokenize('`(a b)') == ['`', '(', 'a', 'b', ')']
 
-    @pytest.mark.xfail
     def test_tokenize_comma_in_macro(self):
-        pass
+        assert tokenize('`(a ,b ,@c)') == [
+            '`', '(', 'a', ',', 'b', ',@', 'c', ')']
 
 
 class TestParse(PylispTestCase):
@@ -56,6 +72,146 @@ class TestParse(PylispTestCase):
         parsed = parse('aSymbol')
         assert isinstance(parsed, Symbol)
 
+    def test_symbols_interned(self):
+        parsed = parse('(aSymbol aSymbol other)')
+        assert parsed[0] is parsed[1]
+        assert parsed[0] is parse('aSymbol')
+        assert parsed[0] is Symbol('aSymbol')
+        assert parsed[0] is not parsed[2]
+        assert {parsed[0]: 1}[parse('aSymbol')] == 1
+
+    def test_symbols_released(self):
+        kept = parse('kept-symbol')
+        parse('(unused-symbol-1 unused-symbol-2)')
+        assert 'unused-symbol-1' not in environments.symbol_table
+        assert parse('kept-symbol') is kept
+
+    def test_symbols_unpickle_interned(self):
+        sym = parse('aSymbol')
+        assert pickle.loads(pickle.dumps(sym, 2)) is sym
+
+
+class TestReader(PylispTestCase):
+    source = '''(define f (lambda (x) (* x 2)))
+                'quoted-symbol
+                "a  (string)\\" here"
+                (f '(1 2.5 "three"))
+                last'''
+
+    def test_read_forms(self):
+        forms = list(read_forms(self.source))
+        assert len(forms) == 5
+        assert forms[0] == parse('(define f (lambda (x) (* x 2)))')
+        assert forms[1] == [Symbol('quote'), Symbol('quoted-symbol')]
+        assert forms[2] == 'a  (string)" here'
+        assert forms[3][1][1] == [1, 2.5, 'three']
+        assert forms[4] is Symbol('last')
+
+    def test_chunked(self):
+        expected = list(read_forms(self.source))
+        for size in [1, 2, 3, 7, 50]:
+            chunks = [self.source[i:i + size]
+                      for i in range(0, len(self.source), size)]
+            assert list(read_forms(chunks)) == expected
+
+    def test_file(self):
+        stream = io.BytesIO(u'(list "caf\u00e9" 1)'.encode('utf-8'))
+        # Splits the two bytes of the e-acute
+        assert list(read_forms(stream, chunk_size=11)) == [
+            [Symbol('list'), u'caf\u00e9', 1]]
+
+    def test_feed(self):
+        reader = Reader()
+        assert reader.feed('(a (b') == []
+        assert reader.depth == 2
+        assert reader.feed(' c)) (d') == [parse('(a (b c))')]
+        assert reader.feed(' "e)') == []
+        assert reader.in_string
+        assert reader.feed('")') == [[Symbol('d'), 'e)']]
+        assert reader.idle
+
+    def test_quasiquote(self):
+        expected = parse('(quasiquote (a (unquote b) (unquote-splicing c)))')
+        assert parse('`(a ,b ,@c)') == expected
+        # ,@ split between chunks
+        assert list(read_forms(['`(a ,b ,', '@c)'])) == [expected]
+        with pytest.raises(SyntaxError):
+            parse('(a ,')
+
+    def test_errors(self):
+        with pytest.raises(SyntaxError) as excinfo:
+            list(read_forms('(a b)\n  (c))'))
+        assert 'line 2, column 6' in str(excinfo.value)
+        with pytest.raises(SyntaxError):
+            parse('(a (b)')
+        with pytest.raises(SyntaxError):
+            parse('"abc')
+        with pytest.raises(SyntaxError):
+            parse('(a) (b)')
+        with pytest.raises(SyntaxError):
+            parse('')
+
+
+class TestRepl(PylispTestCase):
+
+    def test_eval_loop(self, capsys):
+        lines = iter(['(define f (lambda (x)',
+                      '  (list x ")(" (quote',
+                      '    y))))',
+                      '(f 1) (f "a',
+                      'b") 3',
+                      '))',
+                      '(+ 1 2)'])
+        prompts = []
+
+        def read_line(prompt):
+            prompts.append(prompt)
+            try:
+                return next(lines)
+            except StopIteration:
+                raise EOFError
+
+        eval_loop(read_line)
+        out = capsys.readouterr()[0]
+        assert 'Error: Unexpected ")"' in out
+        assert '[5]\x1b[0m 3\n' in out
+        assert global_parse_and_eval('f') is not None
+        assert [p.startswith('...') for p in prompts] == [
+            False, True, True, False, True, False, False, False]
+        assert prompts[2].endswith('      ')
+
+
+class TestCommandLine(PylispTestCase):
+
+    def test_files_and_expressions(self, tmpdir, capsys):
+        script = tmpdir.join('script.lisp')
+        script.write('(define sq (lambda (x) (* x x)))\n'
+                     '(sq 4) (list "a b" (quote c) 1.5) "plain"\n'
+                     '(gethash 1 (make-hash-table))\n')
+        assert cli.main([str(script), '-e', '(sq 5)']) == 0
+        assert capsys.readouterr()[0] == '16\n("a b" c 1.5)\nplain\n25\n'
+        assert cli.main(['-q', '-e', '(sq 6)']) == 0
+        assert capsys.readouterr()[0] == ''
+
+    def test_interleaved(self, tmpdir, capsys):
+        first = tmpdir.join('a.lisp')
+        first.write('(define a 1)\n')
+        second = tmpdir.join('b.lisp')
+        second.write('(+ a b)\n')
+        assert cli.main([str(first), '-e', '(+ a 1)', '-e', '(define b 2)',
+                         str(second), '-e', '(+ a b 3)']) == 0
+        assert capsys.readouterr()[0] == '2\n3\n6\n'
+        with pytest.raises(SystemExit):
+            cli.main([str(first), '-e', '(+ a 1)', str(second), '--bogus'])
+
+    def test_errors(self, capsys):
+        assert cli.main(['-e', '(fib 10) (nope)', '-e', '(fib 11)']) == 1
+        out, err = capsys.readouterr()
+        assert out == '55\n'
+        assert 'nope' in err
+        assert cli.main(['-e', '(+ 1']) == 1
+        assert 'SyntaxError' in capsys.readouterr()[1]
+
 
 class TestEval(PylispTestCase):
     def test_eval_addition(self, addition_sexp):
@@ -135,6 +291,64 @@ class TestEnvironments(PylispTestCase):
         assert global_parse_and_eval('(a 10)') == 10
         assert global_parse_and_eval('(b 10)') == 10
 
+    def test_let_closures(self):
+        global_parse_and_eval('''(let ((step 2) (count 0))
+                                   (define counter (lambda ()
+                                       (progn (set 'count (+ count step))
+                                              count)))
+                                   (define get-step (lambda () step)))''')
+        assert global_parse_and_eval('(counter)') == 2
+        assert global_parse_and_eval('(counter)') == 4
+        assert global_parse_and_eval('(get-step)') == 2
+        with pytest.raises(ValueError):
+            global_parse_and_eval('step')
+        # Defined in the procedure, not the let
+        global_parse_and_eval('''(define outer (lambda (x)
+                                   (progn (let ((y (* x 2)))
+                                            (define inner (lambda () y)))
+                                          (inner))))''')
+        assert global_parse_and_eval('(outer 5)') == 10
+
+    def test_globals_shadowed_later(self):
+        # Globals already looked up as such, then bound locally for the first
+        # time
+        global_parse_and_eval('(define glob-p 1)')
+        global_parse_and_eval('(define glob-l 2)')
+        global_parse_and_eval('(define glob-d 3)')
+        global_parse_and_eval(
+            '(define get-globs (lambda () (list glob-p glob-l glob-d)))')
+        assert global_parse_and_eval('(get-globs)') == [1, 2, 3]
+        assert global_parse_and_eval('((lambda (glob-p) glob-p) 4)') == 4
+        assert global_parse_and_eval('(let ((glob-l 5)) glob-l)') == 5
+        assert global_parse_and_eval(
+            '((lambda () (progn (define glob-d 6) glob-d)))') == 6
+        assert global_parse_and_eval('(get-globs)') == [1, 2, 3]
+        global_parse_and_eval("(set 'glob-p 7)")
+        assert global_parse_and_eval('(get-globs)') == [7, 2, 3]
+
+    def test_local_names_released(self):
+        # Once nothing binds or refers to a local name, it's forgotten
+        assert global_parse_and_eval(
+            '((lambda (briefly-local) briefly-local) 1)') == 1
+        assert 'briefly-local' not in environments.symbol_table
+        global_parse_and_eval('(define briefly-local 2)')
+        assert not Symbol('briefly-local').local
+        assert global_parse_and_eval('briefly-local') == 2
+        # Bound from Python
+        env = environments.Environment({'from-python': 3},
+                                       environments.global_env)
+        assert env.eval(parse('from-python')) == 3
+
+    def test_globals_in_forks(self):
+        env = environments.global_env
+        fork = env.fork()
+        env.eval(parse('(define forked-glob 1)'))
+        fork.eval(parse('(define forked-glob 2)'))
+        get = parse('((lambda () forked-glob))')
+        assert env.eval(get) == 1
+        assert fork.eval(get) == 2
+        assert env.fork().eval(get) == 1
+
 
 class TestBuiltin(PylispTestCase):
     def test_and(self):
@@ -146,6 +360,13 @@ class TestBuiltin(PylispTestCase):
         assert global_parse_and_eval('(and (= 2 2) (< 2 1))') == None
         assert (global_parse_and_eval("(and 1 2 'c '(f g))") ==
                 global_parse_and_eval("'(f g)"))
+        # The last value is tested too, wherever the and is
+        assert global_parse_and_eval('(and 1 0)') is None
+        assert global_parse_and_eval('(and 0)') is None
+        global_parse_and_eval('(define zero (lambda () 0))')
+        assert global_parse_and_eval('((lambda () (and 1 (zero))))') is None
+        assert global_parse_and_eval(
+            '((native (lambda (x) (and 1 x))) 0)') is None
 
     def test_or(self):
         assert global_parse_and_eval('(or)') == None
@@ -155,6 +376,8 @@ class TestBuiltin(PylispTestCase):
         assert global_parse_and_eval('(or (= 2 2) (> 2 1))') == True
         assert global_parse_and_eval('(or (= 2 2) (< 2 1))') == True
         assert global_parse_and_eval("(or 1 2 'c '(f g))") == 1
+        assert global_parse_and_eval('(or 0 0)') == 0
+        assert global_parse_and_eval('(or None 0)') == 0
 
     def test_quote(self):
         ret = global_parse_and_eval('(quote (x y z))')
@@ -262,6 +485,38 @@ class TestBuiltin(PylispTestCase):
         assert global_parse_and_eval('(func 2)') == 4
 
 
+class TestTailCalls(PylispTestCase):
+    # Deep enough to blow the Python stack without tail calls
+
+    def test_if(self):
+        global_parse_and_eval('''(define count (lambda (n acc)
+                                   (if (= n 0) acc
+                                     (count (- n 1) (+ acc 1)))))''')
+        assert global_parse_and_eval('(count 10000 0)') == 10000
+
+    def test_cond_progn_let(self):
+        global_parse_and_eval('''(define count (lambda (n acc)
+                                   (cond ((= n 0) acc)
+                                         (True (progn
+                                           (let ((m (- n 1)))
+                                             (count m (+ acc 1))))))))''')
+        assert global_parse_and_eval('(count 10000 0)') == 10000
+
+    def test_and_or(self):
+        global_parse_and_eval('''(define down (lambda (n)
+                                   (or (= n 0)
+                                       (and True (down (- n 1))))))''')
+        assert global_parse_and_eval('(down 10000)') == True
+
+    def test_mutual_recursion(self):
+        global_parse_and_eval('''(define even (lambda (n)
+                                   (if (= n 0) True (odd (- n 1)))))''')
+        global_parse_and_eval('''(define odd (lambda (n)
+                                   (if (= n 0) None (even (- n 1)))))''')
+        assert global_parse_and_eval('(even 10000)') == True
+        assert global_parse_and_eval('(odd 10000)') == None
+
+
 class TestLispBuiltins(PylispTestCase):
 
     def test_zero(self):
@@ -284,6 +539,32 @@ class TestScope(PylispTestCase):
               x))) ''')
         assert global_parse_and_eval("(x '(1 2 3))") == [2, 3, 4]
 
+    def test_nested_scopes(self):
+        assert global_parse_and_eval('''(let ((a 1))
+                                          (let ((b 2))
+                                            (let ((c 3))
+                                              ((lambda (d) (+ a b c d))
+                                               4))))''') == 10
+
+    def test_define_in_procedure_is_local(self):
+        global_parse_and_eval('''(define f (lambda (x)
+                                   (progn (define y (* x 2))
+                                          (+ x y))))''')
+        assert global_parse_and_eval('(f 3)') == 9
+        assert global_parse_and_eval('(f 4)') == 12
+        with pytest.raises(ValueError):
+            global_parse_and_eval('y')
+
+    def test_set_let_variable(self):
+        assert global_parse_and_eval("(let ((n 1)) (set 'n 5) n)") == 5
+
+    def test_bound_by_hand(self):
+        child = environments.Environment(parent=environments.global_env)
+        child['zzq'] = 5
+        assert child.eval(parse('(+ zzq 1)')) == 6
+        with pytest.raises(ValueError):
+            child.eval(parse('zzq-unbound'))
+
 
 class TestClosures(PylispTestCase):
     def test_closure_let_over_define(self):
@@ -341,12 +622,956 @@ class TestHashTables(PylispTestCase):
         assert global_parse_and_eval('(gethash 1 table)') == 8
 
 
+class TestLazy(PylispTestCase):
+
+    @pytest.mark.timeout(1)
+    def test_pipeline(self):
+        global_parse_and_eval('(define odd? (lambda (x) (% x 2)))')
+        assert global_parse_and_eval(
+            '''(force (take 4 (filter odd?
+                 (map (lambda (x) (* x x)) (lazy-seq 0 10000000000)))))'''
+        ) == [1, 9, 25, 49]
+        assert global_parse_and_eval(
+            '(force (take 3 (drop 5 (lazy-map + (count-from 0) '
+            '(count-from 100 10)))))') == [155, 166, 177]
+        assert global_parse_and_eval(
+            '(reduce + (take 100 (count-from 1)))') == 5050
+
+    def test_reiterable(self):
+        global_parse_and_eval('(define s (lazy-map fact (lazy-seq 1 5)))')
+        assert global_parse_and_eval('(force s)') == [1, 2, 6, 24]
+        assert global_parse_and_eval('(force s)') == [1, 2, 6, 24]
+        # map over lists stays eager
+        assert global_parse_and_eval('(map fact (seq 1 5))') == [1, 2, 6, 24]
+
+
+class TestVectors(PylispTestCase):
+
+    def test_access(self):
+        global_parse_and_eval('(define v (list->vector (seq 5)))')
+        assert global_parse_and_eval('(vector? v)')
+        assert global_parse_and_eval('(vector-length v)') == 5
+        assert global_parse_and_eval('(vector-ref v 3)') == 3
+        global_parse_and_eval('(vector-set v 1 1.5)')
+        assert global_parse_and_eval('(vector->list v)') == [0, 1.5, 2, 3, 4]
+        slice_ = global_parse_and_eval('(vector-slice v 1 4 2)')
+        assert slice_.tolist() == [1.5, 3]
+        global_parse_and_eval('(vector-set (vector-slice v 0 2) 0 9)')
+        assert global_parse_and_eval('(vector-ref v 0)') == 0
+        assert global_parse_and_eval('(make-vector 3 7)').tolist() == [7, 7, 7]
+        with pytest.raises(TypeError):
+            global_parse_and_eval('(vector 1 "two")')
+
+    def test_elementwise(self):
+        global_parse_and_eval('(define v (vector 1 2 3 4))')
+        global_parse_and_eval('(define w (vector 4 3 2 1))')
+        for expr, expected in [('(+ v w)', [5, 5, 5, 5]),
+                               ('(- 10 v)', [9, 8, 7, 6]),
+                               ('(* v v)', [1, 4, 9, 16]),
+                               ('(/ v 2.0)', [0.5, 1, 1.5, 2]),
+                               ('(< v w)', [1, 1, 0, 0]),
+                               ('(= v 3)', [0, 0, 1, 0])]:
+            assert global_parse_and_eval(expr).tolist() == expected
+        assert global_parse_and_eval('(and v 1)') == 1
+        with pytest.raises(ValueError):
+            global_parse_and_eval('(+ v (vector 1 2))')
+
+    def test_map_reduce(self):
+        global_parse_and_eval('(define v (vector 1 2 3 4))')
+        assert global_parse_and_eval('(map * v v)').tolist() == [1, 4, 9, 16]
+        assert global_parse_and_eval(
+            '(map (lambda (x) (* x 10)) v)').tolist() == [10, 20, 30, 40]
+        assert global_parse_and_eval("(map (lambda (x) 'a) v)") == [
+            Symbol('a')] * 4
+        assert global_parse_and_eval('(reduce + v)') == 10
+        assert global_parse_and_eval('(reduce * v 2)') == 48
+        assert global_parse_and_eval(
+            '(reduce (lambda (a b) (+ a b 1)) v)') == 13
+
+
+class TestMemoize(PylispTestCase):
+
+    def test_define_memoized(self):
+        global_parse_and_eval('''(define-memoized mfib (lambda (x)
+                                   (if (< x 2) x
+                                     (+ (mfib (- x 1)) (mfib (- x 2))))))''')
+        assert global_parse_and_eval('(mfib 80)') == 23416728348467685
+        stats = global_parse_and_eval('(memo-stats mfib)')
+        assert stats['misses'] == 81
+        assert stats['hits'] == 78
+        assert global_parse_and_eval(
+            '(gethash "size" (memo-stats mfib))') == 81
+
+    def test_lru_eviction(self):
+        global_parse_and_eval(
+            '(define sq (memoize (lambda (x) (* x x)) :max-size 2))')
+        for x in [1, 2, 1, 3, 1, 2]:
+            assert global_parse_and_eval('(sq {})'.format(x)) == x * x
+        # 2 was least recently used when 3 came in
+        stats = global_parse_and_eval('sq').stats()
+        assert (stats['hits'], stats['misses'],
+                stats['evictions']) == (2, 4, 2)
+        global_parse_and_eval('(memo-clear sq)')
+        assert global_parse_and_eval('sq').stats()['size'] == 0
+
+    def test_ttl(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr(memo, 'clock', lambda: now[0])
+        global_parse_and_eval(
+            '(define-memoized f (lambda (x) (+ x 1)) :ttl 10 :max-size None)')
+        global_parse_and_eval('(f 1)')
+        now[0] += 5
+        global_parse_and_eval('(f 1)')
+        now[0] += 10
+        assert global_parse_and_eval('(f 1)') == 2
+        stats = global_parse_and_eval('(memo-stats f)')
+        assert (stats['hits'], stats['misses'],
+                stats['evictions']) == (1, 2, 1)
+
+    def test_errors(self):
+        global_parse_and_eval('(define ident (memoize (lambda (x) x)))')
+        with pytest.raises(TypeError) as excinfo:
+            global_parse_and_eval('(ident (list 1 2))')
+        assert 'unhashable' in str(excinfo.value)
+        with pytest.raises(SyntaxError):
+            global_parse_and_eval('(memoize ident :size 3)')
+
+
+class TestParallelMap(PylispTestCase):
+
+    @pytest.fixture(autouse=True)
+    def shutdown(self):
+        yield
+        parallel.shutdown()
+
+    def test_pmap(self):
+        global_parse_and_eval('(define offset 10)')
+        global_parse_and_eval('''(define f (let ((k 3))
+                                   (lambda (x y) (+ (* k x) y offset))))''')
+        expected = [3 * x + 2 * x + 10 for x in range(50)]
+        assert global_parse_and_eval(
+            '(pmap f (seq 50) (map (lambda (x) (* 2 x)) (seq 50)) '
+            ':workers 3 :chunk-size 4)') == expected
+        assert global_parse_and_eval('(pmap fact (seq 5))') == [0, 1, 2, 6, 24]
+        assert global_parse_and_eval('(pmap fact (list))') == []
+
+    def test_error_reports_item(self):
+        with pytest.raises(parallel.ParallelMapError) as excinfo:
+            global_parse_and_eval(
+                "(pmap (lambda (x) (/ 12 x)) '(1 2 3 0 4) :workers 2 "
+                ":chunk-size 1)")
+        assert excinfo.value.index == 3
+        assert excinfo.value.item == 0
+        assert 'ZeroDivisionError' in str(excinfo.value)
+        with pytest.raises(SyntaxError):
+            global_parse_and_eval('(pmap fact (seq 5) :workers)')
+
+    def test_pool_reused(self):
+        global_parse_and_eval('(define offset 1)')
+        global_parse_and_eval('(define g (lambda (x) (+ x offset)))')
+        source = '(pmap g (seq 4) :workers 2 :chunk-size 1)'
+        assert global_parse_and_eval(source) == [1, 2, 3, 4]
+        pool = parallel.pool
+        assert pool is not None
+        assert global_parse_and_eval(source) == [1, 2, 3, 4]
+        assert parallel.pool is pool
+        # The workers' globals are out of date
+        global_parse_and_eval("(set 'offset 2)")
+        assert global_parse_and_eval(source) == [2, 3, 4, 5]
+        assert parallel.pool is not pool
+        # No forking from other threads
+        parallel.shutdown()
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(global_parse_and_eval(source)))
+        thread.start()
+        thread.join()
+        assert results == [[2, 3, 4, 5]]
+        assert parallel.pool is None
+
+    def test_pool_sees_closures(self):
+        global_parse_and_eval('''(define setk (let ((k 3))
+                                   (define scale (lambda (x) (* k x)))
+                                   (lambda (v) (set 'k v))))''')
+        global_parse_and_eval('(define h (lambda (x) (scale x)))')
+        global_parse_and_eval('(define g (lambda (x) (scale (h x))))')
+        source = '(pmap {} (seq 4) :workers 2 :chunk-size 1)'
+        assert global_parse_and_eval(source.format('g')) == [0, 9, 18, 27]
+        global_parse_and_eval('(setk 10)')
+        assert (global_parse_and_eval(source.format('g')) ==
+                global_parse_and_eval('(map g (seq 4))') ==
+                [0, 100, 200, 300])
+        # Reading globals in from a fork's base doesn't count as a change
+        env = environments.global_env.fork()
+        env.eval(parse('(define f (lambda (x) (* 2 x)))'))
+        assert env.eval(parse(source.format('f'))) == [0, 2, 4, 6]
+        pool = parallel.pool
+        assert env.eval(parse('(fact 5)')) == 120
+        assert env.eval(parse(source.format('f'))) == [0, 2, 4, 6]
+        assert parallel.pool is pool
+
+
+class TestProfiler(PylispTestCase):
+
+    def test_profile(self, capsys):
+        assert global_parse_and_eval('(profile (fib 10))') == 55
+        stats = profiler.last().stats
+        assert stats['fib'][0] == 177
+        assert stats['+'][0] == 88
+        assert stats['fib'][3] <= stats['<profile>'][3]
+        assert 'fib' in capsys.readouterr()[0]
+        assert not profiler.active
+
+    def test_collapsed_stacks(self, tmpdir):
+        path = tmpdir.join('out.folded')
+        global_parse_and_eval(
+            '(define sq (lambda (x) (let ((y x)) (* y y))))')
+        global_parse_and_eval('''(define loop (lambda (n acc)
+                                   (if (= n 0) acc
+                                       (loop (- n 1) (+ acc (sq n))))))''')
+        # Tail calls don't pile up, on the engines' stacks or the profiler's
+        assert global_parse_and_eval(
+            '(profile (loop 5000 0) "{}")'.format(path)) == sum(
+                x * x for x in range(5001))
+        stats = profiler.last().stats
+        assert stats['loop'][:2] == [5001, 5001]
+        assert stats['sq'][:2] == [5000, 10000]
+        stacks = dict(line.rsplit(' ', 1) for line in
+                      path.read().splitlines())
+        assert set(stacks) >= {'<profile>;loop', '<profile>;loop;sq',
+                               '<profile>;loop;sq;*'}
+        assert not any(';loop;loop' in stack for stack in stacks)
+
+    def test_errors_end_profile(self):
+        with pytest.raises(ZeroDivisionError):
+            global_parse_and_eval('(profile (/ 1 0))')
+        assert not profiler.active
+        assert global_parse_and_eval('(fib 10)') == 55
+
+    def test_threads(self):
+        global_parse_and_eval('''(define down (lambda (n)
+                                   (if (= n 0) 0 (down (- n 1)))))''')
+        results = []
+
+        def unprofiled():
+            # Still gets its tail calls
+            results.append(global_parse_and_eval('(down 5000)'))
+
+        def profiled():
+            results.append(profiler.profile(global_parse_and_eval, '(fib 10)'))
+            results.append(profiler.last().stats['fib'][0])
+
+        def run():
+            for target in [unprofiled, profiled]:
+                thread = threading.Thread(target=target)
+                thread.start()
+                thread.join()
+            # The other thread's profile ending doesn't end this one
+            return global_parse_and_eval('(fib 5)')
+
+        assert profiler.profile(run) == 5
+        assert results == [0, 55, 177]
+        assert profiler.last().stats['fib'][0] == 15
+        assert not profiler.active
+
+
+class TestBenchmarks(PylispTestCase):
+
+    def test_measure(self, engine):
+        for name in ['read', 'closures', 'hash-tables']:
+            result = benchmark.measure(benchmark.benchmarks[name], engine,
+                                       repeat=1, min_time=0.001)
+            assert result['ops_per_sec'] > 0
+            assert result['peak_kb'] >= 0
+
+    def test_compare(self):
+        baseline = {'fib/vm': {'ops_per_sec': 1000.0, 'peak_kb': 1000},
+                    'map/vm': {'ops_per_sec': 1000.0, 'peak_kb': 1000}}
+        results = {'fib/vm': {'ops_per_sec': 950.0, 'peak_kb': 1100},
+                   'map/vm': {'ops_per_sec': 800.0, 'peak_kb': 4000},
+                   'new/vm': {'ops_per_sec': 1.0, 'peak_kb': 1}}
+        regressions = benchmark.compare(results, baseline)
+        assert len(regressions) == 2
+        assert all(r.startswith('map/vm') for r in regressions)
+        assert benchmark.compare(results, baseline, threshold=0.5) == [
+            regressions[1]]
+
+
+class TestBytecode(PylispTestCase):
+
+    def test_disassemble(self):
+        code = compile_toplevel(parse('''(define count (lambda (n acc)
+                                           (if (= n 0) acc
+                                             (count (- n 1) (+ acc 1)))))'''))
+        listing = disassemble(code)
+        assert 'DEFINE_GLOBAL' in listing
+        assert 'count (n acc)' in listing
+        assert 'depth 0, slot 1' in listing
+        assert 'TAIL_CALL' in listing
+
+    def test_code_pickles(self):
+        env = std_environment('vm')
+        code = compile_toplevel(parse('(let ((x 6)) (* x (fact 3)))'))
+        assert run(pickle.loads(pickle.dumps(code, 2)), None, env) == 36
+        code = compile_toplevel(parse("'(x y)"))
+        assert run(pickle.loads(pickle.dumps(code, 2)), None, env) == [
+            Symbol('x'), Symbol('y')]
+
+    def test_deep_recursion(self):
+        # Far past Python's recursion limit
+        env = std_environment('vm')
+        env.eval(parse('''(define sumto (lambda (x)
+                             (if (< x 1) 0 (+ x (sumto (- x 1))))))'''))
+        assert env.eval(parse('(sumto 20000)')) == 200010000
+        assert vm.max_depth() == 20000
+        # Each evaluation starts afresh
+        assert env.eval(parse('(sumto 10)')) == 55
+        assert vm.max_depth() == 10
+
+
+class TestSnapshots(PylispTestCase):
+
+    def test_forks_are_isolated(self):
+        base = std_environment().snapshot()
+        one, two = base.fork(), base.fork()
+        one.eval(parse('(define x 1)'))
+        one.eval(parse("(set 'fact 5)"))
+        assert one.eval(parse('x')) == 1
+        with pytest.raises(ValueError):
+            two.eval(parse('x'))
+        assert one.eval(parse('fact')) == 5
+        assert two.eval(parse('(fact 5)')) == 120
+        assert isinstance(base['fact'], Procedure)
+
+    def test_fork_sees_base_definitions(self):
+        base = std_environment().snapshot()
+        env = base.fork()
+        with pytest.raises(ValueError):
+            env.eval(parse('(define fib 1)'))
+        # A snapshot of a fork layers on top of the original base
+        env.eval(parse('(define sq (lambda (x) (* x x)))'))
+        env = env.snapshot().fork()
+        assert env.eval(parse('(sq (fib 10))')) == 3025
+
+    def test_fork_rebinds_base_procedures(self):
+        # The base's procedures look up globals in the fork, as if they had
+        # been defined there
+        global_parse_and_eval("(set 'fib (memoize fib))")
+        assert global_parse_and_eval('(fib 24)') == 46368
+        assert global_parse_and_eval('(memo-stats fib)')['hits'] == 22
+        env = std_environment().snapshot().fork()
+        env.eval(parse("(set '< (lambda (a b) True))"))
+        env.eval(parse('(define sq (lambda (x) (* x x)))'))
+        env.eval(parse('(define sq-of (lambda (x) (sq x)))'))
+        # And so do the ones a layered snapshot's fork reads
+        env = env.snapshot().fork()
+        env.eval(parse("(set 'sq (lambda (x) 0))"))
+        assert env.eval(parse('(fact 5)')) == 5
+        assert env.eval(parse('(sq-of 3)')) == 0
+
+    def test_snapshot_is_read_only(self):
+        base = std_environment().snapshot()
+        with pytest.raises(TypeError):
+            base['x'] = 1
+        with pytest.raises(TypeError):
+            base.eval(parse('(define x 1)'))
+
+    def test_reset(self):
+        global_parse_and_eval('(define x 1)')
+        reset_global_env()
+        with pytest.raises(ValueError):
+            global_parse_and_eval('x')
+
+
+class TestCache(PylispTestCase):
+
+    @pytest.fixture(autouse=True)
+    def cache_dir(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(cache, 'cache_dir', str(tmpdir))
+        monkeypatch.setattr(cache, 'loaded', {})
+        return tmpdir
+
+    def test_compile_source(self, cache_dir):
+        env = environments.global_env
+        source = '(define sq (lambda (x) (* x x)))\n(sq 7)'
+        compiled = cache.compile_source(source, type(env))
+        assert len(compiled) == 2
+        assert len(cache_dir.listdir()) == 1
+        # Loaded back from disk, not compiled again
+        cache.clear()
+        assert cache.compile_source(source, type(env)) is not compiled
+        assert cache.eval_source(source, env) == 49
+
+    def test_corrupt_file(self, cache_dir):
+        env = environments.global_env
+        cache.compile_source('(+ 1 2)', type(env))
+        cache_dir.listdir()[0].write('garbage')
+        cache.clear()
+        assert cache.eval_source('(+ 1 2)', env) == 3
+
+    def test_key(self):
+        env_class = type(environments.global_env)
+        key = cache.cache_key('(+ 1 2)', env_class)
+        assert key != cache.cache_key('(+ 1 2)', environments.Snapshot)
+        # A set in one environment doesn't change it for the rest
+        global_parse_and_eval("(set '+ (lambda (a b) (- a b)))")
+        assert key == cache.cache_key('(+ 1 2)', env_class)
+
+    def test_cached_before_set(self):
+        env = environments.global_env
+        source = '(define h (lambda (x) (+ x (+ 1 2))))'
+        cache.compile_source(source, type(env))
+        global_parse_and_eval("(set '+ (lambda (a b) (- a b)))")
+        cache.eval_source(source, env)
+        assert global_parse_and_eval('(h 5)') == 6
+
+    def test_untrusted(self, cache_dir):
+        env_class = type(environments.global_env)
+        cache.compile_source('(+ 1 2)', env_class)
+        key = cache.cache_key('(+ 1 2)', env_class)
+        assert cache.read_cache(key) is not None
+        # Anyone could have written it
+        cache_dir.chmod(0o777)
+        assert cache.read_cache(key) is None
+        cache_dir.chmod(0o700)
+
+    def test_load_file(self, cache_dir):
+        path = cache_dir.join('lib.lisp')
+        path.write('(define double (lambda (x) (* 2 x)))\n'
+                   '(define quad (lambda (x) (double (double x))))\n')
+        cache.precompile([str(path)])
+        # One for each engine
+        assert len(cache_dir.listdir('*.plc')) == 3
+        cache.load_file(str(path), environments.global_env)
+        assert global_parse_and_eval('(quad 3)') == 12
+
+
+class TestNative(PylispTestCase):
+
+    def test_native_fact_fib(self):
+        global_parse_and_eval('''(define nfact (native (lambda (x)
+                                   (if (< x 2) x
+                                     (* x (nfact (- x 1)))))))''')
+        global_parse_and_eval('''(define nfib (native (lambda (x)
+                                   (if (< x 2) x
+                                     (+ (nfib (- x 1)) (nfib (- x 2)))))))''')
+        assert isinstance(global_parse_and_eval('nfact'), NativeProcedure)
+        assert global_parse_and_eval('(nfact 6)') == 720
+        assert global_parse_and_eval('(nfib 15)') == 610
+        assert (global_parse_and_eval("(map nfib '(0 1 2 3 4 5 6))") ==
+                [0, 1, 1, 2, 3, 5, 8])
+
+    def test_native_calls_counted(self):
+        global_parse_and_eval('''(define nfib (native (lambda (x)
+                                   (if (< x 2) x
+                                     (+ (nfib (- x 1)) (nfib (- x 2)))))))''')
+        with Budget(steps=177) as budget:
+            assert global_parse_and_eval('(nfib 10)') == 55
+        assert budget.usage()['steps'] == 177
+        with pytest.raises(LimitExceeded):
+            global_parse_and_eval('(nfib 10)', steps=176)
+        assert profiler.profile(global_parse_and_eval, '(nfib 10)') == 55
+        assert profiler.last().stats['nfib'][0] == 177
+
+    def test_native_forms(self):
+        global_parse_and_eval('''(define f (native (lambda (x table)
+                                   (cond ((= x 0) (and 1 0 2))
+                                         ((= x 1) (or None 0 'sym))
+                                         ((= x 2) (let ((y (* x 10)))
+                                                    (progn 1 (+ x y))))
+                                         ((= x 3) (gethash x table))
+                                         ((= x 4) (= x 5))
+                                         (True '(a b))))))''')
+        assert isinstance(global_parse_and_eval('f'), NativeProcedure)
+        global_parse_and_eval('(define table (make-hash-table))')
+        global_parse_and_eval('(set (gethash 3 table) "three")')
+        for x in range(6):
+            expected = global_parse_and_eval(
+                '((lambda (x table) (cond ((= x 0) (and 1 0 2)) '
+                "((= x 1) (or None 0 'sym)) "
+                '((= x 2) (let ((y (* x 10))) (progn 1 (+ x y)))) '
+                '((= x 3) (gethash x table)) ((= x 4) (= x 5)) '
+                "(True '(a b)))) {} table)".format(x))
+            assert global_parse_and_eval('(f {} table)'.format(x)) == expected
+
+    def test_unsupported_falls_back(self):
+        global_parse_and_eval('''(define adder (native (lambda (x)
+                                   (lambda (y) (+ x y)))))''')
+        global_parse_and_eval('''(define counter (native (lambda (x)
+                                   (progn (define y x) y))))''')
+        global_parse_and_eval('''(define closed (let ((z 3))
+                                   (native (lambda (x) (+ x z)))))''')
+        global_parse_and_eval("(defmacro sq (y) `(* ,y ,y))")
+        global_parse_and_eval('(define squared (native (lambda (y) (sq y))))')
+        global_parse_and_eval("(define listed (native (lambda (y) `(a ,y))))")
+        assert global_parse_and_eval('(squared 3)') == 9
+        assert global_parse_and_eval('(listed 3)') == [Symbol('a'), 3]
+        for name in ['adder', 'counter', 'closed', 'squared', 'listed']:
+            proc = global_parse_and_eval(name)
+            assert isinstance(proc, Procedure)
+            assert not isinstance(proc, NativeProcedure)
+        assert global_parse_and_eval('((adder 1) 2)') == 3
+        assert global_parse_and_eval('(counter 4)') == 4
+        assert global_parse_and_eval('(closed 4)') == 7
+
+
 class TestMacros(PylispTestCase):
 
-    @pytest.mark.xfail
-    def test_macro_expansion(self):
-        pass
+    def test_quasiquote(self):
+        global_parse_and_eval('(define x 5)')
+        assert global_parse_and_eval(
+            '`(a ,x ,@(list 1 2) (b ,(+ x 1)))') == parse('(a 5 1 2 (b 6))')
+        assert global_parse_and_eval("`(1 ,@'() 2)") == [1, 2]
+        assert global_parse_and_eval('`(a `(b ,(c ,x)))') == parse(
+            '(a (quasiquote (b (unquote (c 5)))))')
 
-    @pytest.mark.xfail
-    def test_gensyms(self):
-        pass
+    def test_macro_expansion(self):
+        global_parse_and_eval(
+            '(defmacro unless (c &rest body) `(if ,c None (progn ,@body)))')
+        global_parse_and_eval('(define f (lambda (x) (unless (< x 0) 1 x)))')
+        assert global_parse_and_eval('(f 3)') == 3
+        assert global_parse_and_eval('(f -1)') is None
+        # A local of the same name isn't the macro
+        global_parse_and_eval('(define g (lambda (unless) (unless 2)))')
+        assert global_parse_and_eval('(g (lambda (y) (* y 10)))') == 20
+
+    def test_expanded_once(self):
+        global_parse_and_eval('(define counts (make-hash-table))')
+        global_parse_and_eval('(set (gethash 0 counts) 0)')
+        global_parse_and_eval("""(defmacro twice (x)
+                                   (progn (set (gethash 0 counts)
+                                               (+ 1 (gethash 0 counts)))
+                                          `(* 2 ,x)))""")
+        global_parse_and_eval('(define f (lambda (x) (+ (twice x) 1)))')
+        assert [global_parse_and_eval('(f {})'.format(x))
+                for x in range(5)] == [1, 3, 5, 7, 9]
+        assert global_parse_and_eval('(gethash 0 counts)') == 1
+
+    def test_expansion_kept_on_form(self):
+        global_parse_and_eval('(define counts (make-hash-table))')
+        global_parse_and_eval('(set (gethash 0 counts) 0)')
+        global_parse_and_eval("""(defmacro twice (x)
+                                   (progn (set (gethash 0 counts)
+                                               (+ 1 (gethash 0 counts)))
+                                          `(* 2 ,x)))""")
+        global_parse_and_eval('(defmacro quad (x) `(twice (twice ,x)))')
+        # The macro calls in an expansion are expanded once too
+        global_parse_and_eval('(define g (lambda (x) (quad x)))')
+        assert [global_parse_and_eval('(g {})'.format(x))
+                for x in range(3)] == [0, 4, 8]
+        assert global_parse_and_eval('(gethash 0 counts)') == 2
+        form = parse('(quad 3)')
+        assert environments.global_env.eval(form) == 12
+        assert form.expansion[1] == parse('(twice (twice 3))')
+        # and goes when the form does
+        ref = weakref.ref(form)
+        del form
+        assert ref() is None
+
+    def test_gensyms(self, memoize_sexp):
+        global_parse_and_eval(memoize_sexp)
+        global_parse_and_eval("""(define-memo mfib x
+                                   (if (< x 2) x
+                                     (+ (mfib (- x 1)) (mfib (- x 2)))))""")
+        global_parse_and_eval('(define-memo sq x (* x x))')
+        assert global_parse_and_eval('(mfib 80)') == 23416728348467685
+        assert global_parse_and_eval('(sq 12)') == 144
+        assert (global_parse_and_eval('(gensym)') is not
+                global_parse_and_eval('(gensym)'))
+
+    def test_defines_in_expansion(self):
+        global_parse_and_eval(
+            '(defmacro defsq (name) `(define ,name (lambda (y) (* y y))))')
+        global_parse_and_eval(
+            '(define f (lambda (z) (progn (defsq sq2) (sq2 z))))')
+        assert global_parse_and_eval('(f 7)') == 49
+        with pytest.raises(ValueError):
+            global_parse_and_eval('sq2')
+
+    def test_source_with_macros(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(cache, 'cache_dir', str(tmpdir))
+        source = """(defmacro inc (x) `(+ ,x 1))
+                    (define three (inc 2))"""
+        assert cache.eval_source(source, environments.global_env) == 3
+        assert cache.eval_source('(inc three)',
+                                 environments.global_env) == 4
+
+    def test_cached_without_macros(self, tmpdir, monkeypatch):
+        # What was compiled where there were no macros isn't used where
+        # there are
+        monkeypatch.setattr(cache, 'cache_dir', str(tmpdir))
+        env = std_environment()
+        cache.compile_source('(twice 21)', type(env))
+        env.eval(parse('(defmacro twice (x) `(* 2 ,x))'))
+        assert cache.eval_source('(twice 21)', env) == 42
+
+
+class TestOptimizer(PylispTestCase):
+
+    def optimized(self, source):
+        return optimize_lambda(parse(source), lambda name: False,
+                               environments.global_env)
+
+    def test_folding(self):
+        assert (self.optimized('(lambda (x) (* x (* 60 (* 60 24))))') ==
+                parse('(* x 86400)'))
+        assert self.optimized("(lambda () (+ '2 3.5))") == 5.5
+        assert self.optimized('(lambda () (< 2 1))') is None
+        # Errors are left for run time
+        assert self.optimized('(lambda () (/ 1 0))') == parse('(/ 1 0)')
+        # Not the primitives
+        assert self.optimized('(lambda (+) (+ 1 2))') == parse('(+ 1 2)')
+        assert (self.optimized('(lambda () (let ((* +)) (* 2 3)))') ==
+                parse('(let ((* +)) (* 2 3))'))
+
+    def test_pruning(self):
+        assert self.optimized('(lambda (a b) (if True a b))') is Symbol('a')
+        assert self.optimized('(lambda (a) (if (= 1 2) a))') is None
+        assert self.optimized('''(lambda (a b)
+                                   (cond ((< 2 1) a) ((> a 0) b) (True 7)
+                                         (a b)))''') == parse(
+            '(cond ((> a 0) b) (True 7))')
+        assert self.optimized(
+            "(lambda (a b) (progn 1 a (progn b (a)) '5))") == parse(
+                '(progn a b (a) 5)')
+
+    def test_stats(self, monkeypatch):
+        monkeypatch.setattr(optimize, 'stats', {'procedures': 0, 'removed': 0})
+        self.optimized('(lambda (a b) (if True a (+ 1 2)))')
+        assert optimize.stats == {'procedures': 1, 'removed': 7}
+
+    def test_optimized_procedures(self):
+        global_parse_and_eval(
+            '(define days (lambda (n) (* n (* 60 (* 60 24)))))')
+        assert global_parse_and_eval('(days 2)') == 172800
+        global_parse_and_eval("(defmacro form-of (x) `(quote ,x))")
+        global_parse_and_eval('(define f (lambda () (form-of (+ 1 2))))')
+        assert global_parse_and_eval('(f)') == parse('(+ 1 2)')
+
+    def test_optimized_once(self):
+        make = parse('(lambda () (lambda (x) (* x (* 60 60))))')
+        outer = environments.global_env.eval(make)
+        first, second = outer(), outer()
+        assert first.body == parse('(* x 3600)')
+        assert first.body is second.body
+        # What's kept goes with the form
+        ref = weakref.ref(make)
+        del make, outer, first, second
+        assert ref() is None
+
+    def test_redefined_primitive(self):
+        global_parse_and_eval("(set '* (lambda (a b) (- a b)))")
+        global_parse_and_eval('(define g (lambda () (* 5 3)))')
+        assert global_parse_and_eval('(g)') == 2
+
+    def test_redefined_after(self):
+        global_parse_and_eval('(define h (lambda (x) (+ x (+ 1 2))))')
+        global_parse_and_eval('(define k (lambda () (lambda () (* 5 3))))')
+        global_parse_and_eval('(define k1 (k))')
+        assert global_parse_and_eval('(h 1)') == 4
+        assert global_parse_and_eval('(k1)') == 15
+        global_parse_and_eval("(set '+ (lambda (a b) (- a b)))")
+        # Built before the set, and made afterwards
+        assert global_parse_and_eval('(h 5)') == 6
+        global_parse_and_eval("(set '* (lambda (a b) (- a b)))")
+        assert global_parse_and_eval('(k1)') == 2
+        assert global_parse_and_eval('((k))') == 2
+
+    def test_redefined_apart(self):
+        other = environments.global_env.base.fork()
+        source = '(define h (lambda (x) (+ x (* 2 3))))'
+        global_parse_and_eval(source)
+        other.eval(parse(source))
+        body = other.eval(parse('h')).body
+        assert body == parse('(+ x 6)')
+        global_parse_and_eval("(set '* (lambda (a b) (- a b)))")
+        assert global_parse_and_eval('(h 1)') == 0
+        assert other.eval(parse('(h 1)')) == 7
+        # Not optimized again for the other environment's set
+        assert other.eval(parse('h')).body is body
+        assert other.generation == 0
+
+
+class TestTasks(PylispTestCase):
+
+    def session(self, loop, log):
+        def lookup(x):
+            future = Future()
+            loop.call_later(0.01, future.set_result, x * 10)
+            return future
+
+        env = tasks.session()
+        env['lookup'] = AsyncPrimitive(lookup)
+        env['note'] = log.append
+        return env
+
+    def test_concurrent(self):
+        loop = Loop()
+        log = []
+        slow = tasks.evaluate(
+            '(note "slow") (define v (fib 15)) (note "done") v',
+            self.session(loop, log), loop, 100)
+        waits = tasks.evaluate(
+            '(note "waits") (define r (+ (lookup 1) (lookup 2))) (note r) r',
+            self.session(loop, log), loop)
+        # Waiting in tail position, deep in a loop
+        loops = tasks.evaluate('''(define f (lambda (x)
+                                     (if (< x 1) (lookup 5) (f (- x 1)))))
+                                  (f 3000)''', self.session(loop, log), loop)
+        assert loop.run_until_complete(tasks.gather([slow, waits, loops])) == [
+            610, 30, 50]
+        # The computation gave way to the others
+        assert log[:2] == ['slow', 'waits']
+        assert sorted(log[2:]) == [30, 'done']
+
+    def test_errors(self):
+        loop = Loop()
+        log = []
+        env = self.session(loop, log)
+        env['fail'] = AsyncPrimitive(lambda: loop_failure(loop))
+        task = tasks.evaluate('(+ 1 (fail))', env, loop)
+        with pytest.raises(KeyError):
+            loop.run_until_complete(task)
+        # Not from inside another primitive
+        task = tasks.evaluate('(map lookup (list 1 2))', env, loop)
+        with pytest.raises(RuntimeError):
+            loop.run_until_complete(task)
+        # Outside a task, the call blocks
+        done = Future()
+        done.set_result(7)
+        env['ready'] = AsyncPrimitive(lambda: done)
+        assert env.eval(parse('(+ 1 (ready))')) == 8
+
+    def test_compile_apart(self):
+        # Sessions compiling at once on different threads see their own
+        # macros
+        first, second = tasks.session(), tasks.session()
+        paused = {}
+        for env, name in [(first, 'first'), (second, 'second')]:
+            paused[name] = threading.Event(), threading.Event()
+            env['pause'] = lambda name=name: (
+                paused[name][0].set() or paused[name][1].wait(5))
+            env.eval(parse('(defmacro slow () (progn (pause) 0))'))
+        first.eval(parse('(defmacro m () 1)'))
+        second.eval(parse('(define m (lambda () 2))'))
+        results = {}
+
+        def compile_in(env, name, source):
+            results[name] = env.eval(parse(source))
+
+        threads = [
+            threading.Thread(target=compile_in,
+                             args=(second, 'second', '(progn (slow) (m))')),
+            threading.Thread(target=compile_in,
+                             args=(first, 'first', '(progn (slow) (m))'))]
+        try:
+            # The second starts compiling, then the first, then the second
+            # finishes while the first is still going
+            threads[0].start()
+            paused['second'][0].wait(5)
+            threads[1].start()
+            paused['first'][0].wait(5)
+            paused['second'][1].set()
+            threads[0].join(5)
+        finally:
+            for _, go in paused.values():
+                go.set()
+            for thread in threads:
+                thread.join()
+        assert results == {'first': 1, 'second': 2}
+
+    def test_budget(self):
+        loop = Loop()
+        log = []
+        spin = tasks.evaluate(
+            '(define spin (lambda (n) (spin (+ n 1)))) (spin 0)',
+            self.session(loop, log), loop, 100, Budget(steps=5000))
+        fib = tasks.evaluate('(fib 15)', self.session(loop, log), loop, 100)
+        with pytest.raises(LimitExceeded) as e:
+            loop.run_until_complete(spin)
+        assert e.value.usage['steps'] == 5001
+        # The other task isn't held to it
+        assert loop.run_until_complete(fib) == 610
+
+
+class TestLimits(PylispTestCase):
+
+    @pytest.fixture(autouse=True)
+    def procedures(self):
+        global_parse_and_eval('(define spin (lambda (n) (spin (+ n 1))))')
+        global_parse_and_eval('(define deep (lambda (n) (+ 1 (deep n))))')
+
+    def test_steps(self):
+        # (fib 10) is 177 calls
+        with Budget(steps=177) as budget:
+            assert global_parse_and_eval('(fib 10)') == 55
+        assert budget.usage()['steps'] == 177
+        with pytest.raises(LimitExceeded) as e:
+            global_parse_and_eval('(fib 10)', steps=176)
+        assert e.value.limit == 'steps'
+        assert e.value.usage['steps'] == 177
+        # Calls made from primitives count too
+        with pytest.raises(LimitExceeded):
+            global_parse_and_eval('(map (lambda (x) (spin x)) (list 1))',
+                                  steps=1000)
+
+    def test_deadline_and_depth(self):
+        with pytest.raises(LimitExceeded) as e:
+            global_parse_and_eval('(spin 0)', seconds=0.05)
+        assert e.value.limit == 'seconds'
+        assert e.value.usage['seconds'] >= 0.05
+        with pytest.raises(LimitExceeded) as e:
+            global_parse_and_eval('(deep 0)', depth=40)
+        assert e.value.limit == 'depth'
+        assert 40 < e.value.usage['depth'] <= 50
+        assert global_parse_and_eval('(fib 10)') == 55
+
+    def test_nested(self):
+        with Budget(steps=1000) as outer:
+            global_parse_and_eval('(fib 10)')
+            # Limited by what the outer budget has left
+            with pytest.raises(LimitExceeded) as e:
+                global_parse_and_eval('(spin 0)', steps=5000)
+            assert e.value.usage['limits']['steps'] == 1000 - 177
+            with pytest.raises(LimitExceeded):
+                global_parse_and_eval('(fib 1)')
+        assert outer.usage()['steps'] > 1000
+
+    def test_depth_from_entry(self):
+        # Calls already in progress when a budget starts don't count
+        environments.global_env['limited-deep'] = (
+            lambda: global_parse_and_eval('(deep 0)', depth=10))
+        global_parse_and_eval('''(define down (lambda (n)
+                                    (if (= n 0) (limited-deep)
+                                      (+ 1 (down (- n 1))))))''')
+        with pytest.raises(LimitExceeded) as e:
+            global_parse_and_eval('(down 30)')
+        assert 10 < e.value.usage['depth'] <= 13
+
+    def test_threads(self):
+        # Each thread's evaluations count against its own budget
+        results = {}
+
+        def run(name, source, steps):
+            try:
+                with Budget(steps=steps) as budget:
+                    for _ in range(20):
+                        global_parse_and_eval(source)
+                results[name] = budget.usage()['steps']
+            except LimitExceeded as e:
+                results[name] = e.usage['steps']
+
+        threads = [threading.Thread(target=run, args=args) for args in [
+            ('fib', '(fib 10)', 177 * 20), ('spin', '(spin 0)', 5000)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == {'fib': 177 * 20, 'spin': 5001}
+
+
+def loop_failure(loop):
+    future = Future()
+    loop.call_soon(future.set_exception, KeyError('nope'))
+    return future
+
+
+class TestServer(PylispTestCase):
+
+    @pytest.fixture
+    def serve(self, tmpdir):
+        servers = []
+
+        def serve(**kwargs):
+            path = str(tmpdir.join('pylisp.sock'))
+            server = make_server(path, **kwargs)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            servers.append(server)
+            return path
+        yield serve
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_sessions(self, serve):
+        path = serve()
+        first, second = Client(path), Client(path)
+        assert first.eval('(define x 5) (list x "s")') == '(5 "s")'
+        with pytest.raises(RemoteError):
+            second.eval('x')
+        assert first.eval('(+ x 1)') == '6'
+        metrics = first.metrics()
+        assert metrics['sessions'] == 2
+        assert metrics['requests'] == 3
+        assert metrics['errors'] == 1
+        assert metrics['latency_p50'] is not None
+        first.close()
+        second.close()
+
+    def test_limits(self, serve):
+        path = serve(workers=1, queue_size=0, timeout=0.5)
+        spinning, other = Client(path), Client(path)
+        spinning.eval('(define spin (lambda (n) (spin (+ n 1))))')
+        errors = []
+        thread = threading.Thread(target=lambda: errors.append(
+            pytest.raises(RemoteError, spinning.eval, '(spin 0)')))
+        thread.start()
+        while not other.metrics()['running']:
+            time.sleep(0.01)
+        with pytest.raises(RemoteError) as busy:
+            other.eval('1')
+        assert 'Busy' in str(busy.value)
+        thread.join()
+        assert 'EvalTimeout' in str(errors[0].value)
+        # The worker is free again
+        assert spinning.eval('(+ 1 2)') == '3'
+        metrics = other.metrics()
+        assert (metrics['timeouts'], metrics['busy']) == (1, 1)
+        spinning.close()
+        other.close()
+
+    def test_runaway(self, serve):
+        # A runaway evaluation, here inside a primitive, is stopped at its
+        # timeout, and doesn't hold up other sessions meanwhile
+        path = serve(workers=2, timeout=0.5)
+        spinning, other = Client(path), Client(path)
+        spinning.eval('(define spin (lambda (n) (spin (+ n 1))))')
+        errors = []
+        thread = threading.Thread(target=lambda: errors.append(
+            pytest.raises(RemoteError, spinning.eval,
+                          '(map (lambda (x) (spin x)) (list 1))')))
+        thread.start()
+        while not other.metrics()['running']:
+            time.sleep(0.01)
+        start = time.time()
+        assert other.eval('(fib 15)') == '610'
+        assert time.time() - start < 0.5
+        assert not errors
+        thread.join()
+        assert 'EvalTimeout' in str(errors[0].value)
+        assert other.metrics()['timeouts'] == 1
+        spinning.close()
+        other.close()
+
+    def test_stuck(self, monkeypatch, serve):
+        # One the vm never gets to stop still gets its response, and its
+        # worker is replaced
+        monkeypatch.setattr(server, 'GRACE', 0.1)
+        path = serve(workers=1, timeout=0.1)
+        stuck, other = Client(path), Client(path)
+        start = time.time()
+        with pytest.raises(RemoteError) as e:
+            stuck.eval('(reduce + (take 3000000 (count-from)))')
+        assert 'EvalTimeout' in str(e.value)
+        assert time.time() - start < 0.5
+        assert other.eval('(+ 1 2)') == '3'
+        metrics = other.metrics()
+        assert (metrics['timeouts'], metrics['stuck']) == (1, 1)
+        # Until it's done
+        while other.metrics()['stuck'] and time.time() - start < 10:
+            time.sleep(0.05)
+        assert other.metrics()['stuck'] == 0
+        stuck.close()
+        other.close()